@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+set -e
+
+python3 ./service_delivery_fact_snapshot_to_minio.py
\ No newline at end of file
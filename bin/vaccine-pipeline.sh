@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+set -e
+
+python3 ./vaccine_pipeline.py
@@ -1,4 +1,5 @@
 #!/usr/bin/env bash
 set -e
 
-python3 ./vaccine_register_munge.py
\ No newline at end of file
+# writes both the all staff and the willing staff register aggregates
+python3 ./vaccine_register_willing_munge.py
@@ -1,4 +0,0 @@
-#!/usr/bin/env bash
-set -e
-
-python3 ./vaccine_register_willing_munge.py
@@ -1,6 +1,5 @@
 #!/usr/bin/env bash
 set -e
 
-python3 ./vaccine_rollout_time_series.py
-
-
+# writes both the all staff and the willing staff time series
+python3 ./vaccine_rollout_willing_time_series.py
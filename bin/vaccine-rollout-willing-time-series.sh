@@ -1,4 +0,0 @@
-#!/usr/bin/env bash
-set -e
-
-python3 ./vaccine_rollout_willing_time_series.py
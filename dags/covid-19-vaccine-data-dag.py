@@ -39,6 +39,7 @@ k8s_run_env = {
     'COVID_19_DATA_DIR': '/covid-19-data',
     'DB_UTILS_LOCATION': 'https://ds2.capetown.gov.za/db-utils',
     'DB_UTILS_PKG': 'db_utils-0.4.0-py2.py3-none-any.whl',
+    'VACCINE_BACKUP_FULL_REBUILD': 'false',
 }
 
 # airflow-workers' secrets
@@ -79,40 +80,10 @@ def covid_19_data_task(task_name, task_kwargs={}):
 
 
 # Defining tasks
-VACCINE_FETCH_TASK = "vaccine-data-to-minio"
-vaccine_data_fetch_operator = covid_19_data_task(VACCINE_FETCH_TASK)
-
 VACCINE_STAFF_PUSH_TASK = "vaccine-staff-data-to-wcgh"
 vaccine_staff_data_push_operator = covid_19_data_task(VACCINE_STAFF_PUSH_TASK)
 
-VACCINE_SEQ_MUNGE = "vaccine-sequencing-munge"
-vaccine_seq_munge_operator = covid_19_data_task(VACCINE_SEQ_MUNGE)
-
-VACCINE_SEQ_AGG_TASK = "vaccine-sequencing-aggregation"
-vaccine_seq_agg_operator = covid_19_data_task(VACCINE_SEQ_AGG_TASK)
-
-VACCINE_ANN_HR_MUNGE_TASK = "vaccine-annotate-hr-munge"
-vaccine_ann_hr_munge_operator = covid_19_data_task(VACCINE_ANN_HR_MUNGE_TASK)
-
-VACCINE_ANN_NON_HR_MUNGE_TASK = "vaccine-annotate-non-hr-munge"
-vaccine_ann_non_hr_munge_operator = covid_19_data_task(VACCINE_ANN_NON_HR_MUNGE_TASK)
-
-VACCINE_REG_AGG_MUNGE_TASK = "vaccine-register-munge"
-vaccine_agg_munge_operator = covid_19_data_task(VACCINE_REG_AGG_MUNGE_TASK)
-
-VACCINE_REG_AGG_WILLING_MUNGE_TASK = "vaccine-register-willing-munge"
-vaccine_agg_willing_munge_operator = covid_19_data_task(VACCINE_REG_AGG_WILLING_MUNGE_TASK)
-
-VACCINE_TIME_SERIES_MUNGE_TASK = "vaccine-rollout-time-series"
-vaccine_time_series_munge_operator = covid_19_data_task(VACCINE_TIME_SERIES_MUNGE_TASK)
-
-VACCINE_TIME_SERIES_WILLING_MUNGE_TASK = "vaccine-rollout-willing-time-series"
-vaccine_time_series_willing_munge_operator = covid_19_data_task(VACCINE_TIME_SERIES_WILLING_MUNGE_TASK)
-
-# Dependencies
-vaccine_data_fetch_operator >> (vaccine_seq_munge_operator, vaccine_ann_hr_munge_operator)
-vaccine_seq_munge_operator >> vaccine_seq_agg_operator
-vaccine_ann_hr_munge_operator >> vaccine_ann_non_hr_munge_operator >> vaccine_agg_munge_operator
-vaccine_agg_munge_operator >> vaccine_time_series_munge_operator
-vaccine_seq_agg_operator >> vaccine_ann_non_hr_munge_operator >> vaccine_agg_willing_munge_operator
-vaccine_agg_willing_munge_operator >> vaccine_time_series_willing_munge_operator
\ No newline at end of file
+# The whole vaccine munging chain, from fetching the lists through to the time series, in a single process, so that
+# each step's outputs are handed straight to the later steps instead of them being read back out of minio
+VACCINE_PIPELINE_TASK = "vaccine-pipeline"
+vaccine_pipeline_operator = covid_19_data_task(VACCINE_PIPELINE_TASK)
\ No newline at end of file
@@ -39,7 +39,8 @@ k8s_run_env = {
     'COVID_19_DEPLOY_URL': 'https://ds2.capetown.gov.za/covid-19-data-deploy',
     'COVID_19_DATA_DIR': '/covid-19-data',
     'DB_UTILS_LOCATION': 'https://ds2.capetown.gov.za/db-utils',
-    'DB_UTILS_PKG': 'db_utils-0.3.7-py2.py3-none-any.whl'
+    'DB_UTILS_PKG': 'db_utils-0.3.7-py2.py3-none-any.whl',
+    'HR_ORG_UNIT_FULL_REBUILD': 'false',
 }
 
 # airflow-workers' secrets
@@ -41,7 +41,9 @@ k8s_run_env = {
     'GEOSPATIAL_UTILS_LOCATION': 'https://ds2.capetown.gov.za/geospatial-utils',
     'GEOSPATIAL_UTILS_PKG': "geospatial_utils-0.2-py3-none-any.whl",
     'DB_UTILS_LOCATION': 'https://ds2.capetown.gov.za/db-utils',
-    'DB_UTILS_PKG': 'db_utils-0.3.7-py2.py3-none-any.whl'
+    'DB_UTILS_PKG': 'db_utils-0.3.7-py2.py3-none-any.whl',
+    'SERVICE_DELIVERY_FULL_REBUILD': 'false',
+    'SERVICE_DELIVERY_AREA_METRICS_WORKERS': '6',
 }
 
 # airflow-workers' secrets
@@ -81,6 +83,9 @@ def covid_19_data_task(task_name, task_kwargs={}):
 
 
 # Defining tasks
+FACT_SNAPSHOT_TASK = 'service-delivery-fact-snapshot'
+fact_snapshot_operator = covid_19_data_task(FACT_SNAPSHOT_TASK)
+
 DATA_FETCH_TASK = 'service-delivery-ts-generate'
 data_fetch_operator = covid_19_data_task(DATA_FETCH_TASK)
 
@@ -98,4 +103,6 @@ AREA_DATA_MUNGE_TASK = "service-delivery-area-metrics-munge"
 area_data_munge_operator = covid_19_data_task(AREA_DATA_MUNGE_TASK)
 
 # Dependencies
+fact_snapshot_operator >> [data_fetch_operator, data_munge_operator, data_hex_munge_operator,
+                           spatial_data_fetch_operator, area_data_munge_operator]
 spatial_data_fetch_operator >> spatial_data_munge_operator
\ No newline at end of file
@@ -1,3 +1,4 @@
+import itertools
 import json
 import logging
 import os
@@ -5,8 +6,11 @@ import sys
 import tempfile
 
 from db_utils import minio_utils
+import numpy
 import pandas
 from pandas.errors import EmptyDataError
+import pyarrow
+import pyarrow.parquet
 
 BUCKET = 'covid'
 CLASSIFICATION = minio_utils.DataClassification.EDGE
@@ -151,9 +155,9 @@ HR_TRANSACTIONAL_COLUMN_VERIFICATION_FUNCS = {
     HR_STATUS: (lambda col: (col.isin(VALID_STATUSES) == True),
                 lambda invalid_df: f"\n{invalid_df[HR_STATUS].value_counts()}, "
                                    f"\n{invalid_df[HR_STATUS].value_counts().index}"),
+    # NB the transaction date is validated using the parsed column, see TYPED_COLUMN_PARSE_FUNCS
     HR_TRANSACTION_DATE: (lambda col: (
-        (pandas.to_datetime(col, format=ISO8601_FORMAT, errors='coerce').notna()) &
-        (pandas.to_datetime(col, format=ISO8601_FORMAT, errors='coerce').dt.date <= pandas.Timestamp.today().date())
+        col.notna() & (col.dt.normalize() <= pandas.Timestamp.today().normalize())
     ),
                           lambda invalid_df: f"\n{invalid_df[HR_TRANSACTION_DATE].value_counts()}, "
                                              f"\n{invalid_df[HR_TRANSACTION_DATE].value_counts().index}"),
@@ -162,6 +166,11 @@ HR_TRANSACTIONAL_COLUMN_VERIFICATION_FUNCS = {
                                             f"\n{invalid_df[HR_UNIT_EVALUATION].value_counts().index}")
 }
 
+# Columns that are parsed once, with the typed values used by the validation functions
+TYPED_COLUMN_PARSE_FUNCS = {
+    HR_TRANSACTION_DATE: lambda col: pandas.to_datetime(col, format=ISO8601_FORMAT, errors='coerce'),
+}
+
 HR_APPROVER = "Approver"
 HR_APPROVER_STAFFNUMBER = "ApproverStaffNumber"
 HR_TRANSACTIONAL_COLUMN_RENAME_DICT = {
@@ -173,8 +182,20 @@ HR_TRANSACTIONAL_COLUMN_RENAME_DICT = {
 CLEANED_HR_TRANSACTIONAL_PREFIX = "data/private/business_continuity_people_status"
 CLEANED_HR_TRANSACTIONAL_FILENAME = f"{CLEANED_HR_TRANSACTIONAL_PREFIX}.csv"
 
+# People status history, as a Parquet dataset partitioned by the status date
+HR_HISTORY_PREFIX = f"{CLEANED_HR_TRANSACTIONAL_PREFIX}_history/"
+HR_HISTORY_PARTITION_COL = "status_date"
+HR_HISTORY_PARTITION_FILENAME = "part-0.parquet"
+HR_HISTORY_DATE_FORMAT = "%Y-%m-%d"
+HR_HISTORY_COLUMNS = [HR_TRANSACTIONAL_COLUMN_RENAME_DICT.get(col, col) for col in HR_TRANSACTIONAL_COLUMNS]
+HR_HISTORY_SCHEMA = pyarrow.schema([(col, pyarrow.string()) for col in HR_HISTORY_COLUMNS])
+# Content hash of each partition, so that downstream scripts can tell which status dates have changed
+HR_HISTORY_MANIFEST_PREFIX = f"{CLEANED_HR_TRANSACTIONAL_PREFIX}_history_manifest"
+HR_HISTORY_MANIFEST_FILENAME = f"{HR_HISTORY_MANIFEST_PREFIX}.parquet"
+HR_HISTORY_HASH_COL = "content_hash"
 
-def get_data_df(filename, minio_access, minio_secret):
+
+def get_data_df(filename, minio_access, minio_secret, **read_csv_kwargs):
     with tempfile.NamedTemporaryFile() as temp_data_file:
         logging.debug("Pulling data from Minio bucket...")
         result = minio_utils.minio_to_file(
@@ -189,7 +210,7 @@ def get_data_df(filename, minio_access, minio_secret):
 
         logging.debug(f"Reading in raw data from '{temp_data_file.name}'...")
         try:
-            data_df = pandas.read_csv(temp_data_file)
+            data_df = pandas.read_csv(temp_data_file, **read_csv_kwargs)
         except EmptyDataError as e:
             logging.warning("Datafile is empty. Returning an empty dataframe.")
             data_df = pandas.DataFrame()
@@ -208,41 +229,49 @@ def flatten_hr_form(hr_df):
 
     logging.debug(f"Not flattening '{(already_flat).sum()}'/'{hr_df.shape[0]}' because they seem to already be flat")
 
-    def flatten_row(row):
-        # Flattening the columns that need it
-        flattened_column_values = {
-            col: [val for val in row[col].split(";")]
-            for col in HR_COLUMNS_TO_FLATTEN
-        }
-        try:
-            row_df = pandas.DataFrame(flattened_column_values)
-
-            # Broadcasting all of the other columns
-            for col in hr_df.columns:
-                if col not in HR_COLUMNS_TO_FLATTEN:
-                    row_df[col] = row[col]
-
-            return row_df
-        except ValueError:
-            length_strings = [col + ':' + str(len(values)) for col, values in flattened_column_values.items()]
-            logging.error(
-                f"Skipping {row['Manager Staff No']} on {row['Date']}, lengths are {','.join(length_strings)}"
-            )
+    to_flatten_df = hr_df[~(null_entries | already_flat)]
+    flatten_cols = [col for col in hr_df.columns if col in HR_COLUMNS_TO_FLATTEN]
 
-    flat_df = pandas.concat(
-        hr_df[~(null_entries | already_flat)].apply(flatten_row, axis=1).values
-    )
+    # Splitting whole columns at once, and checking that each row splits into the same number of values in every column
+    split_values = {col: to_flatten_df[col].str.split(";") for col in flatten_cols}
+    split_lengths = pandas.DataFrame({col: values.str.len() for col, values in split_values.items()})
+    consistent_lengths = split_lengths.nunique(axis=1) == 1
 
-    # Appending entries without ";"
-    flat_df = flat_df.append(hr_df[already_flat]).reset_index(drop=True)
+    for index, lengths in split_lengths[~consistent_lengths].iterrows():
+        length_strings = [col + ':' + str(length) for col, length in lengths.items()]
+        logging.error(
+            f"Skipping {to_flatten_df.loc[index, 'Manager Staff No']} on {to_flatten_df.loc[index, 'Date']}, "
+            f"lengths are {','.join(length_strings)}"
+        )
 
-    # Appending the null entries
+    # Repeating each row once per value, and then laying the split values out alongside
+    row_lengths = split_lengths.loc[consistent_lengths, flatten_cols[0]]
+    flat_df = to_flatten_df[consistent_lengths].loc[to_flatten_df[consistent_lengths].index.repeat(row_lengths)]
+    for col in flatten_cols:
+        flat_df[col] = list(itertools.chain.from_iterable(split_values[col][consistent_lengths]))
+
+    # Appending entries without ";", and then the null entries
     # Probably no point, but that is not the job of this function!
-    flat_df = flat_df.append(hr_df[null_entries]).reset_index(drop=True)
+    flat_df = pandas.concat([flat_df, hr_df[already_flat], hr_df[null_entries]]).reset_index(drop=True)
 
     return flat_df
 
 
+def remap_values(values, remap):
+    remap_func = lambda val: remap.get(val, str(val).strip())
+
+    # Remapping only the unique values, and then broadcasting the results back using the codes
+    codes, uniques = pandas.factorize(values)
+    remapped_uniques = numpy.array([remap_func(val) for val in uniques] + [None], dtype=object)
+    remapped = pandas.Series(remapped_uniques[codes], index=values.index, dtype=object)
+
+    # factorize lumps None and NaN together, so remapping the (hopefully few) null values one at a time
+    null_values = codes == -1
+    remapped[null_values] = [remap_func(val) for val in values[null_values]]
+
+    return remapped
+
+
 def clean_hr_form(hr_df, master_df):
     logging.debug(f"hr_df.shape={hr_df.shape}")
 
@@ -250,19 +279,21 @@ def clean_hr_form(hr_df, master_df):
     hr_df[HR_TRANSACTIONAL_STAFFNUMBER] = hr_df[HR_TRANSACTIONAL_STAFFNUMBER].astype(str).str.extract(".*(\d{8}).*")
 
     # Remapping statuses
-    hr_df[HR_STATUS] = hr_df[HR_STATUS].apply(
-        lambda val: STATUS_REMAP.get(val, str(val).strip())
-    )
+    hr_df[HR_STATUS] = remap_values(hr_df[HR_STATUS], STATUS_REMAP)
 
     # Remapping evaluation statuses
-    hr_df[HR_UNIT_EVALUATION] = hr_df[HR_UNIT_EVALUATION].apply(
-        lambda val: EVALUATION_STATUS_REMAP.get(val, str(val).strip())
-    )
+    hr_df[HR_UNIT_EVALUATION] = remap_values(hr_df[HR_UNIT_EVALUATION], EVALUATION_STATUS_REMAP)
+
+    # Parsing typed columns once, for the validation functions to reuse
+    typed_cols = {
+        col: parse_func(hr_df[col])
+        for col, parse_func in TYPED_COLUMN_PARSE_FUNCS.items()
+    }
 
     # Checking validity of HR DF, and *not* selecting invalid value
     hr_df["Valid"] = True
     for col, (validity_func, debug_func) in HR_TRANSACTIONAL_COLUMN_VERIFICATION_FUNCS.items():
-        col_validity = validity_func(hr_df[col])
+        col_validity = validity_func(typed_cols.get(col, hr_df[col]))
 
         if col_validity.sum() != col_validity.shape[0]:
             logging.warning(f"Found {(~col_validity).sum()} invalid values in attribute '{col}'")
@@ -334,6 +365,188 @@ def update_hr_dataset(cleaned_hr_df, current_state_df):
     return deduped_df
 
 
+def get_status_dates(hr_df):
+    return pandas.to_datetime(hr_df[HR_TRANSACTION_DATE]).dt.strftime(HR_HISTORY_DATE_FORMAT)
+
+
+def _normalise_history_df(hr_df):
+    # Everything is stored as strings (bar the nulls), in a stable order, so that partitions can be compared
+    history_df = hr_df[HR_HISTORY_COLUMNS].astype(object)
+    history_df = history_df.where(history_df.isna(), history_df.astype(str))
+
+    return history_df.sort_values(by=[HR_MASTER_STAFFNUMBER, HR_TRANSACTION_DATE]).reset_index(drop=True)
+
+
+def _list_history_partitions(minio_access, minio_secret):
+    history_partitions = {}
+    for object_name in minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                                          minio_prefix_override=HR_HISTORY_PREFIX):
+        if object_name.endswith(".parquet"):
+            partition_values = dict(part.split("=", 1) for part in object_name.split("/") if "=" in part)
+            history_partitions[partition_values[HR_HISTORY_PARTITION_COL]] = object_name
+
+    return history_partitions
+
+
+def _get_history_partitions_df(partition_objects, minio_access, minio_secret):
+    if not partition_objects:
+        return pandas.DataFrame(columns=HR_HISTORY_COLUMNS)
+
+    partition_dfs = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        for i, object_name in enumerate(partition_objects):
+            local_path = os.path.join(tempdir, f"{i}.parquet")
+            result = minio_utils.minio_to_file(local_path,
+                                               BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                               minio_filename_override=object_name)
+            assert result, f"Failed to fetch people status partition '{object_name}'!"
+
+            partition_dfs += [pyarrow.parquet.read_table(local_path, schema=HR_HISTORY_SCHEMA).to_pandas()]
+
+    return pandas.concat(partition_dfs, ignore_index=True)
+
+
+def get_hr_history_df(minio_access, minio_secret, start_date=None, end_date=None):
+    # Dates are ISO8601 date strings, and are inclusive
+    history_partitions = _list_history_partitions(minio_access, minio_secret)
+    selected_partitions = [
+        object_name
+        for status_date, object_name in sorted(history_partitions.items())
+        if (start_date is None or status_date >= start_date) and (end_date is None or status_date <= end_date)
+    ]
+    logging.debug(f"Selected {len(selected_partitions)}/{len(history_partitions)} people status partitions")
+
+    return _get_history_partitions_df(selected_partitions, minio_access, minio_secret)
+
+
+def get_hr_history_manifest(minio_access, minio_secret):
+    manifest_files = set(minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                                            minio_prefix_override=HR_HISTORY_MANIFEST_FILENAME))
+    if HR_HISTORY_MANIFEST_FILENAME not in manifest_files:
+        logging.warning(f"No people status history manifest found at '{HR_HISTORY_MANIFEST_FILENAME}'")
+        return pandas.DataFrame(columns=[HR_HISTORY_PARTITION_COL, HR_HISTORY_HASH_COL])
+
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_manifest_file:
+        result = minio_utils.minio_to_file(temp_manifest_file.name,
+                                           BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                           minio_filename_override=HR_HISTORY_MANIFEST_FILENAME)
+        assert result, f"Failed to fetch people status history manifest '{HR_HISTORY_MANIFEST_FILENAME}'!"
+        manifest_df = pandas.read_parquet(temp_manifest_file.name)
+
+    return manifest_df[[HR_HISTORY_PARTITION_COL, HR_HISTORY_HASH_COL]]
+
+
+def put_hr_history_partitions(hr_df, minio_access, minio_secret):
+    history_df = _normalise_history_df(hr_df)
+    partition_hashes = {}
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        local_path = os.path.join(tempdir, HR_HISTORY_PARTITION_FILENAME)
+        for status_date, partition_df in history_df.groupby(get_status_dates(history_df)):
+            partition_hashes[status_date] = str(pandas.util.hash_pandas_object(partition_df, index=False).sum())
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_pandas(partition_df, schema=HR_HISTORY_SCHEMA, preserve_index=False),
+                local_path
+            )
+
+            # Same object name for each write, so this replaces whatever was in the partition before
+            result = minio_utils.file_to_minio(
+                filename=local_path,
+                minio_bucket=BUCKET,
+                minio_key=minio_access,
+                minio_secret=minio_secret,
+                data_classification=CLASSIFICATION,
+                filename_prefix_override=f"{HR_HISTORY_PREFIX}{HR_HISTORY_PARTITION_COL}={status_date}/",
+            )
+            assert result, f"Failed to upload people status partition '{status_date}'!"
+
+    # Updating the manifest with the partitions that have just been written
+    manifest_df = get_hr_history_manifest(minio_access, minio_secret)
+    manifest_df = pandas.concat([
+        manifest_df[~manifest_df[HR_HISTORY_PARTITION_COL].isin(partition_hashes.keys())],
+        pandas.DataFrame({HR_HISTORY_PARTITION_COL: list(partition_hashes.keys()),
+                          HR_HISTORY_HASH_COL: list(partition_hashes.values())})
+    ]).sort_values(by=HR_HISTORY_PARTITION_COL)
+
+    result = minio_utils.dataframe_to_minio(manifest_df, BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                            filename_prefix_override=HR_HISTORY_MANIFEST_PREFIX,
+                                            data_versioning=False,
+                                            file_format="parquet")
+    assert result, "Failed to upload people status history manifest!"
+
+
+def upsert_hr_history(cleaned_hr_df, minio_access, minio_secret):
+    # Only the partitions for the dates that are in the cleaned data could possibly change
+    history_partitions = _list_history_partitions(minio_access, minio_secret)
+    touched_dates = set(get_status_dates(cleaned_hr_df))
+    stored_df = _get_history_partitions_df(
+        [object_name for status_date, object_name in sorted(history_partitions.items()) if status_date in touched_dates],
+        minio_access, minio_secret
+    )
+    logging.debug(f"Read {stored_df.shape[0]} stored values for {len(touched_dates)} status dates")
+
+    current_state_df = stored_df
+    if not history_partitions:
+        logging.warning(f"No people status history found, seeding it from '{CLEANED_HR_TRANSACTIONAL_FILENAME}'")
+        current_state_df = get_data_df(CLEANED_HR_TRANSACTIONAL_FILENAME, minio_access, minio_secret)
+        if current_state_df.empty:
+            current_state_df = pandas.DataFrame(columns=HR_HISTORY_COLUMNS)
+
+    updated_df = _normalise_history_df(update_hr_dataset(cleaned_hr_df, current_state_df))
+    updated_dates = get_status_dates(updated_df)
+
+    # Then, only writing back the partitions that are new or have changed
+    stored_df = _normalise_history_df(stored_df)
+    stored_partitions = dict(iter(stored_df.groupby(get_status_dates(stored_df))))
+    changed_dates = [
+        status_date
+        for status_date, partition_df in updated_df.groupby(updated_dates)
+        if (status_date not in stored_partitions or
+            not partition_df.reset_index(drop=True).equals(stored_partitions[status_date].reset_index(drop=True)))
+    ]
+    logging.debug(f"Writing {len(changed_dates)}/{updated_dates.nunique()} people status partitions")
+
+    changed_df = updated_df[updated_dates.isin(changed_dates)]
+    put_hr_history_partitions(changed_df, minio_access, minio_secret)
+
+    # All of the values of the partitions that have changed
+    return changed_df
+
+
+def replace_history_partitions(hr_df, partitions_df):
+    # Replacing all of the values in hr_df for the status dates that are in partitions_df
+    if hr_df.empty:
+        return partitions_df
+
+    return pandas.concat([
+        hr_df[~get_status_dates(hr_df).isin(set(get_status_dates(partitions_df)))],
+        partitions_df
+    ], ignore_index=True)
+
+
+def put_hr_transactional_csv(changed_hr_df, minio_access, minio_secret):
+    # The full people status CSV is still published, for anything outside this repo that reads it. Only the partitions
+    # that have changed are spliced into it, rather than reading all of the history back in.
+    if changed_hr_df.empty:
+        logging.debug(f"No people status partitions have changed, so '{CLEANED_HR_TRANSACTIONAL_FILENAME}' is current")
+        return
+
+    # Read as text, so that the values that aren't being replaced are written back out exactly as they were
+    stored_hr_df = get_data_df(CLEANED_HR_TRANSACTIONAL_FILENAME, minio_access, minio_secret,
+                               dtype=str, keep_default_na=False)
+    hr_transactional_df = replace_history_partitions(
+        stored_hr_df[HR_HISTORY_COLUMNS] if not stored_hr_df.empty else stored_hr_df,
+        changed_hr_df[HR_HISTORY_COLUMNS]
+    ).sort_values(by=[HR_TRANSACTION_DATE], ascending=False, kind="stable")
+    logging.debug(f"hr_transactional_df.shape={hr_transactional_df.shape}")
+
+    result = minio_utils.dataframe_to_minio(hr_transactional_df, BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                            filename_prefix_override=CLEANED_HR_TRANSACTIONAL_PREFIX,
+                                            data_versioning=False,
+                                            file_format="csv")
+    assert result, f"Failed to upload '{CLEANED_HR_TRANSACTIONAL_FILENAME}'!"
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
@@ -352,9 +565,6 @@ if __name__ == "__main__":
     hr_form_df = get_data_df(HR_FORM_FILENAME_PATH,
                              secrets["minio"]["edge"]["access"],
                              secrets["minio"]["edge"]["secret"])
-    hr_transactional_df = get_data_df(CLEANED_HR_TRANSACTIONAL_FILENAME,
-                                      secrets["minio"]["edge"]["access"],
-                                      secrets["minio"]["edge"]["secret"])
     hr_master_df = get_data_df(HR_MASTER_FILENAME_PATH,
                                secrets["minio"]["edge"]["access"],
                                secrets["minio"]["edge"]["secret"])
@@ -368,17 +578,16 @@ if __name__ == "__main__":
     cleaned_hr_form_df = clean_hr_form(flat_hr_form_df, hr_master_df)
     logging.info("Clean[ed] HR form data")
 
-    logging.info("Dedup[ing] HR form data")
-    deduped_hr_form_df = update_hr_dataset(cleaned_hr_form_df, hr_transactional_df)
-    logging.info("Dedup[ed] HR form data")
-
-    # Writing result out
-    logging.info("Writing cleaned HR Form DataFrame to Minio...")
-    minio_utils.dataframe_to_minio(deduped_hr_form_df, BUCKET,
-                                   secrets["minio"]["edge"]["access"],
-                                   secrets["minio"]["edge"]["secret"],
-                                   minio_utils.DataClassification.EDGE,
-                                   filename_prefix_override=CLEANED_HR_TRANSACTIONAL_PREFIX,
-                                   data_versioning=False,
-                                   file_format="csv")
+    logging.info("Upsert[ing] HR form data into the people status history")
+    changed_hr_df = upsert_hr_history(cleaned_hr_form_df,
+                                      secrets["minio"]["edge"]["access"],
+                                      secrets["minio"]["edge"]["secret"])
+    logging.info("Upsert[ed] HR form data into the people status history")
+
+    logging.info(f"Writ[ing] the people status history to '{CLEANED_HR_TRANSACTIONAL_FILENAME}'")
+    put_hr_transactional_csv(changed_hr_df,
+                             secrets["minio"]["edge"]["access"],
+                             secrets["minio"]["edge"]["secret"])
+    logging.info(f"Wr[ote] the people status history to '{CLEANED_HR_TRANSACTIONAL_FILENAME}'")
+
     logging.info("...Done!")
@@ -6,11 +6,13 @@ import tempfile
 
 from db_utils import minio_utils
 import holidays
+import numpy
 import pandas
 
+import hr_data_munge
+
 BUCKET = 'covid'
 CLASSIFICATION = minio_utils.DataClassification.EDGE
-HR_TRANSACTIONAL_FILENAME_PATH = "data/private/business_continuity_people_status.csv"
 HR_MASTER_FILENAME_PATH = "data/private/city_people.csv"
 HR_ORG_UNIT_MASTER_PATH = "data/private/city_org_unit_master_data.csv"
 
@@ -31,14 +33,28 @@ HR_ORG_UNIT_COLUMNS = [
 ]
 
 HR_ORG_UNIT_STATUSES = "data/private/business_continuity_org_unit_statuses"
+HR_STATUS_COUNT = "StatusCount"
+# Both the full and incremental outputs are written in this order, so that they come out the same
+HR_ORG_UNIT_SORT_COLUMNS = [HR_TRANSACTION_DATE, *HR_ORG_UNIT_COLUMNS, HR_CATEGORIES]
 
 SMOOTHING_THRESHOLD = 4
-ZA_HOLIDAYS = holidays.CountryHoliday("ZA", prov="WC")
+HOLIDAYS_COUNTRY = "ZA"
+HOLIDAYS_PROVINCE = "WC"
 
 HR_ORG_UNIT_SMOOTHED_STATUSES = "data/private/business_continuity_org_unit_smoothed_statuses"
 
+# Incremental state, i.e. the people status history manifest that the stored outputs were built from, along with a
+# hash of the org unit hierarchy
+HR_ORG_UNIT_STATE = "data/private/business_continuity_org_unit_state"
+ORG_UNIT_HIERARCHY_HASH_COL = "org_unit_hierarchy_hash"
+# ...as well as the staff's org units and locations, and the status dates that each staff member has statuses on
+HR_ORG_UNIT_STAFF_STATE = "data/private/business_continuity_org_unit_staff_state"
+HR_ORG_UNIT_STAFF_DATES_STATE = "data/private/business_continuity_org_unit_staff_dates_state"
+STAFF_ATTRIBUTE_COLUMNS = [HR_STAFF_ORG_UNIT, HR_LOCATION]
+FULL_REBUILD_VAR = "HR_ORG_UNIT_FULL_REBUILD"
+
 
-def get_data_df(filename, minio_access, minio_secret):
+def get_data_df(filename, minio_access, minio_secret, **read_csv_kwargs):
     with tempfile.NamedTemporaryFile() as temp_data_file:
         logging.debug("Pulling data from Minio bucket...")
         result = minio_utils.minio_to_file(
@@ -52,7 +68,7 @@ def get_data_df(filename, minio_access, minio_secret):
         assert result
 
         logging.debug(f"Reading in raw data from '{temp_data_file.name}'...")
-        data_df = pandas.read_csv(temp_data_file)
+        data_df = pandas.read_csv(temp_data_file, **read_csv_kwargs)
         data_df.drop([
             col for col in data_df.columns
             if "Unnamed" in col
@@ -61,6 +77,11 @@ def get_data_df(filename, minio_access, minio_secret):
     return data_df
 
 
+def get_stored_df(filename, minio_access, minio_secret):
+    # Reading the stored outputs back in exactly as they were written, otherwise the "N/A" fill values become NaN
+    return get_data_df(filename, minio_access, minio_secret, dtype=str, keep_default_na=False)
+
+
 def merge_df(hr_df, hr_master_df, hr_org_df):
     combined_df = hr_df.merge(
         hr_master_df,
@@ -94,32 +115,90 @@ def merge_df(hr_df, hr_master_df, hr_org_df):
     return combined_df
 
 
-def _is_weekend_or_public_holiday(date):
-    return (date.weekday in {5, 6}) or (date in ZA_HOLIDAYS)
+def get_holiday_calendar(min_date, max_date):
+    # Padding by a year on either side, so that business day offsets can step outside of the date range
+    za_holidays = holidays.CountryHoliday(HOLIDAYS_COUNTRY, prov=HOLIDAYS_PROVINCE,
+                                          years=range(min_date.year - 1, max_date.year + 2))
+
+    return numpy.busdaycalendar(holidays=numpy.array(sorted(za_holidays), dtype="datetime64[D]"))
+
+
+def get_business_day_calendar(min_date, max_date):
+    # All of the business days in the date range, as well as the max date, so that values always reach the latest date
+    business_day_calendar = get_holiday_calendar(min_date, max_date)
+
+    calendar_days = numpy.arange(min_date, max_date + numpy.timedelta64(1, "D"), dtype="datetime64[D]")
+    calendar_mask = numpy.is_busday(calendar_days, busdaycal=business_day_calendar) | (calendar_days == max_date)
+
+    return calendar_days[calendar_mask]
 
 
 def smooth_combined_df(combined_df):
-    max_date = pandas.to_datetime(combined_df.Date).max()
+    status_dates = pandas.to_datetime(combined_df[HR_TRANSACTION_DATE]).values.astype("datetime64[D]")
+    max_date = status_dates.max()
     logging.debug(f"max_date={max_date}")
 
     logging.debug(f"combined_df.shape={combined_df.shape}")
-    # First, rolling values forward by several days, clipping to the current max date
-    smoothed_df = combined_df.append([
-            combined_df.copy().assign(
-                Date=(pandas.to_datetime(combined_df.Date) + pandas.Timedelta(days=i)).clip(upper=max_date)
-            ).query("~Date.apply(@_is_weekend_or_public_holiday) ")
-            for i in range(1, SMOOTHING_THRESHOLD+1)
-    # Then, only keeping the values which add something new
-    ]).drop_duplicates(
-        subset=[HR_STAFFNUMBER, HR_TRANSACTION_DATE],
-        keep="first"
-    )
+    calendar = get_business_day_calendar(status_dates.min().astype(object), max_date.astype(object))
+
+    # Position of the latest calendar day on or before each status date, which is where it gets filled forward from,
+    # and of the earliest calendar day on or after each status date, which is where it stops the previous status
+    status_df = combined_df.assign(
+        calendar_pos=numpy.searchsorted(calendar, status_dates, side="right") - 1,
+        block_pos=numpy.searchsorted(calendar, status_dates, side="left"),
+        status_date=status_dates,
+    ).sort_values(by=[HR_STAFFNUMBER, "status_date"])
+    status_df["next_block_pos"] = status_df.groupby(HR_STAFFNUMBER)["block_pos"].shift(-1).fillna(calendar.shape[0])
+
+    # Only using the most recent status in each position to fill forward with
+    source_df = status_df.drop_duplicates(subset=[HR_STAFFNUMBER, "calendar_pos"], keep="last")
+
+    # Rolling values forward by several business days, stopping at the staff member's next status or the max date
+    fill_counts = numpy.minimum(source_df["next_block_pos"] - source_df["calendar_pos"] - 1,
+                                SMOOTHING_THRESHOLD).astype(int)
+
+    filled_df = source_df.loc[source_df.index.repeat(fill_counts)]
+    fill_offsets = filled_df.groupby(level=0).cumcount().values + 1
+    filled_df[HR_TRANSACTION_DATE] = calendar[filled_df["calendar_pos"].values + fill_offsets].astype(object)
+
+    smoothed_df = pandas.concat([
+        combined_df,
+        filled_df.drop(["calendar_pos", "block_pos", "status_date", "next_block_pos"], axis="columns")
+    ])
     logging.debug(f"smoothed_df.shape={smoothed_df.shape}")
 
     return smoothed_df
 
 
-def get_org_unit_df(combined_df):
+def get_group_value_counts(values, group_ids, group_count):
+    # (group x value) count matrix, with a row for every group, even if it only has null values. Only meant for columns
+    # with a handful of distinct values, such as the statuses
+    return values.groupby(group_ids).value_counts().unstack(fill_value=0).reindex(
+        range(group_count), fill_value=0
+    )
+
+
+def get_group_modes(values, group_ids, group_count):
+    # Most common value in each group, i.e. the argmax of each row of the (group x value) count matrix. The matrix is
+    # kept sparse, as some of the columns (e.g. location) have nearly as many values as there are groups.
+    value_codes, value_uniques = pandas.factorize(values, sort=True)
+    has_value = value_codes != -1
+    cell_ids, cell_counts = numpy.unique(group_ids.values[has_value] * value_uniques.shape[0] + value_codes[has_value],
+                                         return_counts=True)
+    cell_groups, cell_values = numpy.divmod(cell_ids, value_uniques.shape[0])
+
+    # Ordering cells by group, then count (descending), then value - ties go to the lowest value, like Series.mode
+    cell_order = numpy.lexsort((cell_values, -cell_counts, cell_groups))
+    group_firsts = numpy.r_[True, cell_groups[cell_order][1:] != cell_groups[cell_order][:-1]]
+    mode_cells = cell_order[group_firsts[:cell_order.shape[0]]]
+
+    modes = numpy.full(group_count, None, dtype=object)
+    modes[cell_groups[mode_cells]] = value_uniques[cell_values[mode_cells]]
+
+    return modes
+
+
+def get_org_unit_df(combined_df, statuses=()):
     # We only care about dates
     combined_df[HR_TRANSACTION_DATE] = pandas.to_datetime(
         combined_df[HR_TRANSACTION_DATE]
@@ -134,31 +213,32 @@ def get_org_unit_df(combined_df):
     logging.debug(f"filled_df.shape=\n{filled_df.shape}")
 
     groupby_cols = [*HR_ORG_UNIT_COLUMNS, HR_TRANSACTION_DATE]
-    flattened_org_unit_df = (
-        filled_df[[*groupby_cols, HR_TRANSACTION_EVALUATION, HR_LOCATION, HR_CATEGORIES]].groupby(groupby_cols, sort=False)
-            .apply(
-            lambda df: pandas.DataFrame({
-                # select the most common value in the evaluation and location cols
-                HR_TRANSACTION_EVALUATION: df[HR_TRANSACTION_EVALUATION].mode(),
-                HR_LOCATION: df[HR_LOCATION].mode(),
-                # do a count of the different statuses - actually quite sneaky data manipulation
-                **df[HR_CATEGORIES].value_counts().to_dict()
-            })
-        )
-            # getting back to a dataframe
-            .reset_index()
-            # cleaning up the new index that appears
-            .drop(f"level_{len(groupby_cols)}", axis='columns')
-    )
+    group_ids = filled_df.groupby(groupby_cols, sort=False).ngroup()
+    group_count = group_ids.max() + 1 if group_ids.shape[0] else 0
+    logging.debug(f"group_count={group_count}")
+
+    # do a count of the different statuses - actually quite sneaky data manipulation
+    status_counts_df = get_group_value_counts(filled_df[HR_CATEGORIES], group_ids, group_count)
+    # making sure that any other statuses that we know about also get counted, even if they don't appear here
+    missing_statuses = [status for status in statuses if status not in status_counts_df.columns]
+    status_counts_df = status_counts_df.reindex(columns=[*status_counts_df.columns, *missing_statuses], fill_value=0)
+    flattened_org_unit_df = pandas.concat([
+        filled_df[groupby_cols].drop_duplicates().reset_index(drop=True),
+        pandas.DataFrame({
+            # select the most common value in the evaluation and location cols
+            HR_TRANSACTION_EVALUATION: get_group_modes(filled_df[HR_TRANSACTION_EVALUATION], group_ids, group_count),
+            HR_LOCATION: get_group_modes(filled_df[HR_LOCATION], group_ids, group_count),
+        }),
+        status_counts_df.reset_index(drop=True),
+    ], axis='columns')
     logging.debug(f"flattened_org_unit_df.head(5)=\n{flattened_org_unit_df.head(5)}")
     logging.debug(f"flattened_org_unit_df.shape=\n{flattened_org_unit_df.shape}")
 
     melted_df = flattened_org_unit_df.melt(
         id_vars=[*groupby_cols, HR_TRANSACTION_EVALUATION, HR_LOCATION],
         var_name=HR_CATEGORIES,
-        value_name="StatusCount"
+        value_name=HR_STATUS_COUNT
     )
-    melted_df.loc[:, "StatusCount"] = melted_df.loc[:, "StatusCount"].fillna(0)
     logging.debug(f"melted_df.head(5)=\n{melted_df.head(5)}")
     logging.debug(f"melted_df.columns=\n{melted_df.columns}")
 
@@ -171,44 +251,220 @@ def get_org_unit_df(combined_df):
     return melted_df
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+def get_incremental_state(state_prefix, minio_access, minio_secret):
+    state_filename = f"{state_prefix}.parquet"
+    state_files = set(minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                                         minio_prefix_override=state_filename))
+    if state_filename not in state_files:
+        logging.warning(f"No incremental state found at '{state_filename}'")
+        return None
 
-    # Loading secrets
-    SECRETS_PATH_VAR = "SECRETS_PATH"
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_state_file:
+        result = minio_utils.minio_to_file(temp_state_file.name,
+                                           BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                           minio_filename_override=state_filename)
+        assert result, f"Failed to fetch state file '{state_filename}'!"
+        state_df = pandas.read_parquet(temp_state_file.name)
 
-    if SECRETS_PATH_VAR not in os.environ:
-        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
-        sys.exit(-1)
+    return state_df
+
+
+def put_incremental_state(state_df, state_prefix, minio_access, minio_secret):
+    result = minio_utils.dataframe_to_minio(state_df, BUCKET, minio_access, minio_secret, CLASSIFICATION,
+                                            filename_prefix_override=state_prefix,
+                                            data_versioning=False,
+                                            file_format="parquet")
+    assert result, f"Failed to write org unit incremental state '{state_prefix}'!"
 
-    secrets_path = os.environ["SECRETS_PATH"]
-    secrets = json.load(open(secrets_path))
+
+def get_org_unit_hierarchy_hash(hr_org_df):
+    # Any change to the hierarchy can affect every org unit's values, so it means rebuilding everything
+    org_df = hr_org_df[[HR_ORG_UNIT, *HR_ORG_UNIT_COLUMNS]].sort_values(by=HR_ORG_UNIT, kind="stable")
+
+    return str(pandas.util.hash_pandas_object(org_df, index=False).sum())
+
+
+def get_staff_attributes_df(hr_master_df):
+    # The only parts of the master data that end up in the outputs are each staff member's org unit and location
+    return hr_master_df[[HR_STAFFNUMBER, *STAFF_ATTRIBUTE_COLUMNS]]
+
+
+def get_changed_staff(staff_state_df, staff_attributes_df):
+    # Staff that have been added, removed, or whose org unit or location is different to when the state was saved
+    compared_df = staff_attributes_df.merge(staff_state_df, on=HR_STAFFNUMBER,
+                                            how="outer", suffixes=("", "_state"), indicator=True)
+    changed = compared_df["_merge"] != "both"
+    for col in STAFF_ATTRIBUTE_COLUMNS:
+        current_values, state_values = compared_df[col], compared_df[f"{col}_state"]
+        changed |= (current_values != state_values) & ~(current_values.isna() & state_values.isna())
+
+    return compared_df.loc[changed, HR_STAFFNUMBER]
+
+
+def get_staff_dates_df(hr_df):
+    return pandas.DataFrame({
+        HR_STAFFNUMBER: hr_df[HR_STAFFNUMBER],
+        hr_data_munge.HR_HISTORY_PARTITION_COL: hr_data_munge.get_status_dates(hr_df),
+    }).drop_duplicates(ignore_index=True)
+
+
+def get_changed_dates(state_df, manifest_df, staff_dates_df=None, changed_staff=()):
+    # Status dates that are new, or whose contents have changed since the state was saved, as well as the dates that
+    # the staff whose master data has changed have statuses on
+    compared_df = manifest_df.merge(state_df[[hr_data_munge.HR_HISTORY_PARTITION_COL, hr_data_munge.HR_HISTORY_HASH_COL]],
+                                    on=hr_data_munge.HR_HISTORY_PARTITION_COL,
+                                    how="outer", suffixes=("", "_state"))
+    changed = compared_df[hr_data_munge.HR_HISTORY_HASH_COL] != compared_df[f"{hr_data_munge.HR_HISTORY_HASH_COL}_state"]
+    changed_dates = set(compared_df.loc[changed, hr_data_munge.HR_HISTORY_PARTITION_COL])
+
+    if staff_dates_df is not None:
+        changed_dates.update(
+            staff_dates_df.loc[staff_dates_df[HR_STAFFNUMBER].isin(changed_staff), hr_data_munge.HR_HISTORY_PARTITION_COL]
+        )
+
+    return sorted(changed_dates)
+
+
+def get_smoothing_affected_dates(changed_dates, previous_max_date, max_date):
+    # A changed status date affects the smoothed values for up to SMOOTHING_THRESHOLD business days afterwards, and if
+    # the max date moves, then every day since the previous max date is affected too
+    changed_dates = numpy.array(changed_dates, dtype="datetime64[D]")
+    previous_max_date = numpy.datetime64(previous_max_date, "D")
+    max_date = numpy.datetime64(max_date, "D")
+
+    business_day_calendar = get_holiday_calendar(changed_dates.min().astype(object), max_date.astype(object))
+    horizon_dates = numpy.busday_offset(changed_dates, SMOOTHING_THRESHOLD,
+                                        roll="backward", busdaycal=business_day_calendar)
+
+    one_day = numpy.timedelta64(1, "D")
+    affected_dates = numpy.unique(numpy.concatenate([
+        *(numpy.arange(changed_date, horizon_date + one_day)
+          for changed_date, horizon_date in zip(changed_dates, horizon_dates)),
+        numpy.arange(previous_max_date, max_date + one_day)
+    ]))
+
+    return [str(affected_date) for affected_date in affected_dates[affected_dates <= max_date]]
+
+
+def get_smoothing_start_date(affected_date):
+    # Earliest status date that could be smoothed forward onto the affected date
+    affected_date = numpy.datetime64(affected_date, "D")
+    business_day_calendar = get_holiday_calendar(affected_date.astype(object), affected_date.astype(object))
+
+    return str(numpy.busday_offset(affected_date, -SMOOTHING_THRESHOLD,
+                                   roll="backward", busdaycal=business_day_calendar))
+
+
+def update_stored_df(stored_df, updated_df, updated_dates):
+    # Replacing all of the stored values for the updated dates
+    kept_df = stored_df[~stored_df[HR_TRANSACTION_DATE].isin(updated_dates)]
+
+    # Statuses that have only just turned up get counted as zero for the rest of the dates, like a full rebuild does
+    new_statuses = sorted(set(updated_df[HR_CATEGORIES]) - set(stored_df[HR_CATEGORIES]))
+    if new_statuses:
+        logging.debug(f"new_statuses={new_statuses}")
+        group_cols = [col for col in kept_df.columns if col not in (HR_CATEGORIES, HR_STATUS_COUNT)]
+        kept_df = pandas.concat([
+            kept_df,
+            kept_df[group_cols].drop_duplicates().merge(
+                pandas.DataFrame({HR_CATEGORIES: new_statuses}), how="cross"
+            ).assign(**{HR_STATUS_COUNT: 0})
+        ])
+
+    return pandas.concat([
+        kept_df,
+        updated_df[updated_df[HR_TRANSACTION_DATE].isin(updated_dates)]
+    ])
+
+
+def sort_org_unit_df(org_unit_df):
+    # The incremental outputs mix what was read back in as strings with newly computed values
+    return org_unit_df.sort_values(by=HR_ORG_UNIT_SORT_COLUMNS, key=lambda col: col.astype(str),
+                                   kind="stable", ignore_index=True)
+
+
+def update_org_unit_outputs(minio_access, minio_secret, full_rebuild=False):
+    # Only recomputing the dates whose statuses (or smoothed statuses) could have changed since the last run, unless
+    # there is no incremental state, or the org unit hierarchy has changed
+    if full_rebuild:
+        logging.info(f"'{FULL_REBUILD_VAR}' is set, doing a full rebuild")
+        state_df = staff_state_df = staff_dates_df = None
+    else:
+        logging.info("Fetch[ing] incremental state")
+        state_df = get_incremental_state(HR_ORG_UNIT_STATE, minio_access, minio_secret)
+        staff_state_df = get_incremental_state(HR_ORG_UNIT_STAFF_STATE, minio_access, minio_secret)
+        staff_dates_df = get_incremental_state(HR_ORG_UNIT_STAFF_DATES_STATE, minio_access, minio_secret)
+        if staff_state_df is None or staff_dates_df is None:
+            state_df = None
+        logging.info("Fetch[ed] incremental state")
 
     logging.info("Fetch[ing] HR data")
-    hr_transactional_df = get_data_df(HR_TRANSACTIONAL_FILENAME_PATH,
-                                      secrets["minio"]["edge"]["access"],
-                                      secrets["minio"]["edge"]["secret"])
-    hr_master_df = get_data_df(HR_MASTER_FILENAME_PATH,
-                               secrets["minio"]["edge"]["access"],
-                               secrets["minio"]["edge"]["secret"])
-    hr_org_unit_master_df = get_data_df(HR_ORG_UNIT_MASTER_PATH,
-                                        secrets["minio"]["edge"]["access"],
-                                        secrets["minio"]["edge"]["secret"])
+    manifest_df = hr_data_munge.get_hr_history_manifest(minio_access, minio_secret)
+    hr_master_df = get_data_df(HR_MASTER_FILENAME_PATH, minio_access, minio_secret)
+    hr_org_unit_master_df = get_data_df(HR_ORG_UNIT_MASTER_PATH, minio_access, minio_secret)
+    org_unit_hierarchy_hash = get_org_unit_hierarchy_hash(hr_org_unit_master_df)
+    staff_attributes_df = get_staff_attributes_df(hr_master_df)
+
+    # A change to the org unit hierarchy can affect any of the dates
+    if state_df is not None and (ORG_UNIT_HIERARCHY_HASH_COL not in state_df.columns or
+                                 not state_df[ORG_UNIT_HIERARCHY_HASH_COL].eq(org_unit_hierarchy_hash).all()):
+        logging.info("The org unit hierarchy has changed, so doing a full rebuild")
+        state_df = None
+
+    if state_df is not None:
+        # Working out which dates' values could have changed since the last run, including the ones that the staff
+        # who have been hired, have left, or have moved org unit or location have statuses on
+        changed_staff = get_changed_staff(staff_state_df, staff_attributes_df)
+        logging.debug(f"changed_staff.shape={changed_staff.shape}")
+        changed_dates = get_changed_dates(state_df, manifest_df, staff_dates_df, changed_staff)
+        logging.debug(f"changed_dates={changed_dates}")
+        if not changed_dates:
+            if not changed_staff.empty:
+                put_incremental_state(staff_attributes_df, HR_ORG_UNIT_STAFF_STATE, minio_access, minio_secret)
+            logging.info("No people status dates have changed, so nothing to do!")
+            return
+
+        smoothed_dates = get_smoothing_affected_dates(changed_dates,
+                                                      state_df[hr_data_munge.HR_HISTORY_PARTITION_COL].max(),
+                                                      manifest_df[hr_data_munge.HR_HISTORY_PARTITION_COL].max())
+        history_start_date = get_smoothing_start_date(min(smoothed_dates))
+        logging.debug(f"smoothed_dates={smoothed_dates}, history_start_date={history_start_date}")
+    else:
+        history_start_date = None
+
+    hr_transactional_df = hr_data_munge.get_hr_history_df(minio_access, minio_secret, start_date=history_start_date)
+    # The history is stored as strings, whereas the master data's staff numbers are read in as ints
+    hr_transactional_df[HR_STAFFNUMBER] = hr_transactional_df[HR_STAFFNUMBER].astype("int64")
     logging.info("Fetch[ed] HR data")
 
+    if state_df is not None:
+        logging.info("Fetch[ing] stored Org data")
+        stored_org_unit_df = get_stored_df(f"{HR_ORG_UNIT_STATUSES}.csv", minio_access, minio_secret)
+        stored_smoothed_org_unit_df = get_stored_df(f"{HR_ORG_UNIT_SMOOTHED_STATUSES}.csv", minio_access, minio_secret)
+        known_statuses = stored_org_unit_df[HR_CATEGORIES].unique()
+        logging.info("Fetch[ed] stored Org data")
+    else:
+        known_statuses = ()
+
     logging.info("Merg[ing] Transactional and Master HR data, as well as Org Unit data")
     merged_df = merge_df(hr_transactional_df, hr_master_df, hr_org_unit_master_df)
     logging.info("Merg[ed] Transactional and Master HR data, as well as Org Unit data")
 
     logging.info("Assembl[ing] Org data df")
-    org_unit_df = get_org_unit_df(merged_df)
+    if state_df is not None:
+        changed_df = merged_df[pandas.to_datetime(merged_df[HR_TRANSACTION_DATE]).dt.strftime(DATE_COL_FORMAT).isin(
+            changed_dates
+        )].copy()
+        org_unit_df = update_stored_df(stored_org_unit_df,
+                                       get_org_unit_df(changed_df, known_statuses),
+                                       changed_dates)
+    else:
+        org_unit_df = get_org_unit_df(merged_df.copy())
+    org_unit_df = sort_org_unit_df(org_unit_df)
     logging.info("Assembl[ed] Org data df")
 
     logging.info("Writing cleaned Org DataFrame to Minio...")
-    minio_utils.dataframe_to_minio(org_unit_df, BUCKET,
-                                   secrets["minio"]["edge"]["access"],
-                                   secrets["minio"]["edge"]["secret"],
+    minio_utils.dataframe_to_minio(org_unit_df, BUCKET, minio_access, minio_secret,
                                    minio_utils.DataClassification.EDGE,
                                    filename_prefix_override=HR_ORG_UNIT_STATUSES,
                                    data_versioning=False,
@@ -219,16 +475,52 @@ if __name__ == "__main__":
     logging.info("Smooth[ed] Combined data")
 
     logging.info("Assembl[ing] Smoothed org data df")
-    smoothed_org_unit_df = get_org_unit_df(smoothed_hr_df)
+    if state_df is not None:
+        smoothed_org_unit_df = update_stored_df(stored_smoothed_org_unit_df,
+                                                get_org_unit_df(smoothed_hr_df, known_statuses),
+                                                smoothed_dates)
+    else:
+        smoothed_org_unit_df = get_org_unit_df(smoothed_hr_df)
+    smoothed_org_unit_df = sort_org_unit_df(smoothed_org_unit_df)
     logging.info("Assembl[ed] Smoothed org data df")
 
     logging.info("Writing smoothed Org DataFrame to Minio...")
-    minio_utils.dataframe_to_minio(smoothed_org_unit_df, BUCKET,
-                                   secrets["minio"]["edge"]["access"],
-                                   secrets["minio"]["edge"]["secret"],
+    minio_utils.dataframe_to_minio(smoothed_org_unit_df, BUCKET, minio_access, minio_secret,
                                    minio_utils.DataClassification.EDGE,
                                    filename_prefix_override=HR_ORG_UNIT_SMOOTHED_STATUSES,
                                    data_versioning=False,
                                    file_format="csv")
 
+    logging.info("Writ[ing] incremental state")
+    # The history was read from the history start date onwards, so the staff dates before then are still as they were
+    updated_staff_dates_df = get_staff_dates_df(hr_transactional_df)
+    if state_df is not None:
+        updated_staff_dates_df = pandas.concat([
+            staff_dates_df[staff_dates_df[hr_data_munge.HR_HISTORY_PARTITION_COL] < history_start_date],
+            updated_staff_dates_df
+        ], ignore_index=True)
+    put_incremental_state(updated_staff_dates_df, HR_ORG_UNIT_STAFF_DATES_STATE, minio_access, minio_secret)
+    put_incremental_state(staff_attributes_df, HR_ORG_UNIT_STAFF_STATE, minio_access, minio_secret)
+    put_incremental_state(manifest_df.assign(**{ORG_UNIT_HIERARCHY_HASH_COL: org_unit_hierarchy_hash}),
+                          HR_ORG_UNIT_STATE, minio_access, minio_secret)
+    logging.info("Writ[ed] incremental state")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+
+    # Loading secrets
+    SECRETS_PATH_VAR = "SECRETS_PATH"
+
+    if SECRETS_PATH_VAR not in os.environ:
+        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+        sys.exit(-1)
+
+    secrets_path = os.environ["SECRETS_PATH"]
+    secrets = json.load(open(secrets_path))
+
+    full_rebuild = os.environ.get(FULL_REBUILD_VAR, "").lower() in ("1", "true", "yes")
+    update_org_unit_outputs(secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"], full_rebuild)
+
     logging.info("...Done!")
@@ -1,3 +1,5 @@
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
@@ -17,6 +19,7 @@ SP_SITE = '/sites/HRCovidCapacity/'
 SP_EXCEL_LIST_NAME = 'EXCEL FORM DATA'
 DATA_SHEET_NAMES = ['owssvr', 'DATASHEET']
 SP_REGEX = r'^\d+;#(.+)$'
+SP_REGEX_PATTERN = re.compile(SP_REGEX)
 SOURCE_COL_NAME = "SourceUrl"
 ACCESS_COL_NAME = "AccessTimestamp"
 
@@ -46,8 +49,159 @@ BUCKET = 'covid'
 HR_BACKUP_PREFIX = "data/staging/hr_data_backup/"
 FILENAME_PATH = "data/private/hr_data_complete"
 
+# XML list backup - append only JSON Lines batches of the rows that have changed since the previous run, which are
+# periodically compacted into a single file of the latest version of every row
+HR_BACKUP_BATCH_PREFIX = f"{HR_BACKUP_PREFIX}batches/"
+HR_BACKUP_COMPACTED_PREFIX = f"{HR_BACKUP_PREFIX}compacted/"
+HR_BACKUP_INDEX = f"{HR_BACKUP_PREFIX}index"
+HR_BACKUP_INDEX_FILENAME = f"{HR_BACKUP_INDEX}.parquet"
+BACKUP_ID_COL_NAME = "BackupId"
+BACKUP_HASH_COL_NAME = "BackupHash"
+BACKUP_BATCH_TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S"
+BACKUP_COMPACTION_THRESHOLD = 30
+
+# Batch Excel files - only downloaded when their SharePoint version changes, with the parsed sheets cached by content
+HR_BATCH_MANIFEST = f"{HR_BACKUP_PREFIX}batch_file_manifest"
+HR_BATCH_MANIFEST_FILENAME = f"{HR_BATCH_MANIFEST}.parquet"
+HR_BATCH_PARSED_PREFIX = f"{HR_BACKUP_PREFIX}parsed/"
+BATCH_FILE_VERSION_FIELDS = ("Modified", "owshiddenversion")
+BATCH_VERSION_COL_NAME = "FileVersion"
+BATCH_HASH_COL_NAME = "ContentHash"
+BATCH_DOWNLOAD_WORKERS = 4
+
+
+def get_backup_index_df(minio_access, minio_secret):
+    index_files = set(minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret,
+                                                         minio_utils.DataClassification.EDGE,
+                                                         minio_prefix_override=HR_BACKUP_INDEX_FILENAME))
+    if HR_BACKUP_INDEX_FILENAME not in index_files:
+        logging.warning(f"No backup index found at '{HR_BACKUP_INDEX_FILENAME}'")
+        return pandas.DataFrame(columns=[BACKUP_ID_COL_NAME, BACKUP_HASH_COL_NAME])
+
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_index_file:
+        result = minio_utils.minio_to_file(temp_index_file.name,
+                                           BUCKET, minio_access, minio_secret, minio_utils.DataClassification.EDGE,
+                                           minio_filename_override=HR_BACKUP_INDEX_FILENAME)
+        assert result, f"Failed to fetch backup index '{HR_BACKUP_INDEX_FILENAME}'!"
+        index_df = pandas.read_parquet(temp_index_file.name)
+
+    return index_df
+
+
+def backup_xml_list_df(xml_df, access_timestamp, minio_access, minio_secret):
+    # Hashing the content of each row - the access timestamp changes every time, so it doesn't count
+    row_lines = xml_df.to_json(orient="records", lines=True, date_format="iso").splitlines()
+    content_lines = xml_df.drop(columns=[ACCESS_COL_NAME]).to_json(orient="records", lines=True,
+                                                                   date_format="iso").splitlines()
+    backup_df = pandas.DataFrame({
+        BACKUP_ID_COL_NAME: xml_df[XML_ID_COL_NAME].str.extract(SP_REGEX_PATTERN, expand=False).values,
+        BACKUP_HASH_COL_NAME: [hashlib.md5(line.encode()).hexdigest() for line in content_lines],
+    })
+
+    # Only backing up the rows which are new, or have changed since the last backup
+    index_df = get_backup_index_df(minio_access, minio_secret)
+    changed_rows = ~backup_df.merge(
+        index_df, on=[BACKUP_ID_COL_NAME, BACKUP_HASH_COL_NAME], how="left", indicator=True
+    )["_merge"].eq("both").values
+    logging.debug(f"{changed_rows.sum()}/{backup_df.shape[0]} XML entries have changed since the last backup")
+
+    if changed_rows.any():
+        batch_lines = [line for line, changed in zip(row_lines, changed_rows) if changed]
+        batch_content = ("\n".join(batch_lines) + "\n").encode()
+        batch_filename = (f"{access_timestamp.strftime(BACKUP_BATCH_TIMESTAMP_FORMAT)}_"
+                          f"{hashlib.md5(batch_content).hexdigest()}.jsonl")
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            local_path = os.path.join(tempdir, batch_filename)
+            with open(local_path, "wb") as batch_file:
+                batch_file.write(batch_content)
+
+            logging.debug(f"Backing up '{batch_filename}' to Minio...")
+            result = minio_utils.file_to_minio(
+                filename=local_path,
+                filename_prefix_override=HR_BACKUP_BATCH_PREFIX,
+                minio_bucket=BUCKET,
+                minio_key=minio_access,
+                minio_secret=minio_secret,
+                data_classification=minio_utils.DataClassification.EDGE,
+            )
+            assert result, f"Failed to backup '{batch_filename}'!"
 
-def get_xml_list_dfs(site, list_name):
+    # Updating the index with the latest hash for each row
+    index_df = pandas.concat([
+        index_df[~index_df[BACKUP_ID_COL_NAME].isin(backup_df[BACKUP_ID_COL_NAME])],
+        backup_df
+    ])
+    result = minio_utils.dataframe_to_minio(index_df, BUCKET, minio_access, minio_secret,
+                                            minio_utils.DataClassification.EDGE,
+                                            filename_prefix_override=HR_BACKUP_INDEX,
+                                            data_versioning=False,
+                                            file_format="parquet")
+    assert result, "Failed to write backup index!"
+
+    return changed_rows.sum()
+
+
+def compact_xml_list_backup(minio_access, minio_secret, compaction_threshold=BACKUP_COMPACTION_THRESHOLD):
+    # Each compacted file is named after the last batch that it includes
+    def _list_backup_files(prefix):
+        return sorted(
+            object_name
+            for object_name in minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret,
+                                                                  minio_utils.DataClassification.EDGE,
+                                                                  minio_prefix_override=prefix)
+            if object_name.endswith(".jsonl")
+        )
+
+    compacted_files = _list_backup_files(HR_BACKUP_COMPACTED_PREFIX)
+    latest_compacted_file = compacted_files[-1] if compacted_files else None
+    compacted_up_to = os.path.basename(latest_compacted_file) if latest_compacted_file else ""
+
+    pending_batches = [
+        batch_file for batch_file in _list_backup_files(HR_BACKUP_BATCH_PREFIX)
+        if os.path.basename(batch_file) > compacted_up_to
+    ]
+    if len(pending_batches) < compaction_threshold:
+        logging.debug(f"Only {len(pending_batches)} uncompacted batch(es), not compacting yet")
+        return None
+
+    # Merging the batches, in order, on top of the previous compacted file, keeping the latest version of each row
+    latest_rows = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        for backup_file in ([latest_compacted_file] if latest_compacted_file else []) + pending_batches:
+            local_path = os.path.join(tempdir, "backup.jsonl")
+            result = minio_utils.minio_to_file(local_path,
+                                               BUCKET, minio_access, minio_secret,
+                                               minio_utils.DataClassification.EDGE,
+                                               minio_filename_override=backup_file)
+            assert result, f"Failed to fetch '{backup_file}'!"
+
+            with open(local_path, "r") as batch_file:
+                for line in batch_file:
+                    if line.strip():
+                        unique_id = SP_REGEX_PATTERN.search(json.loads(line)[XML_ID_COL_NAME]).group(1)
+                        latest_rows[unique_id] = line
+
+        compacted_filename = os.path.basename(pending_batches[-1])
+        local_path = os.path.join(tempdir, compacted_filename)
+        with open(local_path, "w") as compacted_file:
+            compacted_file.writelines(latest_rows.values())
+
+        logging.debug(f"Compacting {len(pending_batches)} batch(es) into '{compacted_filename}'")
+        result = minio_utils.file_to_minio(
+            filename=local_path,
+            filename_prefix_override=HR_BACKUP_COMPACTED_PREFIX,
+            minio_bucket=BUCKET,
+            minio_key=minio_access,
+            minio_secret=minio_secret,
+            data_classification=minio_utils.DataClassification.EDGE,
+        )
+        assert result, f"Failed to backup '{compacted_filename}'!"
+
+    return compacted_filename
+
+
+def get_xml_list_dfs(site, list_name, minio_access, minio_secret):
     access_timestamp = pandas.Timestamp.now(tz="Africa/Johannesburg")
     xml_list = site.List(list_name).GetListItems()
     xml_df = pandas.DataFrame(xml_list)
@@ -58,103 +212,204 @@ def get_xml_list_dfs(site, list_name):
     else:
         logging.debug(f"Got {xml_df.shape[0]} XML entries")
 
-    url_pattern = re.compile(SP_REGEX)
     logging.debug(f"Setting '{SOURCE_COL_NAME}'='URL Path', '{ACCESS_COL_NAME}'={access_timestamp}")
 
     xml_df[SOURCE_COL_NAME] = xml_df[XML_URL_COL_NAME].str.extract(
-        url_pattern, expand=False
+        SP_REGEX_PATTERN, expand=False
     ).apply(
         lambda file_uri: urllib.parse.urljoin(SP_DOMAIN, file_uri)
     )
     xml_df[ACCESS_COL_NAME] = access_timestamp
 
-    # Backing up the XML rows into Minio
-    with tempfile.TemporaryDirectory() as tempdir:
-        for row in xml_df.itertuples(index=False):
-            row_series = pandas.DataFrame({
-                col: [val]
-                for col, val in zip(xml_df.columns, row)
-            }).iloc[0]
-
-            id_search = url_pattern.search(row_series['Unique Id'])
-            unique_id = id_search.group(1)
-            logging.debug(f"Backing up '{unique_id}.json' to Minio...")
-            local_path = os.path.join(tempdir, unique_id)
-            with open(local_path, "w") as json_file:
-                row_series.to_json(json_file)
-
-            minio_utils.file_to_minio(
-                filename=local_path,
-                filename_prefix_override=HR_BACKUP_PREFIX,
-                minio_bucket=BUCKET,
-                minio_key=secrets["minio"]["edge"]["access"],
-                minio_secret=secrets["minio"]["edge"]["secret"],
-                data_classification=minio_utils.DataClassification.EDGE,
-            )
+    # Backing up the changed XML rows into Minio, as a single batch
+    changed_count = backup_xml_list_df(xml_df, access_timestamp, minio_access, minio_secret)
+    logging.debug(f"Backed up {changed_count} changed XML entries")
+
     # Making the XML file more like the others
     xml_df[XML_DATE_COL_NAME] = xml_df[XML_DATE_COL_NAME].dt.strftime(ISO8601_FORMAT)
 
     return xml_df[XML_FIELD_NAMES]
 
 
-def get_excel_list_dfs(site_list, auth, proxy_dict, minio_access, minio_secret):
-    url_pattern = re.compile(SP_REGEX)
-    http_session = requests.Session()
-    http_session.proxies = proxy_dict
-    http_session.auth = auth
+def get_batch_manifest_df(minio_access, minio_secret):
+    manifest_files = set(minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret,
+                                                            minio_utils.DataClassification.EDGE,
+                                                            minio_prefix_override=HR_BATCH_MANIFEST_FILENAME))
+    if HR_BATCH_MANIFEST_FILENAME not in manifest_files:
+        logging.warning(f"No batch file manifest found at '{HR_BATCH_MANIFEST_FILENAME}'")
+        return pandas.DataFrame(columns=[SOURCE_COL_NAME, BATCH_VERSION_COL_NAME, BATCH_HASH_COL_NAME,
+                                         ACCESS_COL_NAME])
+
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_manifest_file:
+        result = minio_utils.minio_to_file(temp_manifest_file.name,
+                                           BUCKET, minio_access, minio_secret, minio_utils.DataClassification.EDGE,
+                                           minio_filename_override=HR_BATCH_MANIFEST_FILENAME)
+        assert result, f"Failed to fetch batch file manifest '{HR_BATCH_MANIFEST_FILENAME}'!"
+        manifest_df = pandas.read_parquet(temp_manifest_file.name)
+
+    return manifest_df
+
+
+def _stringify_sheet_df(sheet_df):
+    # Parquet needs consistent types, so everything bar the nulls becomes a string, which is what ends up in the CSV
+    sheet_df = sheet_df.rename(columns=str).astype(object)
 
+    return sheet_df.where(sheet_df.isna(), sheet_df.astype(str))
+
+
+def get_cached_sheet_dfs(content_hash, minio_access, minio_secret):
+    cache_prefix = f"{HR_BATCH_PARSED_PREFIX}{content_hash}/"
+    cached_files = sorted(minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret,
+                                                             minio_utils.DataClassification.EDGE,
+                                                             minio_prefix_override=cache_prefix))
+
+    sheet_dfs = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        for cached_file in cached_files:
+            local_path = os.path.join(tempdir, os.path.basename(cached_file))
+            result = minio_utils.minio_to_file(local_path,
+                                               BUCKET, minio_access, minio_secret,
+                                               minio_utils.DataClassification.EDGE,
+                                               minio_filename_override=cached_file)
+            assert result, f"Failed to fetch cached sheet '{cached_file}'!"
+            sheet_dfs += [pandas.read_parquet(local_path)]
+
+    return sheet_dfs
+
+
+def put_cached_sheet_dfs(content_hash, sheet_dfs, minio_access, minio_secret):
     with tempfile.TemporaryDirectory() as tempdir:
-        for file_dict in site_list:
-            file_regex_result = url_pattern.search(file_dict["URL Path"])
-            file_uri = file_regex_result.group(1)
-            file_url = urllib.parse.urljoin(SP_DOMAIN, file_uri)
-            logging.debug(f"Fetching '{file_url}'...")
-
-            resp = http_session.get(file_url)
-            assert resp.status_code == 200
-            access_timestamp = pandas.Timestamp.now(tz="Africa/Johannesburg")
-
-            local_filename = file_uri.replace("/", "_")
-            local_path = os.path.join(tempdir, local_filename)
-            with open(local_path, "wb") as name_temp_file:
-                name_temp_file.write(resp.content)
-
-            logging.debug("Backing up HR data file to Minio")
-            minio_utils.file_to_minio(
+        for i, sheet_df in enumerate(sheet_dfs):
+            local_path = os.path.join(tempdir, f"{i:03d}.parquet")
+            sheet_df.to_parquet(local_path, index=False)
+
+            result = minio_utils.file_to_minio(
                 filename=local_path,
-                filename_prefix_override=HR_BACKUP_PREFIX,
+                filename_prefix_override=f"{HR_BATCH_PARSED_PREFIX}{content_hash}/",
                 minio_bucket=BUCKET,
                 minio_key=minio_access,
                 minio_secret=minio_secret,
                 data_classification=minio_utils.DataClassification.EDGE,
             )
+            assert result, f"Failed to cache sheet {i} of '{content_hash}'!"
+
+
+def _download_file(http_session, file_url, local_path):
+    logging.debug(f"Fetching '{file_url}'...")
+    resp = http_session.get(file_url)
+    assert resp.status_code == 200, f"Got {resp.status_code} for '{file_url}'!"
+    access_timestamp = pandas.Timestamp.now(tz="Africa/Johannesburg")
+
+    with open(local_path, "wb") as name_temp_file:
+        name_temp_file.write(resp.content)
+
+    return access_timestamp, hashlib.md5(resp.content).hexdigest()
 
+
+def get_excel_list_dfs(site_list, auth, proxy_dict, minio_access, minio_secret,
+                       sp_domain=SP_DOMAIN, download_workers=BATCH_DOWNLOAD_WORKERS):
+    url_pattern = re.compile(SP_REGEX)
+    http_session = requests.Session()
+    http_session.proxies = proxy_dict
+    http_session.auth = auth
+    # Enough pooled connections for all of the download threads, so that they can reuse their NTLM authenticated ones
+    http_adapter = requests.adapters.HTTPAdapter(pool_connections=download_workers, pool_maxsize=download_workers)
+    http_session.mount("http://", http_adapter)
+    http_session.mount("https://", http_adapter)
+
+    # Working out which files have changed since we last saw them
+    manifest_df = get_batch_manifest_df(minio_access, minio_secret).set_index(SOURCE_COL_NAME)
+    file_entries = []
+    for file_dict in site_list:
+        file_uri = url_pattern.search(file_dict["URL Path"]).group(1)
+        file_url = urllib.parse.urljoin(sp_domain, file_uri)
+        # Without both of the version fields there's no telling whether the file has changed, so it is fetched again
+        version_values = [file_dict.get(field) for field in BATCH_FILE_VERSION_FIELDS]
+        file_version = (None if any(pandas.isna(value) or value == "" for value in version_values)
+                        else "|".join(map(str, version_values)))
+        is_unchanged = (file_version is not None and
+                        file_url in manifest_df.index and
+                        manifest_df.loc[file_url, BATCH_VERSION_COL_NAME] == file_version)
+        file_entries += [(file_uri, file_url, file_version, is_unchanged)]
+
+    logging.debug(f"{sum(not is_unchanged for *_, is_unchanged in file_entries)}/{len(file_entries)} file(s) changed")
+
+    with tempfile.TemporaryDirectory() as tempdir, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as download_executor:
+        # Downloading the changed files concurrently
+        downloads = {
+            file_url: download_executor.submit(_download_file,
+                                               http_session, file_url,
+                                               os.path.join(tempdir, file_uri.replace("/", "_")))
+            for file_uri, file_url, _, is_unchanged in file_entries
+            if not is_unchanged
+        }
+
+        # ...while working through the files in list order
+        for file_uri, file_url, file_version, is_unchanged in file_entries:
+            local_path = os.path.join(tempdir, file_uri.replace("/", "_"))
             is_excel_file = any(map(
                 lambda ext: local_path.endswith(ext),
                 ("xlsx", "xls", "XLSX", "XLS")
             ))
-            if is_excel_file:
-                logging.debug(f"Generating df from downloaded file")
-                for data_sheet_name, raw_df in pandas.read_excel(local_path,
-                                                                 sheet_name=None, dtype="object",
-                                                                 engine='openpyxl').items():
-                    logging.debug(f"Reading sheet'{data_sheet_name}'")
-
-                    logging.debug(f"Setting '{SOURCE_COL_NAME}'='{file_url}', '{ACCESS_COL_NAME}'={access_timestamp}")
-                    raw_df[SOURCE_COL_NAME] = file_url
-                    raw_df[ACCESS_COL_NAME] = access_timestamp
 
-                    logging.debug(f"raw_df.head(10)=\n{raw_df.head(10)}")
-
-                    yield raw_df
+            if is_unchanged:
+                logging.debug(f"'{file_url}' is unchanged, using cached sheets")
+                access_timestamp = pandas.Timestamp(manifest_df.loc[file_url, ACCESS_COL_NAME])
+                content_hash = manifest_df.loc[file_url, BATCH_HASH_COL_NAME]
+                sheet_dfs = get_cached_sheet_dfs(content_hash, minio_access, minio_secret) if is_excel_file else []
             else:
+                access_timestamp, content_hash = downloads[file_url].result()
+
+                logging.debug("Backing up HR data file to Minio")
+                minio_utils.file_to_minio(
+                    filename=local_path,
+                    filename_prefix_override=HR_BACKUP_PREFIX,
+                    minio_bucket=BUCKET,
+                    minio_key=minio_access,
+                    minio_secret=minio_secret,
+                    data_classification=minio_utils.DataClassification.EDGE,
+                )
+
+                sheet_dfs = []
+                if is_excel_file:
+                    logging.debug(f"Generating df from downloaded file")
+                    sheet_dfs = [
+                        _stringify_sheet_df(raw_df)
+                        for raw_df in pandas.read_excel(local_path,
+                                                        sheet_name=None, dtype="object",
+                                                        engine='openpyxl').values()
+                    ]
+                    put_cached_sheet_dfs(content_hash, sheet_dfs, minio_access, minio_secret)
+
+                manifest_df.loc[file_url] = {BATCH_VERSION_COL_NAME: file_version,
+                                             BATCH_HASH_COL_NAME: content_hash,
+                                             ACCESS_COL_NAME: access_timestamp.isoformat()}
+
+            if not is_excel_file:
                 logging.debug("Not an Excel file, continuing..")
                 continue
 
+            for raw_df in sheet_dfs:
+                logging.debug(f"Setting '{SOURCE_COL_NAME}'='{file_url}', '{ACCESS_COL_NAME}'={access_timestamp}")
+                raw_df[SOURCE_COL_NAME] = file_url
+                raw_df[ACCESS_COL_NAME] = access_timestamp
+
+                logging.debug(f"raw_df.head(10)=\n{raw_df.head(10)}")
+
+                yield raw_df
+
+    result = minio_utils.dataframe_to_minio(manifest_df.reset_index(), BUCKET, minio_access, minio_secret,
+                                            minio_utils.DataClassification.EDGE,
+                                            filename_prefix_override=HR_BATCH_MANIFEST,
+                                            data_versioning=False,
+                                            file_format="parquet")
+    assert result, "Failed to write batch file manifest!"
+
 
 def get_combined_list_df(site, auth, proxy_dict, minio_access, minio_secret):
     # Get XML files
-    xml_list_df = get_xml_list_dfs(site, SP_XML_LIST_NAME)
+    xml_list_df = get_xml_list_dfs(site, SP_XML_LIST_NAME, minio_access, minio_secret)
 
     # setup file generator
     # Extract files
@@ -208,6 +463,10 @@ if __name__ == "__main__":
     combined_df = get_combined_list_df(sp_site, sp_auth, city_proxy_dict,
                                        secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"])
 
+    logging.info("Compact[ing] XML list backup...")
+    compact_xml_list_backup(secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"])
+    logging.info("Compact[ed] XML list backup")
+
     logging.info("Writing to Minio...")
     minio_utils.dataframe_to_minio(combined_df, BUCKET,
                                    secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"],
@@ -16,6 +16,7 @@ HR_MASTER_LOCATION_FILENAME_PATH = "data/private/city_people_locations.csv"
 
 HR_MASTER_STAFFNUMBER = 'Persno'
 HR_EXPECTED_STAFFNUMBER = 'StaffNumber'
+STAFF_KEY = 'StaffKey'
 
 ASSESSED_COL = "AssessedStaff"
 HR_MASTER_FILENAME_PATH = "data/private/city_people"
@@ -48,6 +49,26 @@ def get_data_df(filename, minio_access, minio_secret):
     return data_df
 
 
+def get_staff_keys(staff_numbers):
+    """
+    Integer surrogate keys for staff numbers, however they have been typed, so that HR and vaccine data can be joined on
+    them directly. Missing and non-numeric staff numbers get a missing key.
+    """
+    numeric_staff_numbers = pandas.to_numeric(staff_numbers, errors="coerce")
+    whole_staff_numbers = numeric_staff_numbers.where(numeric_staff_numbers % 1 == 0)
+
+    return whole_staff_numbers.astype("Int64")
+
+
+def add_staff_key(df, staff_number_col):
+    """
+    Adds the staff key column to df, reusing the one that it already carries if there is one
+    """
+    df[STAFF_KEY] = df[STAFF_KEY].astype("Int64") if STAFF_KEY in df.columns else get_staff_keys(df[staff_number_col])
+
+    return df
+
+
 def merge_in_location_data(master_df, location_df):
     logging.debug(f"master_df.shape={master_df.shape}")
     employee_master_with_loc_df = master_df.merge(
@@ -78,6 +99,12 @@ def validate_hr_data(master_df):
         f"master_df[HR_MASTER_STAFFNUMBER].nunique()={master_df[HR_EXPECTED_STAFFNUMBER].nunique()}"
     )
 
+    # Staff numbers that aren't whole numbers are kept, with a missing key, so they just drop out of the joins on it
+    missing_key_df = master_df[master_df[STAFF_KEY].isna()]
+    if not missing_key_df.empty:
+        logging.warning(f"{missing_key_df.shape[0]} staff number(s) without a valid '{STAFF_KEY}'")
+        logging.debug(f"missing_key_df[HR_EXPECTED_STAFFNUMBER]=\n{missing_key_df[HR_EXPECTED_STAFFNUMBER]}")
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG,
@@ -119,6 +146,10 @@ if __name__ == "__main__":
     hr_master_df = merge_in_location_data(hr_master_df, hr_master_location_df)
     logging.info("Merg[ed] in HR Master data")
 
+    logging.info("Add[ing] staff keys")
+    hr_master_df = add_staff_key(hr_master_df, HR_MASTER_STAFFNUMBER)
+    logging.info("Add[ed] staff keys")
+
     logging.info("Validat[ing] HR master data")
     validate_hr_data(hr_master_df)
     logging.info("Validat[ed] HR master data")
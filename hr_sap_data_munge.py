@@ -11,7 +11,6 @@ import hr_sap_data_to_minio
 
 BUCKET = 'covid'
 CLASSIFICATION = minio_utils.DataClassification.EDGE
-CLEANED_HR_TRANSACTIONAL = "data/private/business_continuity_people_status"
 
 HR_MASTER_APPROVER_COLUMN = "Approver Name"
 HR_MASTER_APPROVER_STAFFNUMBER_COLUMN = "Approver Staff No"
@@ -118,11 +117,9 @@ if __name__ == "__main__":
     hr_master_df = hr_data_munge.get_data_df(hr_data_munge.HR_MASTER_FILENAME_PATH,
                                              secrets["minio"]["edge"]["access"],
                                              secrets["minio"]["edge"]["secret"])
-    hr_transactional_df = hr_data_munge.get_data_df(hr_data_munge.CLEANED_HR_TRANSACTIONAL_FILENAME,
-                                                    secrets["minio"]["edge"]["access"],
-                                                    secrets["minio"]["edge"]["secret"])
     logging.info("Fetch[ed] HR data")
 
+    changed_hr_df = pandas.DataFrame(columns=hr_data_munge.HR_HISTORY_COLUMNS)
     for sap_file_suffix, sap_file_columns_remap in SAP_FILES_COLUMN_MAP.items():
         sap_filename = f"{hr_sap_data_to_minio.SAP_RAW_FILENAME_PREFIX}{sap_file_suffix}.csv"
         logging.info(f"Fetch[ing] SAP HR data '{sap_filename}'")
@@ -153,17 +150,20 @@ if __name__ == "__main__":
         cleaned_df = hr_data_munge.clean_hr_form(filled_df, hr_master_df)
         logging.info(f"Clean[ed] SAP HR data '{sap_filename}'")
 
-        logging.info(f"Dedup[ing] SAP HR data '{sap_filename}'")
-        hr_transactional_df = hr_data_munge.update_hr_dataset(cleaned_df, hr_transactional_df)
-        logging.info(f"Dedup[ed] SAP HR data '{sap_filename}'")
-
-    # Writing result out
-    logging.info("Writing cleaned SAP HR DataFrame back to Minio...")
-    minio_utils.dataframe_to_minio(hr_transactional_df, BUCKET,
-                                   secrets["minio"]["edge"]["access"],
-                                   secrets["minio"]["edge"]["secret"],
-                                   minio_utils.DataClassification.EDGE,
-                                   filename_prefix_override=CLEANED_HR_TRANSACTIONAL,
-                                   data_versioning=False,
-                                   file_format="csv")
+        logging.info(f"Upsert[ing] SAP HR data '{sap_filename}' into the people status history")
+        # Later files' changes to a partition include the earlier ones, so they replace them
+        changed_hr_df = hr_data_munge.replace_history_partitions(
+            changed_hr_df,
+            hr_data_munge.upsert_hr_history(cleaned_df,
+                                            secrets["minio"]["edge"]["access"],
+                                            secrets["minio"]["edge"]["secret"])
+        )
+        logging.info(f"Upsert[ed] SAP HR data '{sap_filename}' into the people status history")
+
+    logging.info(f"Writ[ing] the people status history to '{hr_data_munge.CLEANED_HR_TRANSACTIONAL_FILENAME}'")
+    hr_data_munge.put_hr_transactional_csv(changed_hr_df,
+                                           secrets["minio"]["edge"]["access"],
+                                           secrets["minio"]["edge"]["secret"])
+    logging.info(f"Wr[ote] the people status history to '{hr_data_munge.CLEANED_HR_TRANSACTIONAL_FILENAME}'")
+
     logging.info("...Done!")
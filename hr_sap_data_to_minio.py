@@ -2,10 +2,14 @@ import hashlib
 import json
 import logging
 import os
+import re
 import sys
+import tempfile
 import zipfile
 
 from db_utils import minio_utils
+from lxml import etree
+import numpy
 import pandas
 
 import exchange_utils
@@ -31,6 +35,106 @@ DATA_FILE_LOOKUPS = {
 BUCKET = 'covid'
 SAP_HR_BACKUP_PREFIX = "data/staging/hr_sap_data_backup/"
 SAP_RAW_FILENAME_PREFIX = "data/private/hr_sap_data_"
+HTML_WHITESPACE_REGEX = re.compile(r"[\r\n]+|\s{2,}")
+HTML_SPANS_XPATH = etree.XPath("boolean((td|th)[@colspan or @rowspan])")
+
+# Parsed attachment cache - the manifest maps each attachment's checksum to its data file prefix (null if it isn't a
+# data file we know about) and its table's header, with the table's values cached as Parquet
+SAP_HR_PARSED_PREFIX = "data/staging/hr_sap_data_parsed/"
+SAP_HR_PARSED_MANIFEST = "data/staging/hr_sap_data_parsed_manifest"
+SAP_HR_PARSED_MANIFEST_FILENAME = f"{SAP_HR_PARSED_MANIFEST}.parquet"
+CHECKSUM_COL = "checksum"
+DATA_FILE_PREFIX_COL = "data_file_prefix"
+HEADER_COL = "header"
+
+
+def _get_cell_text(cell):
+    text = cell.text if not len(cell) else "".join(cell.itertext())
+    return HTML_WHITESPACE_REGEX.sub(" ", text.strip()) if text else ""
+
+
+def _expand_spans(rows, row_spans):
+    # Copying cells' text across their colspans, and down their rowspans, in the same way that pandas.read_html does
+    expanded_rows = []
+    rowspan_remainders = {}
+    for row, spans in zip(rows, row_spans):
+        if spans is None and not rowspan_remainders:
+            expanded_rows += [row]
+            continue
+
+        expanded_row = []
+        col = 0
+        for text, (colspan, rowspan) in zip(row, spans or [(1, 1)] * len(row)):
+            while col in rowspan_remainders:
+                remainder_text, remainder_count = rowspan_remainders.pop(col)
+                expanded_row += [remainder_text]
+                if remainder_count > 1:
+                    rowspan_remainders[col] = (remainder_text, remainder_count - 1)
+                col += 1
+
+            for _ in range(colspan):
+                expanded_row += [text]
+                if rowspan > 1:
+                    rowspan_remainders[col] = (text, rowspan - 1)
+                col += 1
+
+        for remainder_col in sorted(rowspan_remainders):
+            if remainder_col >= col:
+                remainder_text, remainder_count = rowspan_remainders.pop(remainder_col)
+                expanded_row += [remainder_text]
+                if remainder_count > 1:
+                    rowspan_remainders[remainder_col] = (remainder_text, remainder_count - 1)
+
+        expanded_rows += [expanded_row]
+
+    return expanded_rows
+
+
+def read_html_table(html_file, table_id):
+    """Streams through the HTML file, only pulling out the rows of the table with the given id"""
+    header_rows, body_rows, footer_rows = [], [], []
+    in_table = False
+    for event, element in etree.iterparse(html_file, events=("start", "end"), tag=("table", "tr"), html=True):
+        if event == "start":
+            in_table = in_table or (element.tag == "table" and element.get("id") == table_id)
+            continue
+
+        if in_table and element.tag == "tr":
+            cells = [cell for cell in element if cell.tag in ("td", "th")]
+            row = [_get_cell_text(cell) for cell in cells]
+            # Only keeping track of the spans if there are any
+            spans = None
+            if HTML_SPANS_XPATH(element):
+                spans = [(int(cell.get("colspan") or 1), int(cell.get("rowspan") or 1)) for cell in cells]
+
+            section = element.getparent().tag
+            if section == "thead":
+                header_rows += [(row, spans)]
+            elif section == "tfoot":
+                footer_rows += [(row, spans)]
+            elif not body_rows and cells and all(cell.tag == "th" for cell in cells):
+                # Leading rows of only <th> cells count as the header
+                header_rows += [(row, spans)]
+            else:
+                body_rows += [(row, spans)]
+
+        elif in_table and element.get("id") == table_id:
+            break
+
+        # Freeing up everything that we're done with
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    if not in_table:
+        raise ValueError(f"No table with id '{table_id}' found")
+
+    all_rows = header_rows + body_rows + footer_rows
+    rows = _expand_spans(*zip(*all_rows))[len(header_rows):] if all_rows else []
+    width = max(map(len, rows), default=0)
+    table_df = pandas.DataFrame([row + [""] * (width - len(row)) for row in rows], dtype=object)
+
+    return table_df.where(table_df != "", numpy.nan)
 
 
 def light_clean(data_df):
@@ -71,7 +175,7 @@ def get_attachment_file_df(data_file):
         with zip_data_file.open(data_file_path) as html_data_file:
             try:
                 zip_data_df = light_clean(
-                    pandas.read_html(html_data_file, attrs={"id": data_div_id})[0]
+                    read_html_table(html_data_file, data_div_id)
                 )
                 logging.debug(f"zip_data_df.shape={zip_data_df.shape}")
             except Exception as e:
@@ -81,40 +185,127 @@ def get_attachment_file_df(data_file):
     return data_file_prefix, zip_data_df
 
 
-def generate_raw_doc_dfs(items) -> dict:
+def get_parsed_manifest_df(minio_access, minio_secret):
+    manifest_files = set(minio_utils.list_objects_in_bucket(BUCKET, minio_access, minio_secret,
+                                                            minio_utils.DataClassification.EDGE,
+                                                            minio_prefix_override=SAP_HR_PARSED_MANIFEST_FILENAME))
+    if SAP_HR_PARSED_MANIFEST_FILENAME not in manifest_files:
+        logging.warning(f"No parsed attachment manifest found at '{SAP_HR_PARSED_MANIFEST_FILENAME}'")
+        return pandas.DataFrame(columns=[CHECKSUM_COL, DATA_FILE_PREFIX_COL, HEADER_COL])
+
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_manifest_file:
+        result = minio_utils.minio_to_file(temp_manifest_file.name,
+                                           BUCKET, minio_access, minio_secret, minio_utils.DataClassification.EDGE,
+                                           minio_filename_override=SAP_HR_PARSED_MANIFEST_FILENAME)
+        assert result, f"Failed to fetch parsed attachment manifest '{SAP_HR_PARSED_MANIFEST_FILENAME}'!"
+        manifest_df = pandas.read_parquet(temp_manifest_file.name)
+
+    return manifest_df
+
+
+def put_cached_attachment_df(file_checksum, data_df, minio_access, minio_secret):
+    # Parquet wants string column names and consistent types, so the (often blank) header is kept separately, and the
+    # values are stored as the strings that they would be written out as
+    header = json.dumps([None if pandas.isna(col) else str(col) for col in data_df.columns])
+    cache_df = data_df.set_axis([str(i) for i in range(data_df.shape[1])], axis='columns').astype(object)
+    cache_df = cache_df.where(cache_df.isna(), cache_df.astype(str))
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        local_path = os.path.join(tempdir, f"{file_checksum}.parquet")
+        cache_df.to_parquet(local_path, index=False)
+
+        result = minio_utils.file_to_minio(
+            filename=local_path,
+            filename_prefix_override=SAP_HR_PARSED_PREFIX,
+            minio_bucket=BUCKET,
+            minio_key=minio_access,
+            minio_secret=minio_secret,
+            data_classification=minio_utils.DataClassification.EDGE,
+        )
+        assert result, f"Failed to cache parsed attachment '{file_checksum}'!"
+
+    return header
+
+
+def get_cached_attachment_df(file_checksum, header, minio_access, minio_secret):
+    cached_filename = f"{SAP_HR_PARSED_PREFIX}{file_checksum}.parquet"
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_cache_file:
+        result = minio_utils.minio_to_file(temp_cache_file.name,
+                                           BUCKET, minio_access, minio_secret, minio_utils.DataClassification.EDGE,
+                                           minio_filename_override=cached_filename)
+        assert result, f"Failed to fetch parsed attachment '{cached_filename}'!"
+        data_df = pandas.read_parquet(temp_cache_file.name)
+
+    data_df.columns = [numpy.nan if col is None else col for col in json.loads(header)]
+
+    return data_df
+
+
+def generate_raw_doc_dfs(items, minio_access, minio_secret) -> dict:
     """Generates a dictionary of different file types -> dataframes of data"""
     email_data_dfs = {}
+    manifest_df = get_parsed_manifest_df(minio_access, minio_secret).set_index(CHECKSUM_COL)
 
     most_recent_file_numbers = FILES_PER_DAY * DAYS_LOOKBACK
     logging.debug(f"Looking back at {most_recent_file_numbers} files")
     for data_file in exchange_utils.get_attachment_files(items, most_recent_count=most_recent_file_numbers):
-        # backing up data file
         # Calculating checksum
         with open(data_file, "rb") as raw_data_file:
             file_data = raw_data_file.read()
         file_checksum = hashlib.md5(file_data).hexdigest()
         logging.debug(f"file_checksum={file_checksum}")
 
+        # If we've seen this file before, then it has already been backed up and parsed
+        if file_checksum in manifest_df.index:
+            data_file_prefix = manifest_df.loc[file_checksum, DATA_FILE_PREFIX_COL]
+            if pandas.isna(data_file_prefix):
+                logging.debug(f"Already know that there is no data in {data_file}, moving on...")
+                continue
+
+            logging.debug(f"Using cached '{data_file_prefix}' data for {data_file}")
+            data_df = get_cached_attachment_df(file_checksum, manifest_df.loc[file_checksum, HEADER_COL],
+                                               minio_access, minio_secret)
+            dfs = email_data_dfs.get(data_file_prefix, [])
+            email_data_dfs[data_file_prefix] = dfs + [data_df]
+            continue
+
+        # backing up data file
         minio_utils.file_to_minio(
             filename=data_file,
             filename_prefix_override=SAP_HR_BACKUP_PREFIX + file_checksum + "_",
             minio_bucket=BUCKET,
-            minio_key=secrets["minio"]["edge"]["access"],
-            minio_secret=secrets["minio"]["edge"]["secret"],
+            minio_key=minio_access,
+            minio_secret=minio_secret,
             data_classification=minio_utils.DataClassification.EDGE,
         )
 
         # if is a zip file, might be a file we're interested in
-        if zipfile.is_zipfile(data_file):
-            data_file_prefix, data_df = get_attachment_file_df(data_file)
+        data_file_prefix, data_df = (
+            get_attachment_file_df(data_file) if zipfile.is_zipfile(data_file) else (None, None)
+        )
 
-            # If this is a datafile we don't know how to handle, we skip
-            if data_file_prefix is None:
-                logging.warning(f"No data extracted from {data_file}! Moving on...")
-                continue
+        # Remembering what we got out of the file, unless the parse failed, in which case we try again next time
+        if data_file_prefix is None or data_df is not None:
+            manifest_df.loc[file_checksum] = {
+                DATA_FILE_PREFIX_COL: data_file_prefix,
+                HEADER_COL: (put_cached_attachment_df(file_checksum, data_df, minio_access, minio_secret)
+                             if data_df is not None else None)
+            }
 
-            dfs = email_data_dfs.get(data_file_prefix, [])
-            email_data_dfs[data_file_prefix] = dfs + [data_df]
+        # If this is a datafile we don't know how to handle, we skip
+        if data_file_prefix is None:
+            logging.warning(f"No data extracted from {data_file}! Moving on...")
+            continue
+
+        dfs = email_data_dfs.get(data_file_prefix, [])
+        email_data_dfs[data_file_prefix] = dfs + [data_df]
+
+    result = minio_utils.dataframe_to_minio(manifest_df.reset_index(), BUCKET, minio_access, minio_secret,
+                                            minio_utils.DataClassification.EDGE,
+                                            filename_prefix_override=SAP_HR_PARSED_MANIFEST,
+                                            data_versioning=False,
+                                            file_format="parquet")
+    assert result, "Failed to write parsed attachment manifest!"
 
     data_dfs = {
         data_file_prefix: pandas.concat([
@@ -151,7 +342,8 @@ if __name__ == "__main__":
     account_filtered_items = exchange_utils.filter_account(exchange_account, sender_filter=SENDER_FILTER)
 
     logging.info("Getting raw dfs...")
-    raw_doc_dfs = generate_raw_doc_dfs(account_filtered_items)
+    raw_doc_dfs = generate_raw_doc_dfs(account_filtered_items,
+                                       secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"])
 
     logging.info("Writing to Minio...")
     for raw_df_name, df in raw_doc_dfs.items():
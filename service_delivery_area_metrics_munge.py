@@ -1,7 +1,9 @@
 # base imports
+import concurrent.futures
 from dataclasses import dataclass
 import json
 import logging
+import multiprocessing
 import os
 import sys
 # external imports
@@ -9,10 +11,10 @@ from db_utils import minio_utils
 import geopandas as gpd
 from geospatial_utils import mportal_utils
 from h3 import h3
-import numpy as np
 import pandas as pd
 from shapely.geometry import Polygon
 # local imports
+import service_delivery_fact_snapshot_to_minio
 from service_delivery_metrics_munge import select_latest_value
 
 
@@ -25,7 +27,7 @@ class SDTLayer:
 
 
 COVID_BUCKET = "covid"
-SERVICE_FACTS_BUCKET = "service-standards-tool.sd-request-facts"
+SERVICE_FACTS_BUCKET = service_delivery_fact_snapshot_to_minio.SERVICE_REQUEST_FACTS_MINIO_NAME
 PUBLIC_PREFIX = "data/public/"
 PRIVATE_PREFIX = "data/private/"
 SUBCOUNCILS = "subcouncils.geojson"
@@ -67,9 +69,10 @@ SUBURB_CLASS = SDTLayer(SUBURB_LAYER, SUBURB, SUBURB_NAME, SUBURB_NAME_NEW)
 AGGREGATION_CLASS_LIST = [ABSD_CLASS, SC_CLASS, WARD_CLASS]  # , SUBURB_CLASS]
 
 # Notificaiton facts constants
+PYRAMID_DATASET = service_delivery_fact_snapshot_to_minio.PYRAMID_DATASET
 TARGET_RES = 6
-if TARGET_RES not in [6, 7, 10]:
-    logging.error(f"target resolution {TARGET_RES} is not valid. must be one of [6, 7, 10]")
+if TARGET_RES not in [6, 7]:
+    logging.error(f"target resolution {TARGET_RES} is not valid. must be one of [6, 7]")
     sys.exit(-1)
 
 RES = "resolution"
@@ -84,12 +87,9 @@ CLOSE_COUNT = "closed_count"
 CLS_IN_TARGET = "closed_within_target_sum"
 STILL_OPEN_SUM = "opened_still_open_sum"
 BACKLOG = "backlog"
-LONG_BACKLOG_WEIGHTING = "long_backlog_weighting"
 LONG_BACKLOG = "long_backlog"
+PYRAMID_MEASURES = [OPENED_COUNT, CLOSE_COUNT, CLS_IN_TARGET, STILL_OPEN_SUM]
 
-OVERLAP_TAG = "is_overlap"
-SCALE_AREA = "scale_area"
-HEX_AREA = "hex_area"
 PERC_AREA = "percent_area"
 
 TARGET_DATE = "2020-10-12"
@@ -98,7 +98,6 @@ STALENESS_THRESHOLD = pd.Timedelta('28')
 STD_EPSG = "epsg:4326"
 METERS_EPSG = "EPSG:3857"
 
-AREA_INDEX = "area_index"
 GEOMETRY = "geometry"
 AREAS = "areas"
 HEX_INDEX = "index"
@@ -113,6 +112,13 @@ SS_DELTA = "service_std_delta"
 LONG_BACKLOG_OCT = "long_backlog_oct"
 LONG_BACKLOG_DELTA = "long_backlog_delta"
 
+LATEST_KEY = "latest"
+TARGET_DATE_KEY = "target_date"
+WORKERS_VAR = "SERVICE_DELIVERY_AREA_METRICS_WORKERS"
+
+# hex metrics per date key, set before the worker processes are forked so that they share a read-only copy
+_shared_hex_geodfs = {}
+
 
 def get_hex_boundary(hex_index):
     try:
@@ -129,90 +135,59 @@ def make_shapely_poly(x):
 
 def get_hex_overlaps(request_geodf, area_geodf, groupby_col):
     """
-    Get the Uber hex id's that fall within a given spatial area
+    Get the intersections of the Uber hexes with all of the spatial areas in a layer, in a single overlay
     """
+    overlap_geodf = gpd.overlay(area_geodf[[groupby_col, area_geodf.geometry.name]], request_geodf, how='intersection')
 
-    area_list = []
-    for area_name, grp_area_df in area_geodf.groupby([groupby_col]):
-        new_area_frame = gpd.overlay(grp_area_df, request_geodf, how='intersection')
-        indices = new_area_frame[HEX_INDEX].to_list()
-
-        area_list += [{
-            groupby_col: area_name,
-            AREA_INDEX: indices,
-        }]
-
-    req_index_ref = pd.DataFrame(area_list)
+    return overlap_geodf
 
-    return req_index_ref
 
-
-def conver_hex_to_area(request_geodf, area_geodf, groupby_col):
+def conver_hex_to_area(request_geodf, area_geodf, groupby_col, hex_area):
     """
     Convert Unber hex geodf to alternate spatial mapping
     """
+    area_names = area_geodf[groupby_col].unique()
+
+    # Everything in the overlay overlaps by definition, so each hex just gets weighted by its overlapping area
+    overlap_geodf = get_hex_overlaps(request_geodf, area_geodf, groupby_col)
+    overlap_geodf[PERC_AREA] = overlap_geodf.geometry.area / hex_area
+
+    no_overlap_areas = set(area_names) - set(overlap_geodf[groupby_col])
+    for area_name in sorted(no_overlap_areas):
+        logging.warning(f"No hex overlap for {area_name}")
 
-    req_sc_index_df = get_hex_overlaps(request_geodf, area_geodf, groupby_col)
-
-    area_collected_list = []
-    for area_name, group_area_df in area_geodf.groupby([groupby_col]):
-        overlap_hex = req_sc_index_df.query(f"{groupby_col} == @area_name").copy()[AREA_INDEX].to_list()[0]
-        if not overlap_hex:
-            logging.warning(f"No hex overlap for {area_name}")
-            backlog = np.nan
-            service_std = np.nan
-            long_backlog = np.nan
-        else:
-            new_area_frame = gpd.overlay(group_area_df, request_geodf, how='intersection')
-            new_area_frame[SCALE_AREA] = new_area_frame.geometry.area
-            new_area_frame[HEX_AREA] = hex_area
-            new_area_frame[PERC_AREA] = new_area_frame[SCALE_AREA] / new_area_frame[HEX_AREA]
-            new_area_frame[OVERLAP_TAG] = new_area_frame[HEX_INDEX].apply(lambda x: True if x in overlap_hex else False)
-            new_area_frame.loc[(new_area_frame[OVERLAP_TAG] == False), PERC_AREA] = 1
-            new_area_frame[BACKLOG] = new_area_frame[BACKLOG] * new_area_frame[PERC_AREA]
-            new_area_frame[CLS_IN_TARGET] = new_area_frame[CLS_IN_TARGET] * new_area_frame[PERC_AREA]
-            new_area_frame[CLOSE_COUNT] = new_area_frame[CLOSE_COUNT] * new_area_frame[PERC_AREA]
-            new_area_frame[STILL_OPEN_SUM] = new_area_frame[STILL_OPEN_SUM] * new_area_frame[PERC_AREA]
-
-            # long backlog
-            new_area_frame[LONG_BACKLOG_WEIGHTING] = new_area_frame[OPENED_COUNT] * new_area_frame[PERC_AREA]
-
-            still_open_df = new_area_frame.reset_index().sort_values([DATE]).set_index([DATE]).groupby(
-                [HEX_INDEX], sort=False).apply(
-                lambda df: df[[STILL_OPEN_SUM, OPENED_COUNT]].resample("1D").sum().cumsum()).reset_index()
-
-            max_date = still_open_df.reset_index()[DATE].max()
-
-            still_open_df[LONG_BACKLOG_WEIGHTING] = still_open_df[OPENED_COUNT]
-            still_open_df[LONG_BACKLOG] = still_open_df.set_index([DATE]).shift(180, freq="D").reset_index(drop=True)[
-                STILL_OPEN_SUM]
-
-            # remove dates past max date due to shift
-            still_open_df = still_open_df.query(f"{DATE} <= @max_date").copy()
-
-            # calc final long backlog ratio
-            still_open_df[LONG_BACKLOG] /= still_open_df[LONG_BACKLOG_WEIGHTING]
-
-            long_backlog = still_open_df[LONG_BACKLOG].to_list()[0]
-            backlog = new_area_frame[BACKLOG].sum()
-            try:
-                service_std = new_area_frame[CLS_IN_TARGET].sum() / new_area_frame[CLOSE_COUNT].sum()
-            except ZeroDivisionError as e:
-                logging.error(f"zero value for closed count {new_area_frame}\n{e}")
-                sys.exit(-1)
-
-        area_collected_list += [{
-            groupby_col: area_name,
-            BACKLOG: backlog,
-            SERVICE_STD: service_std,
-            LONG_BACKLOG: long_backlog,
-        }]
-
-    collected_area_df = pd.DataFrame(area_collected_list)
+    # long backlog - the hexes' still open and opened counts are already summed over the trailing window
+    weighted_df = overlap_geodf[[BACKLOG, CLS_IN_TARGET, CLOSE_COUNT, STILL_OPEN_SUM, OPENED_COUNT]].multiply(
+        overlap_geodf[PERC_AREA], axis=0
+    )
+    weighted_df[groupby_col] = overlap_geodf[groupby_col]
+    area_sums_df = weighted_df.groupby(groupby_col).sum()
+
+    collected_area_df = pd.DataFrame({
+        BACKLOG: area_sums_df[BACKLOG],
+        SERVICE_STD: area_sums_df[CLS_IN_TARGET] / area_sums_df[CLOSE_COUNT],
+        LONG_BACKLOG: area_sums_df[STILL_OPEN_SUM] / area_sums_df[OPENED_COUNT],
+    }).reindex(area_names).rename_axis(groupby_col).reset_index()
 
     return collected_area_df
 
 
+def _convert_shared_hex_to_area(date_key, area_geodf, groupby_col, hex_area):
+    return conver_hex_to_area(_shared_hex_geodfs[date_key], area_geodf, groupby_col, hex_area)
+
+
+def get_area_executor(workers):
+    """
+    Executor for the (layer, date) hex to area conversions. With more than one worker, the conversions run in forked
+    processes that share the hex metrics, otherwise they run in a single background thread.
+    """
+    if workers > 1:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                      mp_context=multiprocessing.get_context("fork"))
+    else:
+        return concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
@@ -228,28 +203,20 @@ if __name__ == "__main__":
     secrets = json.load(open(secrets_path))
 
     # ---------------------------
-    logging.info(f"Fetch[ing] {SERVICE_FACTS_BUCKET}")
-    service_facts = minio_utils.minio_to_dataframe(
-        minio_bucket=SERVICE_FACTS_BUCKET,
-        minio_key=secrets["minio"]["lake"]["access"],
-        minio_secret=secrets["minio"]["lake"]["secret"],
-        data_classification=LAKE_CLASSIFICATION,
-    )
-    logging.info(f"Fetch[ed] {SERVICE_FACTS_BUCKET}")
+    logging.info(f"Fetch[ing] {PYRAMID_DATASET} at hex resolution {TARGET_RES}")
+    service_facts_hex_level = service_delivery_fact_snapshot_to_minio.get_fact_snapshot(
+        PYRAMID_DATASET,
+        secrets["minio"]["edge"]["access"],
+        secrets["minio"]["edge"]["secret"],
+        resolution=TARGET_RES,
+        columns=[DATE, HEX_INDEX] + PYRAMID_MEASURES
+    ).assign(date=lambda df: pd.to_datetime(df.date, format=DATE_FORMAT))
+    logging.info(f"Fetch[ed] {PYRAMID_DATASET} at hex resolution {TARGET_RES}")
 
     # ---------------------------
-    logging.info(f"Filter[ing] to hex resolution {TARGET_RES}")
-    service_facts_hex_level = service_facts.query(f"{RES} == @TARGET_RES").copy().assign(
-        date=lambda df: pd.to_datetime(df.date, format=DATE_FORMAT))
-    logging.info(f"Filter[ed] to hex resolution {TARGET_RES}")
-
+    # The pyramid is already pivoted by feature, so just need to aggregate over them
     logging.info(f"Pivot[ing] df")
-    city_pivot_df = service_facts_hex_level.groupby(
-        [DATE, HEX_INDEX, MEASURE], as_index=False).sum().pivot_table(
-        columns=MEASURE,
-        values=VALUE,
-        index=[DATE, HEX_INDEX]
-    ).fillna(0)
+    city_pivot_df = service_facts_hex_level.groupby([DATE, HEX_INDEX])[PYRAMID_MEASURES].sum()
     logging.info(f"Pivot[ed] df")
 
     # ---------------------------
@@ -340,51 +307,65 @@ if __name__ == "__main__":
     logging.info(f"Calculat[ed] res {TARGET_RES} area")
 
     # ---------------------------
+    workers = int(os.environ.get(WORKERS_VAR, 1))
+    logging.info(f"Using {workers} worker(s) for the hex to area mapping")
+    _shared_hex_geodfs[LATEST_KEY] = city_backlog_df_latest_geo
+    _shared_hex_geodfs[TARGET_DATE_KEY] = city_backlog_df_oct_gdf
+
+    # Fetching each layer while the previous layers are being mapped
+    area_remapped_futures = {}
+    with get_area_executor(workers) as area_executor:
+        for layer_data_class in AGGREGATION_CLASS_LIST:
+            area_layer = layer_data_class.layer
+            targt_col_name = layer_data_class.id_col
+            target_col_rename = layer_data_class.id_rename
+
+            logging.info(f"Fetch[ing] {area_layer}")
+            area_df = mportal_utils.load_mportal_layer(
+                area_layer,
+                minio_key=secrets["minio"]["lake"]["access"],
+                minio_secret=secrets["minio"]["lake"]["secret"],
+                return_gdf=True,
+            )
+            logging.info(f"Fetch[ed] {area_layer}")
+
+            logging.debug(f"Renam[ing] {targt_col_name} to {target_col_rename}")
+            area_df.rename(columns={targt_col_name: target_col_rename}, inplace=True)
+            logging.debug(f"Renam[ed] {targt_col_name} to {target_col_rename}")
+
+            logging.info("Convert[ing] geometry to meters EPSG for Area calculation reference df")
+            area_geo_df = area_df.to_crs(METERS_EPSG).copy()
+            logging.info("Convert[ed] geometry to meters EPSG for Area calculation reference df")
+
+            logging.info(f"Submitt[ing] hex to area mapping of {area_layer} for latest and target date data")
+            for date_key in (LATEST_KEY, TARGET_DATE_KEY):
+                area_remapped_futures[(area_layer, date_key)] = area_executor.submit(
+                    _convert_shared_hex_to_area, date_key, area_geo_df[[target_col_rename, area_geo_df.geometry.name]],
+                    target_col_rename, hex_area
+                )
+            logging.info(f"Submitt[ed] hex to area mapping of {area_layer} for latest and target date data")
+
+        logging.info(f"Mapp[ing] hex to areas")
+        area_remapped_dfs = {
+            unit_key: area_remapped_future.result()
+            for unit_key, area_remapped_future in area_remapped_futures.items()
+        }
+        logging.info(f"Mapp[ed] hex to areas")
+
     all_areas_collected_df = pd.DataFrame()
     for layer_data_class in AGGREGATION_CLASS_LIST:
         area_layer = layer_data_class.layer
         resolution_name = layer_data_class.resolution
-        targt_col_name = layer_data_class.id_col
         target_col_rename = layer_data_class.id_rename
 
-        logging.info(f"Fetch[ing] {area_layer}")
-        area_df = mportal_utils.load_mportal_layer(
-            area_layer,
-            minio_key=secrets["minio"]["lake"]["access"],
-            minio_secret=secrets["minio"]["lake"]["secret"],
-            return_gdf=True,
-        )
-        logging.info(f"Fetch[ed] {area_layer}")
-
-        logging.debug(f"Renam[ing] {targt_col_name} to {target_col_rename}")
-        area_df.rename(columns={targt_col_name: target_col_rename}, inplace=True)
-        logging.debug(f"Renam[ed] {targt_col_name} to {target_col_rename}")
-
-        logging.info("Convert[ing] geometry to meters EPSG for Area calculation reference df")
-        area_geo_df = area_df.to_crs(METERS_EPSG).copy()
-        logging.info("Convert[ed] geometry to meters EPSG for Area calculation reference df")
-
-        # ---------------------------
-        # get latest subcouncil mapping
-        logging.info(f"Mapp[ing] hex to area for latest data")
-        area_remapped_df_latest = conver_hex_to_area(
-            city_backlog_df_latest_geo, area_geo_df, groupby_col=target_col_rename
-        )
-        logging.info(f"Mapp[ed] hex to area for latest data")
-
-        # ---------------------------
-        # get 2020-10-12 subcouncil mapping
-        logging.info(f"Mapp[ing] hex to area for target date data")
-        area_remapped_df_latest_oct = conver_hex_to_area(
-            city_backlog_df_oct_gdf, area_geo_df, groupby_col=target_col_rename
-        )
+        area_remapped_df_latest = area_remapped_dfs[(area_layer, LATEST_KEY)]
+        area_remapped_df_latest_oct = area_remapped_dfs[(area_layer, TARGET_DATE_KEY)]
         area_remapped_df_latest_oct.rename(
             columns={
                 BACKLOG: BACKLOG_OCT,
                 SERVICE_STD: SS_OCT,
                 LONG_BACKLOG: LONG_BACKLOG_OCT
             }, inplace=True)
-        logging.info(f"Mapp[ed] hex to area for target date data")
 
         # ---------------------------
         # merge data
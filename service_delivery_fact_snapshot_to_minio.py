@@ -0,0 +1,307 @@
+"""
+script to compact the service delivery LAKE fact buckets into a single Parquet snapshot, partitioned by hex resolution
+and month, so that the downstream service delivery scripts only read the partitions and columns that they need.
+
+Also builds a daily hex pyramid of the linear request measures: pivoted once at the finest resolution, with the
+coarser resolutions derived by rolling the hexes up to their parents.
+"""
+
+# base imports
+import json
+import logging
+import os
+import pathlib
+import sys
+import tempfile
+# external imports
+from db_utils import minio_utils
+from h3 import h3
+import numpy
+import pandas
+import pyarrow
+import pyarrow.dataset
+
+SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX = "service-standards-tool"
+SERVICE_REQUEST_FACTS_MINIO_NAME = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-request-facts'
+SERVICE_DELIVERY_CITY_FACTS_MINIO_NAME = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-city-facts'
+SERVICE_DELIVERY_DIRECTORATE_FACTS_MINIO_NAME = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-directorate-facts'
+SERVICE_DELIVERY_DEPARTMENT_FACTS_MINIO_NAME = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-department-facts'
+SNAPSHOT_DATASETS = (
+    SERVICE_REQUEST_FACTS_MINIO_NAME,
+    SERVICE_DELIVERY_CITY_FACTS_MINIO_NAME,
+    SERVICE_DELIVERY_DIRECTORATE_FACTS_MINIO_NAME,
+    SERVICE_DELIVERY_DEPARTMENT_FACTS_MINIO_NAME
+)
+PYRAMID_DATASET = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-request-daily-hex-pyramid'
+FACT_CLASSIFICATION = minio_utils.DataClassification.LAKE
+
+DATE_COL = "date"
+MONTH_COL = "month"
+HEX_RESOLUTION_COL = "resolution"
+HEX_INDEX_COL = "index"
+FEATURE_TYPE_COL = "feature_type"
+FEATURE_COL = "feature"
+MEASURE_COL = "measure"
+VALUE_COL = "value"
+FACT_COLS = [DATE_COL, HEX_INDEX_COL, HEX_RESOLUTION_COL, FEATURE_TYPE_COL, FEATURE_COL, MEASURE_COL, VALUE_COL]
+
+# Measures that are weighted averages, and so can't be summed across hexes, along with their weighting measures
+SERVICE_STANDARD_MEASURE = "service_standard"
+SERVICE_STANDARD_WEIGHTING_MEASURE = "service_standard_weighting"
+LONG_BACKLOG_MEASURE = "long_backlog"
+LONG_BACKLOG_WEIGHTING_MEASURE = "long_backlog_weighting"
+NON_LINEAR_MEASURE_WEIGHTINGS = {
+    SERVICE_STANDARD_MEASURE: SERVICE_STANDARD_WEIGHTING_MEASURE,
+    LONG_BACKLOG_MEASURE: LONG_BACKLOG_WEIGHTING_MEASURE,
+}
+NON_LINEAR_MEASURES = list(NON_LINEAR_MEASURE_WEIGHTINGS.keys())
+WEIGHTING_MEASURES = list(NON_LINEAR_MEASURE_WEIGHTINGS.values())
+# Measures that can be summed across hexes, and so rolled up the pyramid - which includes the weightings
+LINEAR_MEASURES = [
+    "opened_count", "closed_count", "opened_within_target_sum", "closed_within_target_sum", "opened_still_open_sum",
+    "backlog"
+] + WEIGHTING_MEASURES
+PYRAMID_INDEX_COLS = [DATE_COL, HEX_INDEX_COL, FEATURE_COL]
+PYRAMID_COLS = PYRAMID_INDEX_COLS + [HEX_RESOLUTION_COL] + LINEAR_MEASURES
+PYRAMID_BASE_RESOLUTION = 7
+PYRAMID_RESOLUTIONS = (6, 3)
+NO_LOCATION_INDEX = "0"
+
+PARTITION_SCHEMA = pyarrow.schema([(HEX_RESOLUTION_COL, pyarrow.int64()), (MONTH_COL, pyarrow.string())])
+PARTITION_FILENAME_TEMPLATE = "part-{i}.parquet"
+
+ISO8601_DATE_FORMAT = "%Y-%m-%d"
+MONTH_FORMAT = "%Y-%m"
+
+COVID_BUCKET = "covid"
+SNAPSHOT_CLASSIFICATION = minio_utils.DataClassification.EDGE
+SNAPSHOT_PREFIX = "data/private/business_continuity_service_delivery_fact_snapshot/"
+
+
+def get_lake_fact_dataset(fact_bucket, minio_access, minio_secret):
+    df = minio_utils.minio_to_dataframe(
+        minio_bucket=fact_bucket,
+        minio_key=minio_access,
+        minio_secret=minio_secret,
+        data_classification=FACT_CLASSIFICATION,
+    )
+
+    logging.debug(f"{fact_bucket}.shape={df.shape}")
+    logging.debug(f"{fact_bucket}.columns={df.columns}")
+
+    return df[[col for col in FACT_COLS if col in df.columns]]
+
+
+def get_parent_index(hex_indices, resolution):
+    """
+    Maps hex indices to their parents at a coarser resolution, calling h3 once per distinct hex
+    :param hex_indices: (Series) hex index strings
+    :param resolution: (int) parent resolution
+    :return: (ndarray) parent hex index strings
+    """
+    index_codes, unique_indices = pandas.factorize(hex_indices)
+    parent_indices = numpy.array([
+        hex_index if hex_index == NO_LOCATION_INDEX else h3.h3_to_parent(hex_index, resolution)
+        for hex_index in unique_indices
+    ] + [None], dtype=object)
+
+    # NaN indices are coded as -1, which picks up the trailing None
+    return parent_indices[index_codes]
+
+
+def build_daily_pyramid(fact_df):
+    """
+    Pivots the linear measures by date, hex and feature at the base resolution, and then rolls that up to the coarser
+    pyramid resolutions
+    :param fact_df: (DataFrame) request facts, in long format
+    :return: (DataFrame) daily hex aggregates, with a column per linear measure, for all of the pyramid resolutions
+    """
+    base_df = fact_df.query(
+        f"{HEX_RESOLUTION_COL} == @PYRAMID_BASE_RESOLUTION and {MEASURE_COL}.isin(@LINEAR_MEASURES)"
+    )
+    base_pivot_df = base_df.pivot_table(
+        index=PYRAMID_INDEX_COLS, columns=MEASURE_COL, values=VALUE_COL, aggfunc="sum", fill_value=0
+    ).reindex(columns=LINEAR_MEASURES, fill_value=0).reset_index()
+    base_pivot_df.columns.name = None
+    logging.debug(f"base_pivot_df.shape={base_pivot_df.shape}")
+
+    pyramid_dfs = [base_pivot_df.assign(**{HEX_RESOLUTION_COL: PYRAMID_BASE_RESOLUTION})]
+    child_df = base_pivot_df
+    # Going from finest to coarsest, so that each level is rolled up from the (smaller) level below it
+    for resolution in sorted(PYRAMID_RESOLUTIONS, reverse=True):
+        parent_df = child_df.assign(**{
+            HEX_INDEX_COL: get_parent_index(child_df[HEX_INDEX_COL], resolution)
+        }).groupby(PYRAMID_INDEX_COLS, as_index=False)[LINEAR_MEASURES].sum()
+        logging.debug(f"resolution {resolution} parent_df.shape={parent_df.shape}")
+
+        pyramid_dfs += [parent_df.assign(**{HEX_RESOLUTION_COL: resolution})]
+        child_df = parent_df
+
+    return pandas.concat(pyramid_dfs, ignore_index=True)[PYRAMID_COLS]
+
+
+def write_fact_snapshot(fact_df, dataset_name, snapshot_dir):
+    """
+    Writes the fact dataframe out as a hive partitioned (resolution, month) Parquet dataset, one file per partition
+    :param fact_df: (DataFrame) facts, with the date column as an ISO8601 formatted string
+    :param dataset_name: (str) name of the source fact bucket, used as the top level directory of the dataset
+    :param snapshot_dir: (str) local directory to write the dataset into
+    :return: (list) paths of the written files
+    """
+    partitioned_df = fact_df.assign(**{
+        HEX_RESOLUTION_COL: lambda df: df[HEX_RESOLUTION_COL].astype("int64"),
+        MONTH_COL: lambda df: df[DATE_COL].astype(str).str[:7]
+    }).sort_values([HEX_RESOLUTION_COL, DATE_COL])
+
+    dataset_dir = pathlib.Path(snapshot_dir, dataset_name)
+    pyarrow.dataset.write_dataset(
+        pyarrow.Table.from_pandas(partitioned_df, preserve_index=False),
+        dataset_dir,
+        format="parquet",
+        partitioning=pyarrow.dataset.partitioning(PARTITION_SCHEMA, flavor="hive"),
+        basename_template=PARTITION_FILENAME_TEMPLATE,
+        existing_data_behavior="delete_matching",
+    )
+
+    return sorted(dataset_dir.glob("**/*.parquet"))
+
+
+def snapshot_to_minio(snapshot_dir, minio_access, minio_secret):
+    for local_path in sorted(pathlib.Path(snapshot_dir).glob("**/*.parquet")):
+        relative_dir = local_path.parent.relative_to(snapshot_dir)
+        logging.debug(f"Upload[ing] '{relative_dir / local_path.name}'")
+        result = minio_utils.file_to_minio(
+            filename=str(local_path),
+            minio_bucket=COVID_BUCKET,
+            minio_key=minio_access,
+            minio_secret=minio_secret,
+            data_classification=SNAPSHOT_CLASSIFICATION,
+            filename_prefix_override=f"{SNAPSHOT_PREFIX}{relative_dir}/",
+        )
+        assert result, f"Failed to upload '{local_path}'!"
+
+
+def _parse_partition_key(object_name):
+    partition_values = dict(
+        part.split("=", 1) for part in object_name.split("/") if "=" in part
+    )
+
+    return int(partition_values[HEX_RESOLUTION_COL]), partition_values[MONTH_COL]
+
+
+def _build_filter_expression(resolution, start_date, end_date, measures):
+    filter_expression = None
+    for expression in (
+            (pyarrow.dataset.field(HEX_RESOLUTION_COL) == resolution) if resolution is not None else None,
+            (pyarrow.dataset.field(DATE_COL) >= start_date) if start_date is not None else None,
+            (pyarrow.dataset.field(DATE_COL) <= end_date) if end_date is not None else None,
+            pyarrow.dataset.field(MEASURE_COL).isin(measures) if measures is not None else None,
+    ):
+        if expression is not None:
+            filter_expression = expression if filter_expression is None else filter_expression & expression
+
+    return filter_expression
+
+
+def get_fact_snapshot(dataset_name, minio_access, minio_secret,
+                      resolution=None, start_date=None, end_date=None, columns=None, measures=None):
+    """
+    Reads the facts of one source bucket out of the snapshot, only fetching the partitions that could match
+    :param dataset_name: (str) name of the source fact bucket
+    :param minio_access: (str) edge minio access key
+    :param minio_secret: (str) edge minio secret
+    :param resolution: (int) hex resolution to select, or None for all
+    :param start_date: (str) ISO8601 date string of the earliest date to select (inclusive), or None
+    :param end_date: (str) ISO8601 date string of the latest date to select (inclusive), or None
+    :param columns: (list) columns to read, or None for all of the fact columns
+    :param measures: (list) measures to select, or None for all
+    :return: (DataFrame) selected facts
+    """
+    dataset_prefix = f"{SNAPSHOT_PREFIX}{dataset_name}/"
+    start_month = pandas.to_datetime(start_date).strftime(MONTH_FORMAT) if start_date is not None else None
+    end_month = pandas.to_datetime(end_date).strftime(MONTH_FORMAT) if end_date is not None else None
+
+    partition_files = [
+        object_name
+        for object_name in minio_utils.list_objects_in_bucket(COVID_BUCKET,
+                                                              minio_access, minio_secret, SNAPSHOT_CLASSIFICATION,
+                                                              minio_prefix_override=dataset_prefix)
+        if object_name.endswith(".parquet")
+    ]
+    assert partition_files, f"No snapshot files found under '{dataset_prefix}'!"
+
+    selected_files = []
+    for object_name in partition_files:
+        file_resolution, file_month = _parse_partition_key(object_name)
+        if ((resolution is None or file_resolution == resolution) and
+                (start_month is None or file_month >= start_month) and
+                (end_month is None or file_month <= end_month)):
+            selected_files += [object_name]
+    logging.debug(f"Selected {len(selected_files)}/{len(partition_files)} partition files from '{dataset_prefix}'")
+
+    columns = columns if columns is not None else FACT_COLS
+    if not selected_files:
+        logging.warning(f"No partitions in '{dataset_prefix}' match the selection, returning an empty dataframe")
+        return pandas.DataFrame(columns=columns)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        for object_name in selected_files:
+            local_path = pathlib.Path(tempdir, object_name[len(dataset_prefix):])
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            result = minio_utils.minio_to_file(str(local_path),
+                                               COVID_BUCKET, minio_access, minio_secret, SNAPSHOT_CLASSIFICATION,
+                                               minio_filename_override=object_name)
+            assert result, f"Failed to fetch snapshot file '{object_name}'!"
+
+        fact_dataset = pyarrow.dataset.dataset(tempdir, format="parquet",
+                                               partitioning=pyarrow.dataset.partitioning(PARTITION_SCHEMA,
+                                                                                         flavor="hive"))
+        fact_table = fact_dataset.to_table(columns=columns,
+                                           filter=_build_filter_expression(resolution, start_date, end_date,
+                                                                                  measures))
+
+    fact_df = fact_table.to_pandas()
+    logging.debug(f"{dataset_name}.shape={fact_df.shape}")
+
+    return fact_df
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+
+    # Loading secrets
+    SECRETS_PATH_VAR = "SECRETS_PATH"
+
+    if SECRETS_PATH_VAR not in os.environ:
+        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+        sys.exit(-1)
+
+    secrets_path = os.environ["SECRETS_PATH"]
+    secrets = json.load(open(secrets_path))
+
+    with tempfile.TemporaryDirectory() as snapshot_tempdir:
+        for fact_dataset in SNAPSHOT_DATASETS:
+            logging.info(f"Fetch[ing] {fact_dataset}")
+            source_fact_df = get_lake_fact_dataset(fact_dataset,
+                                                   secrets["minio"]["lake"]["access"],
+                                                   secrets["minio"]["lake"]["secret"])
+            logging.info(f"Fetch[ed] {fact_dataset}")
+
+            logging.info(f"Partition[ing] {fact_dataset}")
+            written_files = write_fact_snapshot(source_fact_df, fact_dataset, snapshot_tempdir)
+            logging.debug(f"Wrote {len(written_files)} partition files for {fact_dataset}")
+            logging.info(f"Partition[ed] {fact_dataset}")
+
+            if fact_dataset == SERVICE_REQUEST_FACTS_MINIO_NAME:
+                logging.info(f"Build[ing] {PYRAMID_DATASET}")
+                pyramid_df = build_daily_pyramid(source_fact_df)
+                written_files = write_fact_snapshot(pyramid_df, PYRAMID_DATASET, snapshot_tempdir)
+                logging.debug(f"Wrote {len(written_files)} partition files for {PYRAMID_DATASET}")
+                logging.info(f"Buil[t] {PYRAMID_DATASET}")
+
+        logging.info("Wr[iting] snapshot to Minio")
+        snapshot_to_minio(snapshot_tempdir, secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"])
+        logging.info("Wr[ote] snapshot to Minio")
+
+    logging.info("...Done!")
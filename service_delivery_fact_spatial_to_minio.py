@@ -35,21 +35,16 @@ if __name__ == "__main__":
     secrets = json.load(open(secrets_path))
 
     logging.info("G[etting] Data")
-    source_fact_df = pandas.concat((
+    filtered_fact_df = pandas.concat((
         service_delivery_fact_ts_to_minio.get_fact_dataset(fact_datatset,
-                                                           secrets["minio"]["lake"]["access"],
-                                                           secrets["minio"]["lake"]["secret"])
+                                                           secrets["minio"]["edge"]["access"],
+                                                           secrets["minio"]["edge"]["secret"],
+                                                           resolution=HEX_RESOLUTION)
         for fact_datatset in service_delivery_fact_ts_to_minio.FACTS_DATASETS
     ))
-    logging.debug(f"source_fact_df.shape={source_fact_df.shape}")
-    logging.debug(f"source_fact_df.columns={source_fact_df.columns}")
-    logging.info("G[ot] Data")
-
-    logging.info("Filter[ing] by hex resolution")
-    filtered_fact_df = service_delivery_fact_ts_to_minio.filter_by_resolution(source_fact_df, HEX_RESOLUTION)
     logging.debug(f"filtered_fact_df.shape={filtered_fact_df.shape}")
     logging.debug(f"filtered_fact_df.columns={filtered_fact_df.columns}")
-    logging.info("Filter[ed] by hex resolution")
+    logging.info("G[ot] Data")
 
     logging.info("Pivot[ing] data")
     pivot_df = service_delivery_metrics_munge.pivot_dataframe(filtered_fact_df, INDEX_COLS).reset_index()
@@ -7,16 +7,13 @@ from db_utils import minio_utils
 import numpy
 import pandas
 
-SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX = "service-standards-tool"
-SERVICE_DELIVERY_CITY_FACTS_MINIO_NAME = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-city-facts'
-SERVICE_DELIVERY_DIRECTORATE_FACTS_MINIO_NAME = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-directorate-facts'
-SERVICE_DELIVERY_DEPARTMENT_FACTS_MINIO_NAME = f'{SERVICE_STANDARDS_TOOL_PIPELINE_PREFIX}.sd-department-facts'
+import service_delivery_fact_snapshot_to_minio
+
 FACTS_DATASETS = (
-    SERVICE_DELIVERY_CITY_FACTS_MINIO_NAME,
-    SERVICE_DELIVERY_DIRECTORATE_FACTS_MINIO_NAME,
-    SERVICE_DELIVERY_DEPARTMENT_FACTS_MINIO_NAME
+    service_delivery_fact_snapshot_to_minio.SERVICE_DELIVERY_CITY_FACTS_MINIO_NAME,
+    service_delivery_fact_snapshot_to_minio.SERVICE_DELIVERY_DIRECTORATE_FACTS_MINIO_NAME,
+    service_delivery_fact_snapshot_to_minio.SERVICE_DELIVERY_DEPARTMENT_FACTS_MINIO_NAME
 )
-FACT_CLASSIFICATION = minio_utils.DataClassification.LAKE
 
 DATE_COL = "date"
 MEASURE_COL = "measure"
@@ -26,19 +23,11 @@ HEX_INDEX_COL = "index"
 VALUE_COL = "value"
 FEATURE_TYPE_COL = "feature_type"
 
-SERVICE_STANDARD_WEIGHTING_MEASURE = "service_standard_weighting"
-LONG_BACKLOG_WEIGHTING_MEASURE = "long_backlog_weighting"
-LINEAR_MEASURES = [
-    "opened_count", "closed_count", "opened_within_target_sum", "closed_within_target_sum", "opened_still_open_sum",
-    "backlog", SERVICE_STANDARD_WEIGHTING_MEASURE, LONG_BACKLOG_WEIGHTING_MEASURE
-]
-
-SERVICE_STANDARD_MEASURE = "service_standard"
-LONG_BACKLOG_MEASURE = "long_backlog"
-NON_LINEAR_MEASURES = [
-    SERVICE_STANDARD_MEASURE, SERVICE_STANDARD_WEIGHTING_MEASURE,
-    LONG_BACKLOG_MEASURE, LONG_BACKLOG_WEIGHTING_MEASURE
-]
+LINEAR_MEASURES = service_delivery_fact_snapshot_to_minio.LINEAR_MEASURES
+NON_LINEAR_MEASURE_WEIGHTINGS = service_delivery_fact_snapshot_to_minio.NON_LINEAR_MEASURE_WEIGHTINGS
+# The weighted averages are worked out from their values and weightings
+WEIGHTED_AVERAGE_MEASURES = (service_delivery_fact_snapshot_to_minio.NON_LINEAR_MEASURES +
+                             service_delivery_fact_snapshot_to_minio.WEIGHTING_MEASURES)
 
 HEX_RESOLUTION = 3
 
@@ -49,23 +38,18 @@ BUCKET_CLASSIFICATION = minio_utils.DataClassification.EDGE
 SERVICE_DELIVERY_PREFIX = "data/private/business_continuity_service_delivery"
 
 
-def get_fact_dataset(fact_bucket, minio_access, minio_secret):
-    df = minio_utils.minio_to_dataframe(
-        minio_bucket=fact_bucket,
-        minio_key=minio_access,
-        minio_secret=minio_secret,
-        data_classification=FACT_CLASSIFICATION,
-        use_cache=True
+def get_fact_dataset(fact_bucket, minio_access, minio_secret, resolution=None):
+    # Only reading the partitions of the snapshot for the resolution we're interested in
+    df = service_delivery_fact_snapshot_to_minio.get_fact_snapshot(
+        fact_bucket, minio_access, minio_secret,
+        resolution=resolution,
+        columns=[DATE_COL, HEX_INDEX_COL, HEX_RESOLUTION_COL, FEATURE_TYPE_COL, FEATURE_COL, MEASURE_COL, VALUE_COL]
     )
 
     logging.debug(f"{fact_bucket}.shape={df.shape}")
     logging.debug(f"{fact_bucket}.columns={df.columns}")
 
-    return df[[DATE_COL, HEX_INDEX_COL, HEX_RESOLUTION_COL, FEATURE_TYPE_COL, FEATURE_COL, MEASURE_COL, VALUE_COL]]
-
-
-def filter_by_resolution(fact_df, resolution=HEX_RESOLUTION):
-    return fact_df.query(f"{HEX_RESOLUTION_COL} == {resolution}")
+    return df
 
 
 def _compute_weighted_average(day_df, value_measure, weighting_measure):
@@ -117,7 +101,7 @@ def despatialise(fact_df):
     logging.debug(f"linear_groupby_df.head(10)=\n{linear_groupby_df.head(10)}")
 
     # service standard and long backlogs are a little trickier - need to do a weighted mean
-    non_linear_filtered_df = fact_df.query(f"{MEASURE_COL}.isin(@NON_LINEAR_MEASURES)")
+    non_linear_filtered_df = fact_df.query(f"{MEASURE_COL}.isin(@WEIGHTED_AVERAGE_MEASURES)")
     logging.debug(f"non_linear_filtered_df.shape={non_linear_filtered_df.shape}")
     logging.debug(f"non_linear_filtered_df.columns={non_linear_filtered_df.columns}")
     logging.debug(f"non_linear_filtered_df['{MEASURE_COL}'].value_counts()=\n"
@@ -136,8 +120,7 @@ def despatialise(fact_df):
                 DATE_COL: lambda df: df[DATE_COL].dt.strftime(ISO8601_DATE_FORMAT),
                 MEASURE_COL: value_col
             })
-        for value_col, weighting_col in ((SERVICE_STANDARD_MEASURE, SERVICE_STANDARD_WEIGHTING_MEASURE),
-                                         (LONG_BACKLOG_MEASURE, LONG_BACKLOG_WEIGHTING_MEASURE))
+        for value_col, weighting_col in NON_LINEAR_MEASURE_WEIGHTINGS.items()
     ))
     logging.debug(f"non_linear_groupby_df.shape={non_linear_groupby_df.shape}")
     logging.debug(f"non_linear_groupby_df.columns={non_linear_groupby_df.columns}")
@@ -167,19 +150,14 @@ if __name__ == "__main__":
     secrets = json.load(open(secrets_path))
 
     logging.info("G[etting] Data")
-    source_fact_df = pandas.concat((
-        get_fact_dataset(fact_datatset, secrets["minio"]["lake"]["access"], secrets["minio"]["lake"]["secret"])
+    filtered_fact_df = pandas.concat((
+        get_fact_dataset(fact_datatset, secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"],
+                         resolution=HEX_RESOLUTION)
         for fact_datatset in FACTS_DATASETS
     ))
-    logging.debug(f"source_fact_df.shape={source_fact_df.shape}")
-    logging.debug(f"source_fact_df.columns={source_fact_df.columns}")
-    logging.info("G[ot] Data")
-
-    logging.info("Filter[ing] by date")
-    filtered_fact_df = filter_by_resolution(source_fact_df)
     logging.debug(f"filtered_fact_df.shape={filtered_fact_df.shape}")
     logging.debug(f"filtered_fact_df.columns={filtered_fact_df.columns}")
-    logging.info("Filter[ed] by date")
+    logging.info("G[ot] Data")
 
     logging.info("Comput[ing] pure time series")
     ts_df = despatialise(filtered_fact_df)
@@ -22,10 +22,11 @@ from h3 import h3
 import pandas as pd
 from shapely.geometry import Polygon
 # local imports
+import service_delivery_fact_snapshot_to_minio
 import service_delivery_metrics_munge
 
 # set bucket constants
-SERVICE_FACTS_BUCKET = "service-standards-tool.sd-request-facts"
+SERVICE_FACTS_BUCKET = service_delivery_fact_snapshot_to_minio.SERVICE_REQUEST_FACTS_MINIO_NAME
 SERVICE_ATTRIBUTES = "service-standards-tool.sd-request-fact-attributes"
 COVID_BUCKET = "covid"
 PRIVATE_PREFIX = "data/private/"
@@ -100,57 +101,55 @@ if __name__ == "__main__":
             sys.exit(-1)
         secrets = json.load(open(secrets_path))
 
-    # get the data
-    logging.info(f"Fetch[ing] {SERVICE_FACTS_BUCKET}")
-    service_dfs = []
-    for df_bucket in [SERVICE_FACTS_BUCKET, SERVICE_ATTRIBUTES]:
-        fetched_df = minio_utils.minio_to_dataframe(
-            minio_bucket=df_bucket,
-            minio_key=secrets["minio"]["lake"]["access"],
-            minio_secret=secrets["minio"]["lake"]["secret"],
-            data_classification=LAKE_CLASSIFICATION,
-        )
-        service_dfs.append(fetched_df)
-    logging.info(f"Fetch[ed] {SERVICE_FACTS_BUCKET}")
-
-    service_facts = service_dfs[0]
-    service_attribs = service_dfs[1]
-
-    logging.info("Filter[ing] to hex 7 resolution")
-    service_facts_hex_7 = service_facts.query(f"{RES_COL} == @RESOLUTION").copy().assign(
-        **{DATE_COL: lambda df: pd.to_datetime(df[DATE_COL], format="%Y-%m-%d")}
+    full_rebuild = os.environ.get(service_delivery_metrics_munge.FULL_REBUILD_VAR, "").lower() in ("1", "true", "yes")
+    if full_rebuild:
+        logging.info(f"'{service_delivery_metrics_munge.FULL_REBUILD_VAR}' is set, doing a full rebuild")
+        state_df = None
+    else:
+        logging.info("Fetch[ing] incremental state")
+        state_df = service_delivery_metrics_munge.get_incremental_state(DEPT_SERVICE_METRICS_HEX_7,
+                                                                        secrets["minio"]["edge"]["access"],
+                                                                        secrets["minio"]["edge"]["secret"])
+        logging.info("Fetch[ed] incremental state")
+    window_start = (
+        service_delivery_metrics_munge.get_window_start(state_df).strftime("%Y-%m-%d")
+        if state_df is not None else None
     )
-    logging.info("Filter[ed] to hex 7 resolution")
-
-    # filter out those with no location data
-    logging.info(f"Filter[ing] out hex index == 0")
-    service_facts_hex_7_locs = service_facts_hex_7.query(f"{HEX_INDEX_COL} != '0'").copy()
-    logging.info(f"Filter[ed] out hex index == 0")
 
-    logging.info("Merg[ing] to annotations")
-    res7_facts_annotated = pd.merge(service_facts_hex_7_locs, service_attribs, how="left", on=FEATURE, validate="m:1")
-    logging.info("Merg[ed] to annotations")
+    # get the data
+    logging.info(f"Fetch[ing] {SERVICE_ATTRIBUTES}")
+    service_attribs = minio_utils.minio_to_dataframe(
+        minio_bucket=SERVICE_ATTRIBUTES,
+        minio_key=secrets["minio"]["lake"]["access"],
+        minio_secret=secrets["minio"]["lake"]["secret"],
+        data_classification=LAKE_CLASSIFICATION,
+    )
+    logging.info(f"Fetch[ed] {SERVICE_ATTRIBUTES}")
 
     logging.info("Generat[ing] request code annotation name")
-    res7_facts_annotated.loc[:, CODE] = service_delivery_metrics_munge.generate_request_code_name(res7_facts_annotated)
+    service_attribs.loc[:, CODE] = service_delivery_metrics_munge.generate_request_code_name(service_attribs)
     logging.info("Generat[ed] request code annotation name")
 
-    logging.info("Pivot[ing] dataframe")
-    res7_pivot_df = service_delivery_metrics_munge.pivot_dataframe(res7_facts_annotated, INDEX_COLS)
-    logging.info("Pivot[ed] dataframe")
-    
-    logging.info("Calculat[ing] metric values")
-    res7_calc_df = service_delivery_metrics_munge.calculate_metrics_dataframe(res7_pivot_df, INDEX_COLS)
-    logging.info("Calculat[ed] metric values")
+    # filter out those with no location data
+    logging.info(f"Fetch[ing] and pivot[ing] hex {RESOLUTION} resolution facts with locations")
+    res7_pivot_df = service_delivery_metrics_munge.get_pivot_dataframe(service_attribs,
+                                                                       secrets["minio"]["edge"]["access"],
+                                                                       secrets["minio"]["edge"]["secret"],
+                                                                       RESOLUTION, INDEX_COLS,
+                                                                       start_date=window_start,
+                                                                       with_locations_only=True)
+    logging.info(f"Fetch[ed] and pivot[ed] hex {RESOLUTION} resolution facts with locations")
+
+    logging.info("Calculat[ing] latest metric values and total requests attribute")
+    res7_state_df = service_delivery_metrics_munge.calculate_latest_metrics(res7_pivot_df, INDEX_COLS, state_df)
+    logging.info("Calculat[ed] latest metric values and total requests attribute")
 
     logging.info("Filter[ing] metrics to latest data date")
-    res7_filt_df = service_delivery_metrics_munge.select_latest_value(res7_calc_df, INDEX_COLS)
-    logging.info("Filter[ed] metrics to latest data date")
-
-    logging.info("Calculat[ing] total requests attribute")
-    res7_combined = service_delivery_metrics_munge.calc_total_values(res7_filt_df, res7_pivot_df, INDEX_COLS)
+    res7_combined = service_delivery_metrics_munge.select_latest_value(
+        res7_state_df.drop(columns=service_delivery_metrics_munge.STATE_COLS), INDEX_COLS
+    )
     res7_combined.drop(columns=[DATE_COL], inplace=True)
-    logging.info("Calculat[ed] total requests attribute")
+    logging.info("Filter[ed] metrics to latest data date")
 
     logging.info("Dropp[ing] any entries where all metrics are NaNs")
     res7_combined = service_delivery_metrics_munge.drop_nas(res7_combined, INDEX_COLS)
@@ -170,7 +169,14 @@ if __name__ == "__main__":
 
     if not result:
         logging.debug(f"Send[ing] data to minio failed")
+        sys.exit(-1)
     logging.info(f"Push[ed] collected hex7 metrics data to minio")
+
+    logging.info("Push[ing] incremental state to minio")
+    service_delivery_metrics_munge.put_incremental_state(res7_state_df, DEPT_SERVICE_METRICS_HEX_7,
+                                                         secrets["minio"]["edge"]["access"],
+                                                         secrets["minio"]["edge"]["secret"])
+    logging.info("Push[ed] incremental state to minio")
     sys.exit()
     # get top n request per hex
     logging.info(f"Filter[ing] to top {SELECT_TOP_N} codes per hex")
@@ -10,13 +10,16 @@ import logging
 import os
 import pathlib
 import sys
+import tempfile
 # external imports
 from db_utils import minio_utils
 import pandas as pd
 import numpy as np
+# local imports
+import service_delivery_fact_snapshot_to_minio
 
 # set bucket constants
-SERVICE_FACTS_BUCKET = "service-standards-tool.sd-request-facts"
+SERVICE_FACTS_BUCKET = service_delivery_fact_snapshot_to_minio.SERVICE_REQUEST_FACTS_MINIO_NAME
 SERVICE_ATTRIBUTES = "service-standards-tool.sd-request-fact-attributes"
 COVID_BUCKET = "covid"
 PRIVATE_PREFIX = "data/private/"
@@ -25,6 +28,7 @@ LAKE_CLASSIFICATION = minio_utils.DataClassification.LAKE
 
 # outfiles
 DEPT_SERVICE_METRICS = "business_continuity_service_delivery_department_metrics"
+INCREMENTAL_STATE_PREFIX = f"{PRIVATE_PREFIX}business_continuity_service_delivery_state/"
 
 # settings
 DATE_FORMAT = "%Y-%m-%d"
@@ -56,8 +60,19 @@ DEPT = "department"
 DEPT_COLOUR = "dept_color"
 
 INDEX_COLS = [DIRCT, DEPT, CODE]
+FACT_COLS = [DATE_COL, HEX_INDEX_COL, RES_COL, FEATURE, MEASURE, VAL]
+
+# incremental state
+FIRST_DATE = "first_date"
+# total opened before the facts that the next run reads in again
+OPENED_BASELINE = "opened_total_window_baseline"
+# hash of the group's facts in the rolling window up to the watermark, to pick up late facts
+WINDOW_HASH = "window_hash"
+WATERMARK = "watermark"
+STATE_COLS = [FIRST_DATE, OPENED_BASELINE, WINDOW_HASH, WATERMARK]
 
 SECRETS_PATH_VAR = "SECRETS_PATH"
+FULL_REBUILD_VAR = "SERVICE_DELIVERY_FULL_REBUILD"
 
 DEPARTMENTS_CLR_DICT = {
     "Electricity": '#a6cee3',
@@ -105,6 +120,50 @@ def pivot_dataframe(df, index_cols=INDEX_COLS):
     return pivoted_df
 
 
+def get_pivot_dataframe(service_attribs, minio_access, minio_secret, resolution,
+                        index_cols=INDEX_COLS, start_date=None, with_locations_only=False):
+    """
+    Gets the annotated facts for a hex resolution, pivoted by the index columns and date. The linear measures come from
+    the pre-pivoted daily hex pyramid, so only the non-linear measures have to be pivoted from the raw facts.
+    :param service_attribs: (DataFrame) feature attributes, with the request code annotation name already generated
+    :param minio_access: (str) edge minio access key
+    :param minio_secret: (str) edge minio secret
+    :param resolution: (int) hex resolution
+    :param index_cols: (list) columns to pivot by, along with the date
+    :param start_date: (str) ISO8601 date string of the earliest date to select, or None for all dates
+    :param with_locations_only: (bool) whether to drop the facts with no hex location
+    :return: (DataFrame) pivoted measures, indexed by the index columns and date
+    """
+    annotated_dfs = []
+    for dataset_name, columns, measures in (
+            (service_delivery_fact_snapshot_to_minio.PYRAMID_DATASET,
+             service_delivery_fact_snapshot_to_minio.PYRAMID_COLS, None),
+            (SERVICE_FACTS_BUCKET, FACT_COLS, service_delivery_fact_snapshot_to_minio.NON_LINEAR_MEASURES),
+    ):
+        fact_df = service_delivery_fact_snapshot_to_minio.get_fact_snapshot(
+            dataset_name, minio_access, minio_secret,
+            resolution=resolution, start_date=start_date, columns=columns, measures=measures
+        )
+        fact_df[DATE_COL] = pd.to_datetime(fact_df[DATE_COL], format=DATE_FORMAT)
+        if with_locations_only:
+            fact_df = fact_df.query(f"{HEX_INDEX_COL} != @service_delivery_fact_snapshot_to_minio.NO_LOCATION_INDEX")
+
+        annotated_dfs += [pd.merge(fact_df, service_attribs, how="left", on=FEATURE, validate="m:1")]
+
+    linear_df, non_linear_df = annotated_dfs
+    pivoted_df = linear_df.groupby(
+        index_cols + [DATE_COL]
+    )[service_delivery_fact_snapshot_to_minio.LINEAR_MEASURES].sum()
+    pivoted_df.columns.name = MEASURE
+
+    if not non_linear_df.empty:
+        pivoted_df = pd.concat([pivoted_df, pivot_dataframe(non_linear_df, index_cols)], axis=1).fillna(0)
+
+    pivoted_df = pivoted_df[sorted(pivoted_df.columns)].sort_values(DATE_COL)
+
+    return pivoted_df
+
+
 def calculate_metrics_dataframe(df, index_cols=INDEX_COLS):
     logging.debug("Add[ing] backlog calc")
     calc_df = df.copy()
@@ -178,6 +237,176 @@ def calc_total_values(df, pivot_df, index_cols=INDEX_COLS):
     return combined_df
 
 
+def _opened_total(pivot_df, index_cols, start_date, end_date=None):
+    dates = pivot_df.index.get_level_values(DATE_COL)
+    date_mask = (dates >= start_date) & ((dates < end_date) if end_date is not None else True)
+
+    return pivot_df[date_mask].groupby(index_cols)[OPEN_COUNT].sum()
+
+
+def _window_hashes(pivot_df, index_cols, start_date, end_date):
+    # Order independent hash of each group's facts between the dates (inclusive), so that any change to them shows up
+    dates = pivot_df.index.get_level_values(DATE_COL)
+    window_df = pivot_df[(dates >= start_date) & (dates <= end_date)].reset_index()
+    row_hashes = pd.util.hash_pandas_object(window_df, index=False)
+
+    return row_hashes.groupby([window_df[col] for col in index_cols]).sum()
+
+
+def _anchor_groups(pivot_df, group_first_dates, window_start):
+    # Adding zero entries at the start of each group's window, so that the rolling calculation counts the same number
+    # of periods as it would have if we had the group's full history
+    anchor_dates = group_first_dates.clip(lower=window_start).rename(DATE_COL)
+    anchor_df = pd.DataFrame(
+        0, columns=pivot_df.columns,
+        index=pd.MultiIndex.from_frame(anchor_dates.reset_index())
+    )
+    anchored_df = pd.concat([pivot_df, anchor_df]).groupby(level=list(pivot_df.index.names)).sum()
+
+    return anchored_df
+
+
+def calculate_latest_metrics(pivot_df, index_cols=INDEX_COLS, state_df=None):
+    """
+    Calculates the latest metric values and total opened requests per group. If the state from a previous run is
+    provided, only the groups with data on or after that run's watermark, or whose facts in the rolling window have
+    changed since (e.g. late facts), are recomputed.
+    :param pivot_df: (DataFrame) pivoted facts, as returned by `pivot_dataframe`. When using state, only needs to
+                     contain the dates from `get_window_start` onwards.
+    :param index_cols: (list) columns identifying each group
+    :param state_df: (DataFrame) the output of the previous run of this function, or None for a full rebuild
+    :return: (DataFrame) latest metric values per group, with the state columns needed for the next run
+    """
+    dates = pivot_df.index.get_level_values(DATE_COL)
+    watermark = dates.max()
+
+    if state_df is None:
+        logging.debug("Calculat[ing] metrics over the full history")
+        calc_df = calculate_metrics_dataframe(pivot_df, index_cols)
+        latest_df = calc_df.sort_values(by=DATE_COL).drop_duplicates(subset=index_cols, keep='last')
+        latest_df = calc_total_values(latest_df, pivot_df, index_cols).set_index(index_cols)
+
+        latest_df[FIRST_DATE] = pivot_df.reset_index().groupby(index_cols)[DATE_COL].min()
+        latest_df[OPENED_BASELINE] = _opened_total(
+            pivot_df, index_cols, START_DATE, _get_read_start(watermark)
+        ).reindex(latest_df.index, fill_value=0)
+        window_pivot_df = pivot_df
+        logging.debug("Calculat[ed] metrics over the full history")
+    else:
+        prev_watermark = state_df[WATERMARK].max()
+        window_start = get_window_start(state_df)
+        watermark = max(watermark, prev_watermark)
+        next_window_start = _get_read_start(watermark)
+        opened_start = max(START_DATE, window_start)
+        logging.debug(f"Calculat[ing] metrics incrementally from watermark '{prev_watermark}'")
+
+        recent_pivot_df = pivot_df[dates >= window_start]
+        group_index = recent_pivot_df.index.droplevel(DATE_COL)
+        prev_state_df = state_df.set_index(index_cols)
+
+        # Groups with new data, as well as those whose facts in the rolling window before the watermark have changed
+        window_hashes = _window_hashes(recent_pivot_df, index_cols,
+                                       prev_watermark - pd.Timedelta(ROLLLING_WINDOW), prev_watermark)
+        changed_hashes = window_hashes.index[
+            window_hashes.astype(str) != prev_state_df[WINDOW_HASH].reindex(window_hashes.index)
+        ]
+        changed_groups = group_index[
+            (recent_pivot_df.index.get_level_values(DATE_COL) >= prev_watermark) | group_index.isin(changed_hashes)
+        ].unique()
+        logging.debug(f"Recomput[ing] {len(changed_groups)}/{state_df.shape[0]} groups")
+
+        # The unchanged groups' baselines still have to move up to the next run's window
+        unchanged_df = prev_state_df[~prev_state_df.index.isin(changed_groups)].copy()
+        unchanged_df[OPENED_BASELINE] = unchanged_df[OPENED_BASELINE].add(
+            _opened_total(recent_pivot_df, index_cols, opened_start, next_window_start), fill_value=0
+        ).reindex(unchanged_df.index)
+
+        if len(changed_groups):
+            changed_pivot_df = recent_pivot_df[group_index.isin(changed_groups)]
+
+            group_first_dates = changed_pivot_df.reset_index().groupby(index_cols)[DATE_COL].min()
+            prev_first_dates = prev_state_df[FIRST_DATE].reindex(group_first_dates.index)
+            group_first_dates = prev_first_dates.fillna(group_first_dates).astype(group_first_dates.dtype)
+
+            calc_df = calculate_metrics_dataframe(
+                _anchor_groups(changed_pivot_df, group_first_dates, window_start), index_cols
+            )
+            changed_df = calc_df.sort_values(by=DATE_COL).drop_duplicates(
+                subset=index_cols, keep='last'
+            ).set_index(index_cols)
+
+            # All of the facts from the window start are read in again, so the opened totals are counted on from the
+            # baseline at that point
+            opened_baseline = prev_state_df[OPENED_BASELINE].reindex(changed_df.index).fillna(0)
+            changed_df[TOTAL_OPEN] = opened_baseline.add(
+                _opened_total(changed_pivot_df, index_cols, opened_start), fill_value=0
+            ).reindex(changed_df.index)
+            changed_df[FIRST_DATE] = group_first_dates
+            changed_df[OPENED_BASELINE] = opened_baseline.add(
+                _opened_total(changed_pivot_df, index_cols, opened_start, next_window_start), fill_value=0
+            ).reindex(changed_df.index)
+
+            latest_df = pd.concat([unchanged_df, changed_df])
+        else:
+            latest_df = unchanged_df
+        window_pivot_df = recent_pivot_df
+        logging.debug(f"Calculat[ed] metrics incrementally from watermark '{prev_watermark}'")
+
+    latest_df[WINDOW_HASH] = _window_hashes(
+        window_pivot_df, index_cols, watermark - pd.Timedelta(ROLLLING_WINDOW), watermark
+    ).reindex(latest_df.index, fill_value=0).astype(str)
+    latest_df[WATERMARK] = watermark
+
+    return latest_df.reset_index().sort_values(by=index_cols).reset_index(drop=True)
+
+
+def _get_read_start(watermark):
+    # Late facts are picked up as far back as a rolling window before the watermark, and recomputing the metrics for
+    # those needs another rolling window's worth of facts before them
+    return watermark - 2 * pd.Timedelta(ROLLLING_WINDOW)
+
+
+def get_window_start(state_df):
+    return _get_read_start(state_df[WATERMARK].max())
+
+
+def get_incremental_state(state_name, minio_access, minio_secret):
+    state_filename = f"{INCREMENTAL_STATE_PREFIX}{state_name}.parquet"
+    state_files = set(minio_utils.list_objects_in_bucket(COVID_BUCKET,
+                                                         minio_access, minio_secret, EDGE_CLASSIFICATION,
+                                                         minio_prefix_override=INCREMENTAL_STATE_PREFIX))
+    if state_filename not in state_files:
+        logging.warning(f"No incremental state found at '{state_filename}'")
+        return None
+
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as temp_state_file:
+        result = minio_utils.minio_to_file(temp_state_file.name,
+                                           COVID_BUCKET, minio_access, minio_secret, EDGE_CLASSIFICATION,
+                                           minio_filename_override=state_filename)
+        assert result, f"Failed to fetch state file '{state_filename}'!"
+        state_df = pd.read_parquet(temp_state_file.name)
+
+    missing_cols = [col for col in STATE_COLS if col not in state_df.columns]
+    if missing_cols:
+        logging.warning(f"Incremental state at '{state_filename}' is missing '{', '.join(missing_cols)}', ignoring it")
+        return None
+
+    return state_df
+
+
+def put_incremental_state(state_df, state_name, minio_access, minio_secret):
+    result = minio_utils.dataframe_to_minio(
+        state_df,
+        filename_prefix_override=f"{INCREMENTAL_STATE_PREFIX}{state_name}",
+        minio_bucket=COVID_BUCKET,
+        minio_key=minio_access,
+        minio_secret=minio_secret,
+        data_classification=EDGE_CLASSIFICATION,
+        data_versioning=False,
+        file_format="parquet")
+    assert result, f"Failed to write state for '{state_name}'!"
+
+
 def drop_nas(df, index_cols=INDEX_COLS):
     logging.debug(f"( pre-NaN drop) res3_combined.shape={df.shape}")
     clean_df = df.dropna(subset=[
@@ -210,54 +439,48 @@ if __name__ == "__main__":
             sys.exit(-1)
         secrets = json.load(open(secrets_path))
 
-    logging.info(f"Fetch[ing] {SERVICE_FACTS_BUCKET}")
-    service_dfs = []
-    for df_bucket in [SERVICE_FACTS_BUCKET, SERVICE_ATTRIBUTES]:
-        fetched_df = minio_utils.minio_to_dataframe(
-            minio_bucket=df_bucket,
-            minio_key=secrets["minio"]["lake"]["access"],
-            minio_secret=secrets["minio"]["lake"]["secret"],
-            data_classification=LAKE_CLASSIFICATION,
-        )
-        service_dfs.append(fetched_df)
-    logging.info(f"Fetch[ed] {SERVICE_FACTS_BUCKET}")
-
-    service_facts = service_dfs[0]
-    service_attribs = service_dfs[1]
+    full_rebuild = os.environ.get(FULL_REBUILD_VAR, "").lower() in ("1", "true", "yes")
+    if full_rebuild:
+        logging.info(f"'{FULL_REBUILD_VAR}' is set, doing a full rebuild")
+        state_df = None
+    else:
+        logging.info("Fetch[ing] incremental state")
+        state_df = get_incremental_state(DEPT_SERVICE_METRICS,
+                                         secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"])
+        logging.info("Fetch[ed] incremental state")
+    window_start = get_window_start(state_df).strftime(DATE_FORMAT) if state_df is not None else None
+
+    logging.info(f"Fetch[ing] {SERVICE_ATTRIBUTES}")
+    service_attribs = minio_utils.minio_to_dataframe(
+        minio_bucket=SERVICE_ATTRIBUTES,
+        minio_key=secrets["minio"]["lake"]["access"],
+        minio_secret=secrets["minio"]["lake"]["secret"],
+        data_classification=LAKE_CLASSIFICATION,
+    )
+    logging.info(f"Fetch[ed] {SERVICE_ATTRIBUTES}")
 
     for department in service_attribs[DEPT].unique():
         if department not in DEPARTMENTS_CLR_DICT.keys():
             DEPARTMENTS_CLR_DICT[department] = DEFAULT_GREY
 
-    logging.info("Filter[ing] to hex 3 resolution")
-    service_facts_hex_3 = service_facts.query("resolution == @RESOLUTION").copy().assign(
-        date=lambda df: pd.to_datetime(df.date, format=DATE_FORMAT))
-    logging.info("Filter[ed] to hex 3 resolution")
-
-    logging.info("Merg[ing] to annotations")
-    res3_facts_annotated = pd.merge(service_facts_hex_3, service_attribs, how="left", on=FEATURE, validate="m:1")
-    logging.info("Merg[ed] to annotations")
-
     logging.info("Generat[ing] request code annotation name")
-    res3_facts_annotated.loc[:, CODE] = generate_request_code_name(res3_facts_annotated)
+    service_attribs.loc[:, CODE] = generate_request_code_name(service_attribs)
     logging.info("Generat[ed] request code annotation name")
 
-    logging.info("Pivot[ing] dataframe")
-    res3_pivot_df = pivot_dataframe(res3_facts_annotated)
-    logging.info("Pivot[ed] dataframe")
+    logging.info(f"Fetch[ing] and pivot[ing] hex {RESOLUTION} resolution facts")
+    res3_pivot_df = get_pivot_dataframe(service_attribs,
+                                        secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"],
+                                        RESOLUTION, start_date=window_start)
+    logging.info(f"Fetch[ed] and pivot[ed] hex {RESOLUTION} resolution facts")
 
-    logging.info("Calculat[ing] metric values")
-    res3_calc_df = calculate_metrics_dataframe(res3_pivot_df)
-    logging.info("Calculat[ed] metric values")
+    logging.info("Calculat[ing] latest metric values and total requests attribute")
+    res3_state_df = calculate_latest_metrics(res3_pivot_df, state_df=state_df)
+    logging.info("Calculat[ed] latest metric values and total requests attribute")
 
     logging.info("Filter[ing] metrics to latest data date")
-    res3_filt_df = select_latest_value(res3_calc_df)
-    logging.info("Filter[ed] metrics to latest data date")
-
-    logging.info("Calculat[ing] total requests attribute")
-    res3_combined = calc_total_values(res3_filt_df, res3_pivot_df)
+    res3_combined = select_latest_value(res3_state_df.drop(columns=STATE_COLS))
     res3_combined.drop(columns=[DATE_COL], inplace=True)
-    logging.info("Calculat[ed] total requests attribute")
+    logging.info("Filter[ed] metrics to latest data date")
 
     logging.info("Dropp[ing] any entries where all metrics are NaNs")
     res3_combined = drop_nas(res3_combined)
@@ -281,6 +504,12 @@ if __name__ == "__main__":
 
     if not result:
         logging.debug(f"Send[ing] data to minio failed")
+        sys.exit(-1)
     logging.info(f"Push[ed] collected department metrics data to minio")
 
+    logging.info("Push[ing] incremental state to minio")
+    put_incremental_state(res3_state_df, DEPT_SERVICE_METRICS,
+                          secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"])
+    logging.info("Push[ed] incremental state to minio")
+
     logging.info(f"Done")
@@ -0,0 +1,60 @@
+import io
+import os
+import pathlib
+import sys
+
+import pytest
+
+# The scripts live in the root of the repo
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+
+class FakeMinio:
+    """In memory stand in for the bits of db_utils.minio_utils that the scripts use, keyed by bucket and object name"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def minio_to_file(self, filename, minio_bucket=None, minio_key=None, minio_secret=None, data_classification=None,
+                      minio_filename_override=None, **kwargs):
+        if (minio_bucket, minio_filename_override) not in self.objects:
+            return False
+
+        with open(filename, "wb") as local_file:
+            local_file.write(self.objects[(minio_bucket, minio_filename_override)])
+
+        return True
+
+    def file_to_minio(self, filename, minio_bucket=None, minio_key=None, minio_secret=None, data_classification=None,
+                      filename_prefix_override=None, **kwargs):
+        with open(filename, "rb") as local_file:
+            self.objects[(minio_bucket, f"{filename_prefix_override}{os.path.basename(filename)}")] = local_file.read()
+
+        return True
+
+    def dataframe_to_minio(self, dataframe, minio_bucket=None, minio_key=None, minio_secret=None,
+                           data_classification=None, filename_prefix_override=None, file_format="csv", **kwargs):
+        data_buffer = io.BytesIO()
+        if file_format == "parquet":
+            dataframe.to_parquet(data_buffer)
+        else:
+            dataframe.to_csv(data_buffer, index=False)
+        self.objects[(minio_bucket, f"{filename_prefix_override}.{file_format}")] = data_buffer.getvalue()
+
+        return True
+
+    def list_objects_in_bucket(self, minio_bucket=None, minio_key=None, minio_secret=None, data_classification=None,
+                               minio_prefix_override=None, **kwargs):
+        return [object_name for bucket, object_name in self.objects
+                if bucket == minio_bucket and object_name.startswith(minio_prefix_override or "")]
+
+
+@pytest.fixture
+def fake_minio(monkeypatch):
+    minio_utils = pytest.importorskip("db_utils.minio_utils")
+
+    fake = FakeMinio()
+    for func_name in ("minio_to_file", "file_to_minio", "dataframe_to_minio", "list_objects_in_bucket"):
+        monkeypatch.setattr(minio_utils, func_name, getattr(fake, func_name))
+
+    return fake
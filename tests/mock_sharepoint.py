@@ -0,0 +1,174 @@
+"""
+Local stand in for the SharePoint 2007 Lists SOAP service, with just enough of CAML (Where clauses and row limits) to
+page through lists the way that the scripts do
+"""
+import datetime
+import http.server
+import threading
+from xml.sax.saxutils import quoteattr
+
+from lxml import etree
+
+NS = "http://schemas.microsoft.com/sharepoint/soap/"
+SOAP_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+
+BASE_FIELDS = [
+    ("ID", "ID", "Counter"),
+    ("Title", "Title", "Text"),
+    ("Modified", "Modified", "DateTime"),
+    ("Created", "Created", "Lookup"),
+    ("UniqueId", "Unique Id", "Lookup"),
+    ("FileRef", "URL Path", "Lookup"),
+]
+
+
+class MockList:
+    def __init__(self, name, extra_fields, row_func, n):
+        self.name = name
+        self.fields = BASE_FIELDS + extra_fields
+        self.row_func = row_func
+        self.items = {}
+        self.next_id = 1
+        base = datetime.datetime(2021, 3, 1, 8, 0, 0)
+        for _ in range(n):
+            self.add(base + datetime.timedelta(minutes=7 * self.next_id))
+
+    def add(self, modified):
+        i = self.next_id
+        self.next_id += 1
+        self.items[i] = self._row(i, modified, version=0)
+
+    def modify(self, i, modified):
+        version = self.items[i]["_version"] + 1
+        self.items[i] = self._row(i, modified, version)
+
+    def _row(self, i, modified, version):
+        row = {
+            "ID": str(i),
+            "Title": f"item {i} v{version}",
+            "Modified": modified.strftime("%Y-%m-%d %H:%M:%S"),
+            "Created": f"{i};#2021-03-01 08:00:00",
+            # the unique id stays the same as the item is edited
+            "UniqueId": f"{i};#{{{i:08d}-0000-0000-0000-000000000000}}",
+            "FileRef": f"{i};#sites/hshealth/C19/sv/Lists/{self.name}/{i}_.000",
+            "_version": version,
+        }
+        row.update(self.row_func(i, version))
+        return row
+
+
+class State:
+    lists = {}
+    # (list name, whether there was a query, number of items returned) for each GetListItems call
+    requests = []
+
+
+def _where_matches(el, row, list_):
+    tag = el.tag
+    if tag == "And":
+        return all(_where_matches(child, row, list_) for child in el)
+    if tag == "Or":
+        return any(_where_matches(child, row, list_) for child in el)
+    name = el.find("FieldRef").get("Name")
+    value_el = el.find("Value")
+    field_type = value_el.get("Type")
+    value = value_el.text
+    row_value = row[name]
+    if field_type == "DateTime":
+        # CAML ignores the time unless IncludeTimeValue is set
+        row_value = row_value[:10]
+        value = value[:10]
+    elif field_type in ("Counter", "Number", "Integer"):
+        row_value, value = float(row_value), float(value)
+    return {
+        "Eq": row_value == value, "Neq": row_value != value,
+        "Gt": row_value > value, "Geq": row_value >= value,
+        "Lt": row_value < value, "Leq": row_value <= value,
+    }[tag]
+
+
+def _envelope(body):
+    return (f'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body>'
+            f'{body}</soap:Body></soap:Envelope>')
+
+
+def _rows_xml(rows, fields):
+    out = []
+    for row in rows:
+        attrs = " ".join(f"ows_{name}={quoteattr(row[name])}" for name, _, _ in fields if name in row)
+        out.append(f"<z:row {attrs} />")
+    return "".join(out)
+
+
+def _list_items(command):
+    list_name = command.find(f"{{{NS}}}listName").text
+    row_limit_el = command.find(f"{{{NS}}}rowLimit")
+    row_limit = int(row_limit_el.text) if row_limit_el is not None and row_limit_el.text else 0
+    query = command.find(f"{{{NS}}}query")
+
+    if list_name == "UserInfo":
+        rows, fields = [{"ID": "1", "ImnName": "someone"}], [("ID", "", ""), ("ImnName", "", "")]
+    else:
+        list_ = State.lists[list_name]
+        fields = list_.fields
+        rows = [list_.items[i] for i in sorted(list_.items)]
+        if query is not None:
+            where = query.find("Query/Where")
+            if where is not None and len(where):
+                rows = [row for row in rows if _where_matches(where[0], row, list_)]
+        # a real server has no row limit by default, the views' limits aside
+        if row_limit:
+            rows = rows[:row_limit]
+        State.requests.append((list_name, query is not None, len(rows)))
+
+    return (f'<GetListItemsResponse xmlns="{NS}"><GetListItemsResult>'
+            f'<listitems xmlns:rs="urn:schemas-microsoft-com:rowset" xmlns:z="#RowsetSchema">'
+            f'<rs:data ItemCount="{len(rows)}">{_rows_xml(rows, fields)}</rs:data></listitems>'
+            f'</GetListItemsResult></GetListItemsResponse>')
+
+
+def _get_list(command):
+    list_ = State.lists[command.find(f"{{{NS}}}listName").text]
+    fields = "".join(f"<Field Name={quoteattr(n)} DisplayName={quoteattr(d)} Type={quoteattr(t)} />"
+                     for n, d, t in list_.fields)
+    return (f'<GetListResponse xmlns="{NS}"><GetListResult><List Title={quoteattr(list_.name)}>'
+            f'<Fields>{fields}</Fields><RegionalSettings><Locale>1033</Locale></RegionalSettings>'
+            f'<ServerSettings><ServerVersion>12</ServerVersion></ServerSettings></List></GetListResult>'
+            f'</GetListResponse>')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        action = self.headers["SOAPAction"].rsplit("/", 1)[-1]
+        envelope = etree.fromstring(body)
+        command = envelope.find(f"{{{SOAP_NS}}}Body")[0]
+        if action == "GetSite":
+            response = f'<GetSiteResponse xmlns="{NS}"><GetSiteResult>site</GetSiteResult></GetSiteResponse>'
+        elif action == "GetList":
+            response = _get_list(command)
+        elif action == "GetViewCollection":
+            response = (f'<GetViewCollectionResponse xmlns="{NS}"><GetViewCollectionResult><Views>'
+                        f'<View Name="{{0}}" DisplayName="All Items" /></Views></GetViewCollectionResult>'
+                        f'</GetViewCollectionResponse>')
+        elif action == "GetListItems":
+            response = _list_items(command)
+        else:
+            self.send_response(500)
+            self.end_headers()
+            return
+        data = _envelope(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
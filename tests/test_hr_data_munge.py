@@ -0,0 +1,69 @@
+import numpy
+import pandas
+import pytest
+
+hr_data_munge = pytest.importorskip("hr_data_munge")
+
+BUCKET = hr_data_munge.BUCKET
+CSV_KEY = (BUCKET, hr_data_munge.CLEANED_HR_TRANSACTIONAL_FILENAME)
+STAFF_COUNT = 30
+
+
+def get_status_df(rng, status_date, staff_count=STAFF_COUNT, time="08:00:00"):
+    staff_numbers = rng.choice(STAFF_COUNT, size=staff_count, replace=False) + 1000
+    return pandas.DataFrame({
+        hr_data_munge.HR_MASTER_STAFFNUMBER: staff_numbers.astype(str),
+        hr_data_munge.HR_STATUS: rng.choice(hr_data_munge.VALID_STATUSES, size=staff_count),
+        hr_data_munge.HR_TRANSACTION_DATE: f"{status_date}T{time}",
+        hr_data_munge.HR_UNIT_EVALUATION: rng.choice(["Critical", "Non-critical", None], size=staff_count),
+        hr_data_munge.HR_APPROVER: "Someone",
+        hr_data_munge.HR_APPROVER_STAFFNUMBER: rng.choice(["999", None], size=staff_count),
+    })[hr_data_munge.HR_HISTORY_COLUMNS]
+
+
+def get_sorted_rows(hr_df):
+    return hr_df.fillna("").astype(str).sort_values(by=hr_data_munge.HR_HISTORY_COLUMNS, ignore_index=True)
+
+
+def assert_csv_matches_history(fake_minio):
+    csv_df = hr_data_munge.get_data_df(hr_data_munge.CLEANED_HR_TRANSACTIONAL_FILENAME, "access", "secret",
+                                       dtype=str, keep_default_na=False)
+    history_df = hr_data_munge.get_hr_history_df("access", "secret")
+
+    pandas.testing.assert_frame_equal(get_sorted_rows(csv_df), get_sorted_rows(history_df))
+    assert csv_df[hr_data_munge.HR_TRANSACTION_DATE].is_monotonic_decreasing
+
+
+def test_put_hr_transactional_csv(fake_minio):
+    rng = numpy.random.default_rng(7)
+    status_dates = [str(status_date) for status_date in pandas.bdate_range("2021-03-01", "2021-03-12").date]
+
+    # The history gets seeded from the CSV that was published before there was one
+    seed_df = pandas.concat([get_status_df(rng, status_date) for status_date in status_dates[:5]])
+    fake_minio.objects[CSV_KEY] = seed_df.to_csv(index=False).encode()
+    changed_hr_df = hr_data_munge.upsert_hr_history(get_status_df(rng, status_dates[5]), "access", "secret")
+    assert set(hr_data_munge.get_status_dates(changed_hr_df)) == set(status_dates[:6])
+    hr_data_munge.put_hr_transactional_csv(changed_hr_df, "access", "secret")
+    assert_csv_matches_history(fake_minio)
+
+    # Later statuses on an earlier date, as well as a couple of new dates, across several upserts
+    changed_hr_df = pandas.DataFrame(columns=hr_data_munge.HR_HISTORY_COLUMNS)
+    latest_status_df = get_status_df(rng, status_dates[7])
+    for status_df in (get_status_df(rng, status_dates[2], staff_count=5, time="17:00:00"),
+                      get_status_df(rng, status_dates[6]),
+                      get_status_df(rng, status_dates[6], staff_count=5, time="17:00:00"),
+                      latest_status_df):
+        changed_hr_df = hr_data_munge.replace_history_partitions(
+            changed_hr_df, hr_data_munge.upsert_hr_history(status_df, "access", "secret")
+        )
+    assert set(hr_data_munge.get_status_dates(changed_hr_df)) == {status_dates[2], status_dates[6], status_dates[7]}
+    hr_data_munge.put_hr_transactional_csv(changed_hr_df, "access", "secret")
+    assert_csv_matches_history(fake_minio)
+
+    # Statuses that are already in the history don't change anything, so the CSV isn't written again
+    published_csv = fake_minio.objects.pop(CSV_KEY)
+    changed_hr_df = hr_data_munge.upsert_hr_history(latest_status_df, "access", "secret")
+    assert changed_hr_df.empty
+    hr_data_munge.put_hr_transactional_csv(changed_hr_df, "access", "secret")
+    assert CSV_KEY not in fake_minio.objects
+    fake_minio.objects[CSV_KEY] = published_csv
@@ -0,0 +1,169 @@
+import copy
+
+import numpy
+import pandas
+import pytest
+
+hr_data_munge = pytest.importorskip("hr_data_munge")
+hr_data_org_unit_munge = pytest.importorskip("hr_data_org_unit_munge")
+
+BUCKET = hr_data_org_unit_munge.BUCKET
+STAFF_COUNT = 40
+ORG_UNITS = pandas.DataFrame({
+    hr_data_org_unit_munge.HR_ORG_UNIT: [1, 2, 3, 4],
+    **{col: [f"{col} {i}" for i in range(4)] for col in hr_data_org_unit_munge.HR_ORG_UNIT_COLUMNS},
+})
+# Some of the org units only go down so far, which the outputs fill in with "N/A"
+ORG_UNITS.loc[2:, ["Section", "Division", "Div Sub Area", "Unit", "Subunit"]] = None
+STATUSES = ["At work", "Working from Home", "Off-Site", "Sick"]
+
+
+def get_master_df(org_units):
+    return pandas.DataFrame({
+        hr_data_org_unit_munge.HR_STAFFNUMBER: range(1000, 1000 + len(org_units)),
+        hr_data_org_unit_munge.HR_STAFF_ORG_UNIT: org_units,
+        hr_data_org_unit_munge.HR_LOCATION: [f"POINT ({i % 3} {i % 5})" for i in range(len(org_units))],
+    })
+
+
+def get_status_df(rng, status_date, statuses=STATUSES, staff_count=STAFF_COUNT):
+    staff_numbers = rng.choice(STAFF_COUNT, size=staff_count, replace=False) + 1000
+    return pandas.DataFrame({
+        hr_data_munge.HR_MASTER_STAFFNUMBER: staff_numbers.astype(str),
+        hr_data_munge.HR_STATUS: rng.choice(statuses, size=staff_count),
+        hr_data_munge.HR_TRANSACTION_DATE: f"{status_date}T08:00:00",
+        hr_data_munge.HR_UNIT_EVALUATION: rng.choice(["Critical", "Non-critical", None], size=staff_count),
+        hr_data_munge.HR_APPROVER: "Someone",
+        hr_data_munge.HR_APPROVER_STAFFNUMBER: "999",
+    })[hr_data_munge.HR_HISTORY_COLUMNS]
+
+
+def put_csv(fake_minio, df, filename):
+    fake_minio.objects[(BUCKET, filename)] = df.to_csv(index=False).encode()
+
+
+def get_outputs(fake_minio):
+    return [fake_minio.objects[(BUCKET, f"{prefix}.csv")]
+            for prefix in (hr_data_org_unit_munge.HR_ORG_UNIT_STATUSES,
+                           hr_data_org_unit_munge.HR_ORG_UNIT_SMOOTHED_STATUSES)]
+
+
+def assert_matches_full_rebuild(fake_minio):
+    incremental_outputs = get_outputs(fake_minio)
+
+    # Rebuilding everything from the same sources, and then putting the incremental state of affairs back
+    objects = copy.deepcopy(fake_minio.objects)
+    hr_data_org_unit_munge.update_org_unit_outputs("access", "secret", full_rebuild=True)
+    full_rebuild_outputs = get_outputs(fake_minio)
+    fake_minio.objects = objects
+
+    for incremental_output, full_rebuild_output in zip(incremental_outputs, full_rebuild_outputs):
+        assert incremental_output == full_rebuild_output
+        assert b"N/A" in incremental_output
+
+    return incremental_outputs
+
+
+@pytest.fixture
+def history_start_dates(monkeypatch):
+    # The start dates that the people status history gets read from, None being all of it
+    start_dates = []
+    get_hr_history_df = hr_data_munge.get_hr_history_df
+
+    def recording_get_hr_history_df(minio_access, minio_secret, start_date=None, end_date=None):
+        start_dates.append(start_date)
+        return get_hr_history_df(minio_access, minio_secret, start_date, end_date)
+
+    monkeypatch.setattr(hr_data_munge, "get_hr_history_df", recording_get_hr_history_df)
+
+    return start_dates
+
+
+def update_org_unit_outputs(history_start_dates):
+    history_start_dates.clear()
+    hr_data_org_unit_munge.update_org_unit_outputs("access", "secret")
+
+    return list(history_start_dates)
+
+
+def test_incremental_outputs_match_full_rebuild(fake_minio, history_start_dates):
+    rng = numpy.random.default_rng(42)
+    # Business days in March 2021, which includes the Human Rights Day public holiday
+    status_dates = [str(status_date) for status_date in pandas.bdate_range("2021-03-01", "2021-03-31").date]
+
+    org_units = list(rng.integers(1, 5, size=STAFF_COUNT))
+    put_csv(fake_minio, get_master_df(org_units), hr_data_org_unit_munge.HR_MASTER_FILENAME_PATH)
+    put_csv(fake_minio, ORG_UNITS, hr_data_org_unit_munge.HR_ORG_UNIT_MASTER_PATH)
+    hr_data_munge.put_hr_history_partitions(
+        pandas.concat([get_status_df(rng, status_date, staff_count=30) for status_date in status_dates[:15]]),
+        "access", "secret"
+    )
+    hr_data_org_unit_munge.update_org_unit_outputs("access", "secret")
+    assert_matches_full_rebuild(fake_minio)
+
+    # New status dates
+    for status_date in status_dates[15:18]:
+        hr_data_munge.upsert_hr_history(get_status_df(rng, status_date), "access", "secret")
+    hr_data_org_unit_munge.update_org_unit_outputs("access", "secret")
+    assert_matches_full_rebuild(fake_minio)
+
+    # Changes to an earlier date, which has to be smoothed forward again
+    hr_data_munge.upsert_hr_history(get_status_df(rng, status_dates[10]).assign(**{
+        hr_data_munge.HR_TRANSACTION_DATE: f"{status_dates[10]}T17:00:00"
+    }), "access", "secret")
+    hr_data_org_unit_munge.update_org_unit_outputs("access", "secret")
+    assert_matches_full_rebuild(fake_minio)
+
+    # A status that hasn't been seen before
+    hr_data_munge.upsert_hr_history(get_status_df(rng, status_dates[18], statuses=["Quarantined"]), "access", "secret")
+    hr_data_org_unit_munge.update_org_unit_outputs("access", "secret")
+    assert_matches_full_rebuild(fake_minio)
+
+    # Nothing has changed, so the outputs stay as they are
+    outputs = get_outputs(fake_minio)
+    hr_data_org_unit_munge.update_org_unit_outputs("access", "secret")
+    assert get_outputs(fake_minio) == outputs
+
+    # A new hire, who doesn't have any statuses yet, so nothing needs recomputing
+    org_units += [1]
+    put_csv(fake_minio, get_master_df(org_units), hr_data_org_unit_munge.HR_MASTER_FILENAME_PATH)
+    assert update_org_unit_outputs(history_start_dates) == []
+    assert get_outputs(fake_minio) == outputs
+
+    # ...who then has statuses on the latest few dates
+    new_hire_df = get_status_df(rng, status_dates[16], staff_count=1).assign(**{
+        hr_data_munge.HR_MASTER_STAFFNUMBER: str(1000 + STAFF_COUNT)
+    })
+    for status_date in status_dates[16:19]:
+        hr_data_munge.upsert_hr_history(new_hire_df.assign(**{
+            hr_data_munge.HR_TRANSACTION_DATE: f"{status_date}T09:00:00"
+        }), "access", "secret")
+    update_org_unit_outputs(history_start_dates)
+    outputs = assert_matches_full_rebuild(fake_minio)
+
+    # ...and then moves org unit, which isn't in the people status history at all, so only the dates that they have
+    # statuses on (and the ones that those are smoothed onto) are recomputed
+    org_units[-1] = 3
+    put_csv(fake_minio, get_master_df(org_units), hr_data_org_unit_munge.HR_MASTER_FILENAME_PATH)
+    assert update_org_unit_outputs(history_start_dates) == [
+        hr_data_org_unit_munge.get_smoothing_start_date(status_dates[16])
+    ]
+    assert assert_matches_full_rebuild(fake_minio) != outputs
+
+    # The same goes for a staff member whose statuses go back further than the previous runs have read
+    history_df = hr_data_munge.get_hr_history_df("access", "secret")
+    first_status_date = min(hr_data_munge.get_status_dates(
+        history_df[history_df[hr_data_munge.HR_MASTER_STAFFNUMBER] == "1000"]
+    ))
+    org_units[0] = org_units[0] % 4 + 1
+    put_csv(fake_minio, get_master_df(org_units), hr_data_org_unit_munge.HR_MASTER_FILENAME_PATH)
+    assert update_org_unit_outputs(history_start_dates) == [
+        hr_data_org_unit_munge.get_smoothing_start_date(first_status_date)
+    ]
+    assert_matches_full_rebuild(fake_minio)
+
+    # Changes to the org unit hierarchy mean rebuilding everything
+    put_csv(fake_minio, ORG_UNITS.replace({"Directorate 1": "Directorate 1 (renamed)"}),
+            hr_data_org_unit_munge.HR_ORG_UNIT_MASTER_PATH)
+    assert update_org_unit_outputs(history_start_dates) == [None]
+    assert b"Directorate 1 (renamed)" in assert_matches_full_rebuild(fake_minio)[0]
@@ -0,0 +1,86 @@
+import numpy
+import pandas
+import pytest
+
+service_delivery_metrics_munge = pytest.importorskip("service_delivery_metrics_munge")
+LINEAR_MEASURES = service_delivery_metrics_munge.service_delivery_fact_snapshot_to_minio.LINEAR_MEASURES
+
+INDEX_COLS = service_delivery_metrics_munge.INDEX_COLS
+DATE_COL = service_delivery_metrics_munge.DATE_COL
+STATE_NAME = "test_metrics"
+GROUPS = [(f"Directorate {i % 2}", f"Department {i % 3}", f"Code {i}") for i in range(6)]
+
+
+def get_facts_df(rng, groups, dates):
+    facts_df = pandas.DataFrame(
+        [(*group, date) for group in groups for date in dates if rng.random() < 0.7],
+        columns=INDEX_COLS + [DATE_COL]
+    )
+    for measure in LINEAR_MEASURES:
+        facts_df[measure] = rng.integers(0, 20, size=facts_df.shape[0]).astype(float)
+
+    return facts_df
+
+
+def get_pivot_df(facts_df, start_date=None):
+    # Standing in for get_pivot_dataframe, which only reads the facts from the start date onwards
+    pivot_df = facts_df.groupby(INDEX_COLS + [DATE_COL])[LINEAR_MEASURES].sum()
+    pivot_df.columns.name = service_delivery_metrics_munge.MEASURE
+    if start_date is not None:
+        pivot_df = pivot_df[pivot_df.index.get_level_values(DATE_COL) >= start_date]
+
+    return pivot_df[sorted(pivot_df.columns)].sort_values(DATE_COL)
+
+
+def update_metrics(facts_df):
+    state_df = service_delivery_metrics_munge.get_incremental_state(STATE_NAME, "access", "secret")
+    window_start = service_delivery_metrics_munge.get_window_start(state_df) if state_df is not None else None
+    latest_df = service_delivery_metrics_munge.calculate_latest_metrics(get_pivot_df(facts_df, window_start),
+                                                                        INDEX_COLS, state_df)
+    service_delivery_metrics_munge.put_incremental_state(latest_df, STATE_NAME, "access", "secret")
+
+    return latest_df
+
+
+def assert_matches_full_rebuild(latest_df, facts_df):
+    full_rebuild_df = service_delivery_metrics_munge.calculate_latest_metrics(get_pivot_df(facts_df), INDEX_COLS)
+
+    pandas.testing.assert_frame_equal(latest_df[sorted(latest_df.columns)],
+                                      full_rebuild_df[sorted(full_rebuild_df.columns)],
+                                      check_dtype=False)
+
+
+def test_incremental_metrics_match_full_rebuild(fake_minio):
+    rng = numpy.random.default_rng(27)
+    dates = pandas.date_range("2020-09-01", "2021-06-30", freq="D")
+
+    facts_df = get_facts_df(rng, GROUPS, dates[:-30])
+    latest_df = update_metrics(facts_df)
+    assert_matches_full_rebuild(latest_df, facts_df)
+
+    # New dates for most of the groups
+    facts_df = pandas.concat([facts_df, get_facts_df(rng, GROUPS[:-1], dates[-30:-20])])
+    latest_df = update_metrics(facts_df)
+    assert_matches_full_rebuild(latest_df, facts_df)
+
+    # Late facts, in the rolling window before the watermark, for the group that hasn't had anything newer
+    watermark = latest_df[service_delivery_metrics_munge.WATERMARK].max()
+    late_dates = pandas.date_range(watermark - pandas.Timedelta("150D"), watermark - pandas.Timedelta("5D"), freq="7D")
+    late_facts_df = get_facts_df(rng, GROUPS[-1:], late_dates)
+    assert not late_facts_df.empty
+    facts_df = pandas.concat([facts_df, late_facts_df])
+    prev_latest_df = latest_df
+    latest_df = update_metrics(facts_df)
+    assert_matches_full_rebuild(latest_df, facts_df)
+    assert (latest_df[service_delivery_metrics_munge.TOTAL_OPEN].iloc[-1] >
+            prev_latest_df[service_delivery_metrics_munge.TOTAL_OPEN].iloc[-1])
+
+    # ...as well as alongside newer dates, which moves the window along
+    facts_df = pandas.concat([facts_df,
+                              get_facts_df(rng, GROUPS[:1], dates[-20:]),
+                              get_facts_df(rng, GROUPS[2:4], dates[-60:-50])])
+    latest_df = update_metrics(facts_df)
+    assert_matches_full_rebuild(latest_df, facts_df)
+
+    # Nothing new leaves everything as it was
+    pandas.testing.assert_frame_equal(update_metrics(facts_df), latest_df)
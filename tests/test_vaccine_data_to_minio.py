@@ -0,0 +1,138 @@
+import datetime
+
+import pandas
+import pytest
+
+pytest.importorskip("lxml")
+pytest.importorskip("requests_ntlm")
+shareplum = pytest.importorskip("shareplum")
+vaccine_data_to_minio = pytest.importorskip("vaccine_data_to_minio")
+
+import mock_sharepoint  # noqa: E402
+
+LIST_NAME = vaccine_data_to_minio.SP_VACCINE_REGISTER
+LIST_BACKUP_PREFIX = vaccine_data_to_minio.VACC_LIST_BAK
+ITEM_COUNT = 2500
+
+
+def get_register_row(i, version):
+    return {"Staff_x0020_member": f"{i};#staff {i % 1000}",
+            "Vaccination_x0020_date": f"2021-{3 + i % 6:02d}-{1 + i % 28:02d} 00:00:00",
+            "Title": f"item {i} v{version}"}
+
+
+@pytest.fixture
+def sp_site(monkeypatch):
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setenv("no_proxy", "127.0.0.1")
+    monkeypatch.setattr(mock_sharepoint.State, "lists", {
+        LIST_NAME: mock_sharepoint.MockList(LIST_NAME,
+                                            [("Staff_x0020_member", "Staff member", "Lookup"),
+                                             ("Vaccination_x0020_date", "Vaccination date", "DateTime")],
+                                            get_register_row, ITEM_COUNT)
+    })
+    monkeypatch.setattr(mock_sharepoint.State, "requests", [])
+
+    server = mock_sharepoint.serve()
+    sp_domain = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(vaccine_data_to_minio, "SP_DOMAIN", sp_domain)
+
+    yield shareplum.Site(f"{sp_domain}{vaccine_data_to_minio.SP_SITE}", version=shareplum.site.Version.v2007)
+
+    server.shutdown()
+
+
+def get_list_df(sp_site, full_rebuild=False):
+    mock_sharepoint.State.requests.clear()
+    return vaccine_data_to_minio.list_to_full_df(sp_site, LIST_NAME, LIST_BACKUP_PREFIX,
+                                                 vaccine_data_to_minio.EDGE_CLASSIFICATION,
+                                                 full_rebuild=full_rebuild)
+
+
+def get_items_fetched():
+    return sum(item_count for *_, item_count in mock_sharepoint.State.requests)
+
+
+def assert_matches_full_pull(list_df, sp_site, fake_minio):
+    # Pulling the whole list into an empty store, and then putting the incremental state of affairs back
+    objects = fake_minio.objects
+    fake_minio.objects = {}
+    full_df = get_list_df(sp_site)
+    fake_minio.objects = objects
+
+    compare_cols = sorted(set(full_df.columns) - {vaccine_data_to_minio.ACCESS_COL_NAME, "index"})
+    pandas.testing.assert_frame_equal(
+        list_df[compare_cols].sort_values(vaccine_data_to_minio.ID_COL_NAME, ignore_index=True),
+        full_df[compare_cols].sort_values(vaccine_data_to_minio.ID_COL_NAME, ignore_index=True),
+    )
+    assert list_df.shape[0] == len(mock_sharepoint.State.lists[LIST_NAME].items)
+
+
+def get_items_since(modified_date):
+    # CAML only compares the dates of the modified times
+    return sum(item["Modified"][:10] >= modified_date[:10]
+               for item in mock_sharepoint.State.lists[LIST_NAME].items.values())
+
+
+def get_watermark():
+    return max(item["Modified"] for item in mock_sharepoint.State.lists[LIST_NAME].items.values())
+
+
+def modify_items(item_ids, modified):
+    for item_id in item_ids:
+        mock_sharepoint.State.lists[LIST_NAME].modify(item_id, modified)
+
+
+def test_list_to_full_df_incremental(sp_site, fake_minio):
+    sp_list = mock_sharepoint.State.lists[LIST_NAME]
+
+    # Nothing backed up yet, so everything is fetched in one go
+    list_df = get_list_df(sp_site)
+    assert mock_sharepoint.State.requests == [(LIST_NAME, False, ITEM_COUNT)]
+    assert_matches_full_pull(list_df, sp_site, fake_minio)
+
+    # A day's worth of changes and additions, which fit in a single page, along with the items from the watermark's day
+    watermark = get_watermark()
+    modified = datetime.datetime(2021, 9, 1, 9, 0, 0)
+    modify_items(range(1, ITEM_COUNT, 50), modified)
+    sp_list.add(modified)
+    expected_items = get_items_since(watermark)
+    assert expected_items < vaccine_data_to_minio.XML_PAGE_SIZE
+    list_df = get_list_df(sp_site)
+    assert mock_sharepoint.State.requests == [(LIST_NAME, True, expected_items)]
+    assert_matches_full_pull(list_df, sp_site, fake_minio)
+
+    # An empty delta only fetches the items that share the watermark's date again, and changes nothing
+    empty_delta_df = get_list_df(sp_site)
+    assert mock_sharepoint.State.requests == [(LIST_NAME, True, get_items_since(get_watermark()))]
+    pandas.testing.assert_frame_equal(empty_delta_df.drop(columns=vaccine_data_to_minio.ACCESS_COL_NAME),
+                                      list_df.drop(columns=vaccine_data_to_minio.ACCESS_COL_NAME))
+
+    # Changes spanning several pages, modified a few days after the watermark
+    watermark = get_watermark()
+    modified += datetime.timedelta(days=3)
+    modify_items(range(1, ITEM_COUNT - 100), modified)
+    expected_items = get_items_since(watermark)
+    assert expected_items > 2 * vaccine_data_to_minio.XML_PAGE_SIZE
+    list_df = get_list_df(sp_site)
+    page_sizes = [item_count for *_, item_count in mock_sharepoint.State.requests]
+    assert page_sizes[:-1] == [vaccine_data_to_minio.XML_PAGE_SIZE] * 2
+    assert 0 < page_sizes[-1] < vaccine_data_to_minio.XML_PAGE_SIZE
+    assert get_items_fetched() == expected_items
+    assert_matches_full_pull(list_df, sp_site, fake_minio)
+
+    # A full rebuild fetches everything again, and comes out the same
+    full_rebuild_df = get_list_df(sp_site, full_rebuild=True)
+    assert mock_sharepoint.State.requests == [(LIST_NAME, False, ITEM_COUNT + 1)]
+    assert_matches_full_pull(full_rebuild_df, sp_site, fake_minio)
+
+
+def test_get_backup_snapshot_df_fetch_failure(fake_minio, monkeypatch):
+    snapshot_prefix = vaccine_data_to_minio.get_backup_snapshot_prefix(LIST_BACKUP_PREFIX)
+    fake_minio.objects[(vaccine_data_to_minio.COVID_BUCKET, f"{snapshot_prefix}.parquet")] = b""
+    monkeypatch.setattr(vaccine_data_to_minio.minio_utils, "minio_to_file", lambda *args, **kwargs: False)
+
+    # A snapshot that's there but can't be fetched mustn't be mistaken for an empty one
+    with pytest.raises(SystemExit):
+        vaccine_data_to_minio.get_backup_snapshot_df(vaccine_data_to_minio.COVID_BUCKET, snapshot_prefix,
+                                                     vaccine_data_to_minio.EDGE_CLASSIFICATION)
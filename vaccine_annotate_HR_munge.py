@@ -4,7 +4,6 @@ Script to aggregate on the staff vaccination register
 
 # base imports
 from datetime import datetime
-from collections import defaultdict
 import json
 import logging
 import os
@@ -17,8 +16,9 @@ import pandas as pd
 # local imports
 from vaccine_data_to_minio import (COVID_BUCKET, EDGE_CLASSIFICATION, VACCINE_PREFIX_RAW, VAX_MERGE_STR, CREATED_DATE,
                                    VAX_DATE, RAW_VAX_REGISTER_PREFIX)
-from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, STAFF_NO, EMPTY_VAX_MERGE_STR, NULL_MERGE_VAL, ID_COL_NAME,
-                                      HR_MASTER_DATA, minio_to_df, CSV_READER, PARQUET_READER, HR_KEEP_COLS)
+from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, STAFF_NO, STAFF_KEY, EMPTY_VAX_MERGE_STR, NULL_MERGE_VAL,
+                                      ID_COL_NAME, HR_MASTER_DATA, minio_to_df, CSV_READER, PARQUET_READER, HR_KEEP_COLS,
+                                      add_staff_key)
 
 # input settings
 CITY_VAX_REGISTER = f"{RAW_VAX_REGISTER_PREFIX}.parquet"
@@ -45,79 +45,63 @@ HR_KEEP_COLS_EXTRA = HR_KEEP_COLS + [EMPLOYEE_NAME]
 VAX_KEEP_COLS = [
     VAX_DATE, VAX_TYPE, DOSE_NO, SIDE_EFFECT, CREATED_BY, CREATED_DATE, ACCESS_COL_NAME, VAX_MERGE_STR, ID_COL_NAME
 ]
+HR_MASTER_READ_COLS = HR_KEEP_COLS_EXTRA + [STAFF_KEY]
+# the raw register is sorted by vaccination date, so that the date filter can skip whole row groups
+VAX_DATE_READ_FILTERS = [(VAX_DATE, ">=", START_DATE_FILT), (VAX_DATE, "<=", TODAY)]
+VALIDATION_ERRORS = [
+    "multiple vaccine types detected for person no {staff}",
+    "multiple doses for J&J, expected only one dose",
+    "2nd Dose recorded without 1st Dose",
+]
 
 
 def validate_vaccines(vacc_df):
-    vacc_df[STAFF_NO].replace("NA", np.nan, inplace=True)
-    vacc_df[STAFF_NO].replace("nan", np.nan, inplace=True)
-    personno = vacc_df[STAFF_NO].to_list()
-    vacc_type = vacc_df[VAX_TYPE].to_list()
-    dose_no = vacc_df[DOSE_NO].to_list()
-
-    dose_validateion_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-
-    for (staffno, vacc_ty, dose) in zip(personno, vacc_type, dose_no):
-        dose_validateion_dict[staffno][vacc_ty][dose] += 1
-
-    duplicate_staff_dose = []
-    for staff, vacc_type_dict in dose_validateion_dict.items():
-        if len(vacc_type_dict) > 1:
-            logging.error(f"multiple vaccine types detected for person no {staff}")
-            sys.exit(-1)
-        for vacc_type, dose_dict in vacc_type_dict.items():
-            if vacc_type == J_AND_J_VACC and len(dose_dict) > 1:
-                logging.error(f"multiple doses for J&J, expected only one dose")
-                sys.exit(-1)
-            for dose, count in dose_dict.items():
-                if count > 1 and pd.isna(staff):
-                    logging.warning(f"{count} counts for {vacc_type} dose {dose} with no staff ID")
-                elif count > 1 and pd.notna(staff):
-                    logging.warning(f"multiple entries ({count}) for the same dose ({dose}) for StaffNo {staff}")
-                    duplicate_staff_dose.append(staff)
-
-                if dose == "2nd Dose" and "1st Dose" not in dose_dict.keys():
-                    logging.error(f"2nd Dose recorded without 1st Dose")
-                    sys.exit(-1)
-
-    return duplicate_staff_dose
-
-
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+    vacc_df[STAFF_NO] = vacc_df[STAFF_NO].replace(["NA", "nan"], np.nan)
 
-    # secrets env
-    SECRETS_PATH_VAR = "SECRETS_PATH"
-
-    # Loading secrets
-    logging.info("Fetch[ing] secrets")
-    if SECRETS_PATH_VAR not in os.environ:
-        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+    # counts per staff member, vaccine type and dose, ordered by when the staff member first appears
+    dose_counts = vacc_df.groupby([STAFF_NO, VAX_TYPE, DOSE_NO], dropna=False, sort=False).size().reset_index(
+        name="count"
+    )
+    dose_counts["staff_order"] = dose_counts.groupby(STAFF_NO, dropna=False, sort=False).ngroup()
+    dose_counts = dose_counts.sort_values("staff_order", kind="stable", ignore_index=True)
+
+    staff_types = dose_counts.groupby("staff_order")[VAX_TYPE].transform("nunique", dropna=False)
+    staff_type_groups = [dose_counts["staff_order"], dose_counts[VAX_TYPE]]
+    staff_type_doses = dose_counts.groupby(staff_type_groups, dropna=False)[DOSE_NO].transform("size")
+    has_first_dose = (dose_counts[DOSE_NO] == "1st Dose").groupby(staff_type_groups, dropna=False).transform("any")
+
+    # the rules, in the order that they are checked for each staff member
+    violated_rule = np.select(
+        [staff_types > 1,
+         (dose_counts[VAX_TYPE] == J_AND_J_VACC) & (staff_type_doses > 1),
+         (dose_counts[DOSE_NO] == "2nd Dose") & ~has_first_dose],
+        range(len(VALIDATION_ERRORS)),
+        default=-1
+    )
+    if (violated_rule >= 0).any():
+        violations_df = dose_counts.assign(rule=violated_rule)[violated_rule >= 0].sort_values(
+            ["staff_order", "rule"], kind="stable"
+        )
+        # separately, as a row across both columns gets upcast to the staff number's float dtype
+        staff = violations_df[STAFF_NO].iloc[0]
+        rule = int(violations_df["rule"].iloc[0])
+        logging.error(VALIDATION_ERRORS[rule].format(staff=staff))
         sys.exit(-1)
 
-    secrets_path = os.environ[SECRETS_PATH_VAR]
-    secrets = json.load(open(secrets_path))
-    logging.info("Fetch[ed] secrets")
+    duplicate_counts = dose_counts[dose_counts["count"] > 1]
+    for staff, vacc_type, dose, count in duplicate_counts[[STAFF_NO, VAX_TYPE, DOSE_NO, "count"]].itertuples(
+            index=False):
+        if pd.isna(staff):
+            logging.warning(f"{count} counts for {vacc_type} dose {dose} with no staff ID")
+        else:
+            logging.warning(f"multiple entries ({count}) for the same dose ({dose}) for StaffNo {staff}")
 
-    # ----------------------------------
-    logging.info("Fetch[ing] source dataframes")
-    vax_register_dfs = []
-    for (filename_override, reader) in [
-        (f"{VACCINE_PREFIX_RAW}{CITY_VAX_REGISTER}", PARQUET_READER),
-        (HR_MASTER_DATA, CSV_READER)
-    ]:
-        df = minio_to_df(
-            minio_filename_override=filename_override,
-            minio_bucket=COVID_BUCKET,
-            data_classification=EDGE_CLASSIFICATION,
-            reader=reader
-        )
-        vax_register_dfs.append(df)
+    duplicate_staff_dose = duplicate_counts[STAFF_NO].dropna().to_list()
 
-    # unpack dataframes
-    staff_vaccine_register_df_fixed, staff_list_df = vax_register_dfs
-    logging.info("Fetch[ed] source dataframes")
+    return duplicate_staff_dose
 
+
+def annotate_register_hr(staff_vaccine_register_df_fixed, staff_list_df):
     # process vaccine register
     # drop empty rows
     logging.info(f"Dropp[ing] empty rows")
@@ -136,22 +120,15 @@ if __name__ == "__main__":
     staff_vaccine_register_df_cols_filt = staff_vaccine_register_df_fixed_filt[VAX_KEEP_COLS].copy()
     logging.info(f"Filter[ed] to selected columns")
 
-    # remove wrong dates
+    # remove wrong dates - the readers already drop these with VAX_DATE_READ_FILTERS, so this is only a safeguard
     logging.info("Dropp[ing] bad dates")
     staff_vaccine_register_df_date_filt = staff_vaccine_register_df_cols_filt.query(
         f"@START_DATE_FILT <= `{VAX_DATE}` <= @TODAY").copy()
     if staff_vaccine_register_df_date_filt.empty:
         logging.error("Empty dataframe for vaccine register after date filter")
         sys.exit(-1)
-
-    bad_dates = sorted(
-        staff_vaccine_register_df_cols_filt.query(f"`{VAX_DATE}` < @START_DATE_FILT or `{VAX_DATE}` > @TODAY")[
-            VAX_DATE].unique())
-    logging.warning(
-        f"{len(staff_vaccine_register_df_cols_filt) - len(staff_vaccine_register_df_date_filt)} "
-        f"rows dropped as out of date range")
-    logging.warning(f"Bad dates identified {bad_dates}\n{len(staff_vaccine_register_df_date_filt)} records remaining")
-    logging.info("Dropp[ing] bad dates")
+    logging.info(f"{len(staff_vaccine_register_df_date_filt)} records remaining")
+    logging.info("Dropp[ed] bad dates")
 
     # dedup
     logging.info(f"Filter[ing] out duplicate staff entries")
@@ -173,21 +150,20 @@ if __name__ == "__main__":
     )
     logging.info("Extract[ed] staff number from vaccine register")
 
-    # convert both dfs staff no col to str for merge
-    logging.info("Convert[ing] staff number to str for merge")
-    staff_vaccine_register_df_date_filt_unique[STAFF_NO] = staff_vaccine_register_df_date_filt_unique[STAFF_NO].astype(
-        str)
-    staff_list_df[STAFF_NO] = staff_list_df[STAFF_NO].astype(str)
-    logging.info("Convert[ed] staff number to str for merge")
+    # add the staff keys to merge on
+    logging.info("Add[ing] staff keys for merge")
+    staff_vaccine_register_df_date_filt_unique = add_staff_key(staff_vaccine_register_df_date_filt_unique, STAFF_NO)
+    staff_list_df = add_staff_key(staff_list_df, STAFF_NO)
+    logging.info("Add[ed] staff keys for merge")
 
     # ----------------------------------
-    # annotate vaccine register with staff details
+    # annotate vaccine register with staff details, keeping the register's staff numbers
     logging.info(f"Merg[ing] Staff annotations onto vaccine register")
     register_annotated = pd.merge(
-        staff_list_df[HR_KEEP_COLS_EXTRA],
+        staff_list_df.loc[staff_list_df[STAFF_KEY].notna(), [STAFF_KEY] + HR_KEEP_COLS_EXTRA].drop(columns=[STAFF_NO]),
         staff_vaccine_register_df_date_filt_unique,
         how="right",
-        on=STAFF_NO,
+        on=STAFF_KEY,
         validate="1:m"
     )
     logging.info(f"Merg[ed] Staff annotations onto vaccine register")
@@ -211,6 +187,49 @@ if __name__ == "__main__":
         register_annotated_cln = register_annotated.copy()
     logging.info("Validat[ed] vaccination entries")
 
+    return register_annotated_cln
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+
+    # secrets env
+    SECRETS_PATH_VAR = "SECRETS_PATH"
+
+    # Loading secrets
+    logging.info("Fetch[ing] secrets")
+    if SECRETS_PATH_VAR not in os.environ:
+        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+        sys.exit(-1)
+
+    secrets_path = os.environ[SECRETS_PATH_VAR]
+    secrets = json.load(open(secrets_path))
+    logging.info("Fetch[ed] secrets")
+
+    # ----------------------------------
+    logging.info("Fetch[ing] source dataframes")
+    vax_register_dfs = []
+    for (filename_override, reader, columns, filters) in [
+        (f"{VACCINE_PREFIX_RAW}{CITY_VAX_REGISTER}", PARQUET_READER, VAX_KEEP_COLS, VAX_DATE_READ_FILTERS),
+        (HR_MASTER_DATA, CSV_READER, HR_MASTER_READ_COLS, None)
+    ]:
+        df = minio_to_df(
+            minio_filename_override=filename_override,
+            minio_bucket=COVID_BUCKET,
+            data_classification=EDGE_CLASSIFICATION,
+            reader=reader,
+            columns=columns,
+            filters=filters
+        )
+        vax_register_dfs.append(df)
+
+    # unpack dataframes
+    staff_vaccine_register_df_fixed, staff_list_df = vax_register_dfs
+    logging.info("Fetch[ed] source dataframes")
+
+    register_annotated_cln = annotate_register_hr(staff_vaccine_register_df_fixed, staff_list_df)
+
     # ----------------------------------
     logging.info(f"Push[ing] data to mino")
     minio_utils.dataframe_to_minio(
@@ -13,7 +13,8 @@ import pandas as pd
 # local imports
 from vaccine_data_to_minio import COVID_BUCKET, EDGE_CLASSIFICATION, STAFF_MERGE_STR, VAX_MERGE_STR
 from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, UNIQUE_STAFF_LIST, FIX_HR_ATRIBUTE_COLS, HR_DATA_TAG,
-                                      STAFF_LIST_TAG, STAFF_NO, minio_to_df, PARQUET_READER, fix_attribute_cols)
+                                      STAFF_LIST_TAG, STAFF_NO, STAFF_KEY, MERGE_CODE, minio_to_df, PARQUET_READER,
+                                      fix_attribute_cols, get_merge_codes, get_staff_keys)
 from vaccine_annotate_HR_munge import VACCINE_REGISTER_ANNOTATED_HR
 
 # input settings
@@ -24,6 +25,34 @@ CITY_VAX_REGISTER = f"{VACCINE_REGISTER_ANNOTATED_HR}.parquet"
 VACCINE_REGISTER_ANNOT_NON_STAFF = "staff-vaccination-register-annotated-plus-non-staff"
 
 
+def annotate_register_non_hr(staff_vaccine_register_df, staff_list_df):
+    # ----------------------------------
+    # annotate vaccine register with staff details
+    logging.info(f"Merg[ing] Staff annotations onto vaccine register")
+    staff_merge_codes, vax_merge_codes = get_merge_codes(staff_list_df[STAFF_MERGE_STR],
+                                                         staff_vaccine_register_df[VAX_MERGE_STR])
+    register_annotated = pd.merge(
+        staff_list_df.drop(columns=[STAFF_KEY], errors="ignore").assign(**{MERGE_CODE: staff_merge_codes}),
+        staff_vaccine_register_df.assign(**{MERGE_CODE: vax_merge_codes}),
+        how="right",
+        on=MERGE_CODE,
+        suffixes=[STAFF_LIST_TAG, HR_DATA_TAG],
+        validate="1:m"
+    ).drop(columns=[MERGE_CODE])
+    logging.info(f"Merg[ed] Staff annotations onto vaccine register")
+
+    # ----------------------------------
+    logging.info("Merg[ing] health staff list attributes where existing ones are null")
+    register_annotated_cleaned = fix_attribute_cols(
+        register_annotated, FIX_HR_ATRIBUTE_COLS + [STAFF_NO], STAFF_LIST_TAG, HR_DATA_TAG
+    )
+    # the staff numbers of non-metro staff come from the staff list, so their keys are only known now
+    register_annotated_cleaned[STAFF_KEY] = get_staff_keys(register_annotated_cleaned[STAFF_NO])
+    logging.info("Merg[ed]health staff list attributes where existing ones are null")
+
+    return register_annotated_cleaned
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
@@ -60,26 +89,7 @@ if __name__ == "__main__":
     staff_vaccine_register_df, staff_list_df = vax_register_dfs
     logging.info("Fetch[ed] source dataframes")
 
-    # ----------------------------------
-    # annotate vaccine register with staff details
-    logging.info(f"Merg[ing] Staff annotations onto vaccine register")
-    register_annotated = pd.merge(
-        staff_list_df,
-        staff_vaccine_register_df,
-        how="right",
-        left_on=STAFF_MERGE_STR,
-        right_on=VAX_MERGE_STR,
-        suffixes=[STAFF_LIST_TAG, HR_DATA_TAG],
-        validate="1:m"
-    )
-    logging.info(f"Merg[ed] Staff annotations onto vaccine register")
-
-    # ----------------------------------
-    logging.info("Merg[ing] health staff list attributes where existing ones are null")
-    register_annotated_cleaned = fix_attribute_cols(
-        register_annotated, FIX_HR_ATRIBUTE_COLS + [STAFF_NO], STAFF_LIST_TAG, HR_DATA_TAG
-    )
-    logging.info("Merg[ed]health staff list attributes where existing ones are null")
+    register_annotated_cleaned = annotate_register_non_hr(staff_vaccine_register_df, staff_list_df)
 
     # ----------------------------------
     logging.info(f"Push[ing] data to mino")
@@ -1,4 +1,6 @@
 # base imports
+import concurrent.futures
+import io
 import json
 import logging
 import os
@@ -24,6 +26,11 @@ VACCIE_BACKUP_PREFIX = "data/private/staff_vaccine/backup/"
 STAFF_LIST_BAK = f"{VACCIE_BACKUP_PREFIX}staff/"
 SEQ_LIST_BAK = f"{VACCIE_BACKUP_PREFIX}sequencing/"
 VACC_LIST_BAK = f"{VACCIE_BACKUP_PREFIX}vaccine/"
+BACKUP_SNAPSHOT_SUFFIX = "_snapshot"
+BACKUP_FETCH_WORKERS = 8
+FULL_REBUILD_VAR = "VACCINE_BACKUP_FULL_REBUILD"
+PARQUET_ROW_GROUP_SIZE = 5000
+XML_PAGE_SIZE = 1000
 
 # sharepoint paths
 SP_DOMAIN = 'http://teamsites.capetown.gov.za'
@@ -45,6 +52,9 @@ ACCESS_COL_NAME = "AccessTimestamp"
 XML_URL_COL_NAME = 'URL Path'
 SOURCE_COL_NAME = "SourceUrl"
 ID_COL_NAME = 'Unique Id'
+XML_ID_COL_NAME = "ID"
+BACKUP_KEY_COL_NAME = "BackupKey"
+BACKUP_JSON_COL_NAME = "BackupJson"
 
 STAFF_MERGE_STR = "concatenated_details"
 STAFF_LIST_EDIT_COLS = [STAFF_MERGE_STR]
@@ -55,6 +65,7 @@ MODIFIED = "Modified"
 CREATED_DATE = "Created"
 VAX_MERGE_STR = "Staff member"
 DATE_COLS = [VAX_DATE, ACCESS_COL_NAME, MODIFIED, CREATED_DATE]
+MODIFIED_JSON_REGEX = re.compile(f'"{MODIFIED}": "([^"]+)"')
 
 
 def minio_json_to_dict(minio_filename_override, minio_bucket, data_classification):
@@ -84,12 +95,47 @@ def minio_json_to_dict(minio_filename_override, minio_bucket, data_classificatio
             return json_dict
 
 
-def get_xml_list_dfs(site, list_name, list_backup_suffix, data_classification):
+def get_xml_list_items(sp_list, modified_since=None, page_size=XML_PAGE_SIZE):
+    """
+    Get all of the list's items, or only those modified since the given time, which are paged through in order of ID
+
+    CAML only compares the date of the modified time, so the items modified earlier on that day come back as well
+    """
+    if modified_since is None:
+        return sp_list.GetListItems()
+
+    xml_list = []
+    last_id = 0
+    while True:
+        # Some shareplum versions turn the where clause into XML in place, so each page needs a new query. The row
+        # limit keyword differs between versions, so it is passed positionally, after the view name and fields.
+        xml_page = sp_list.GetListItems(
+            None, None,
+            {"Where": ["And", ("Geq", MODIFIED, modified_since), ("Gt", XML_ID_COL_NAME, str(last_id))],
+             "OrderBy": [XML_ID_COL_NAME]},
+            page_size
+        )
+        if not isinstance(xml_page, list):
+            logging.error(f"Failed to get the items after ID {last_id}: {xml_page}")
+            sys.exit(-1)
+
+        xml_list += xml_page
+        if len(xml_page) < page_size:
+            return xml_list
+
+        # not every shareplum version passes on the order by, so the next page starts after the largest ID so far
+        last_id = max(int(xml_row[XML_ID_COL_NAME]) for xml_row in xml_page)
+
+
+def get_xml_list_dfs(site, list_name, list_backup_suffix, data_classification, modified_since=None):
     access_timestamp = pandas.Timestamp.now(tz="Africa/Johannesburg")
-    xml_list = site.List(list_name).GetListItems()
+    xml_list = get_xml_list_items(site.List(list_name), modified_since)
     xml_df = pandas.DataFrame(xml_list)
 
-    if xml_df.shape[0] == 0:
+    if xml_df.shape[0] == 0 and modified_since is not None:
+        logging.debug(f"No XML entries modified since {modified_since}, returning None")
+        return None
+    elif xml_df.shape[0] == 0:
         logging.warning(f"XML list is empty, returning None")
         return None
     else:
@@ -144,7 +190,7 @@ def get_xml_list_dfs(site, list_name, list_backup_suffix, data_classification):
 
     logging.info(f"back[ed] up {list_name} to minio")
 
-    return True
+    return xml_df_dict_list
 
 
 def collect_json_blobs(bucket, prefix, data_classification):
@@ -157,30 +203,147 @@ def collect_json_blobs(bucket, prefix, data_classification):
     return bucket_file_list
 
 
-def backup_to_full_df(bucket, prefix, data_classification):
+def get_backup_snapshot_prefix(prefix):
+    return f"{prefix.rstrip('/')}{BACKUP_SNAPSHOT_SUFFIX}"
+
+
+def get_backup_snapshot_df(bucket, snapshot_prefix, data_classification):
+    """Get the snapshot of the json backups, as a dataframe of the backup keys and their json"""
+    snapshot_filename = f"{snapshot_prefix}.parquet"
+    snapshot_files = set(collect_json_blobs(bucket=bucket, prefix=snapshot_filename,
+                                            data_classification=data_classification))
+    if snapshot_filename not in snapshot_files:
+        logging.warning(f"No backup snapshot found at '{snapshot_filename}'")
+        return pandas.DataFrame(columns=[BACKUP_KEY_COL_NAME, BACKUP_JSON_COL_NAME])
+
+    with tempfile.NamedTemporaryFile() as temp_data_file:
+        result = minio_utils.minio_to_file(filename=temp_data_file.name,
+                                           minio_filename_override=snapshot_filename,
+                                           minio_bucket=bucket,
+                                           data_classification=data_classification)
+        if not result:
+            logging.error(f"Could not get backup snapshot '{snapshot_filename}' from minio")
+            sys.exit(-1)
+
+        return pandas.read_parquet(temp_data_file.name)
+
+
+def get_backup_snapshot_watermark(snapshot_df):
+    """The latest modified time of the backed up entries, or None if there aren't any"""
+    modified = pandas.to_datetime(
+        snapshot_df[BACKUP_JSON_COL_NAME].astype(str).str.extract(MODIFIED_JSON_REGEX, expand=False),
+        format=VAX_DATE_FORMAT, errors="coerce"
+    ).max()
+
+    return None if pandas.isna(modified) else modified
+
+
+def backup_to_full_df(bucket, prefix, data_classification, backed_up_rows=None, full_rebuild=False,
+                      fetch_workers=BACKUP_FETCH_WORKERS, snapshot_df=None):
     """
     Get all json backup entries and populate the full dataframe
+
+    Only the entries that aren't in the snapshot (or that were just backed up) are fetched from minio. The snapshot
+    can be passed in, if it has already been fetched.
     """
-    json_blob_list = collect_json_blobs(
+    snapshot_prefix = get_backup_snapshot_prefix(prefix)
+    if full_rebuild:
+        snapshot_df = pandas.DataFrame(columns=[BACKUP_KEY_COL_NAME, BACKUP_JSON_COL_NAME])
+    elif snapshot_df is None:
+        snapshot_df = get_backup_snapshot_df(bucket, snapshot_prefix, data_classification)
+    old_snapshot = dict(zip(snapshot_df[BACKUP_KEY_COL_NAME], snapshot_df[BACKUP_JSON_COL_NAME]))
+    snapshot = old_snapshot.copy()
+
+    # The rows that were just backed up don't need to be read back out again
+    for row_dict in (backed_up_rows or []):
+        snapshot[f"{prefix}{row_dict[ID_COL_NAME]}"] = json.dumps(row_dict)
+
+    json_blob_list = list(collect_json_blobs(
         bucket=bucket,
         prefix=prefix,
         data_classification=data_classification
-    )
+    ))
+
+    new_blob_list = [filename for filename in json_blob_list if filename not in snapshot]
+    logging.debug(f"Fetching {len(new_blob_list)} of {len(json_blob_list)} json backup entries")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor:
+        new_blob_dicts = fetch_executor.map(
+            lambda filename: minio_json_to_dict(
+                minio_filename_override=filename,
+                minio_bucket=bucket,
+                data_classification=EDGE_CLASSIFICATION,
+            ),
+            new_blob_list
+        )
+        for filename, blob_dict in zip(new_blob_list, new_blob_dicts):
+            snapshot[filename] = json.dumps(blob_dict)
 
-    part_dict_gen = (
-        minio_json_to_dict(
-            minio_filename_override=filename,
+    snapshot = {filename: snapshot[filename] for filename in json_blob_list}
+    if snapshot != old_snapshot:
+        logging.debug(f"Updating backup snapshot '{snapshot_prefix}'")
+        minio_utils.dataframe_to_minio(
+            pandas.DataFrame({BACKUP_KEY_COL_NAME: list(snapshot.keys()),
+                              BACKUP_JSON_COL_NAME: list(snapshot.values())}),
             minio_bucket=bucket,
-            data_classification=EDGE_CLASSIFICATION,
+            data_classification=data_classification,
+            filename_prefix_override=snapshot_prefix,
+            file_format="parquet",
+            data_versioning=False
         )
-        for filename in json_blob_list
-    )
 
-    full_df = pandas.DataFrame(part_dict_gen)
+    full_df = pandas.DataFrame(json.loads(snapshot[filename]) for filename in json_blob_list)
 
     return full_df.reset_index()
 
 
+def list_to_full_df(site, list_name, list_backup_prefix, data_classification, full_rebuild=False):
+    """
+    Back up the SharePoint list items modified since the latest one in the backup snapshot, and merge them into it to
+    get the full dataframe. All of the items are fetched if there isn't a snapshot yet, or it is being rebuilt.
+    """
+    snapshot_df = (
+        pandas.DataFrame(columns=[BACKUP_KEY_COL_NAME, BACKUP_JSON_COL_NAME]) if full_rebuild else
+        get_backup_snapshot_df(COVID_BUCKET, get_backup_snapshot_prefix(list_backup_prefix), data_classification)
+    )
+    modified_since = get_backup_snapshot_watermark(snapshot_df)
+    logging.debug(f"Fetching the {list_name} items modified since {modified_since or 'the start'}")
+
+    list_backup = get_xml_list_dfs(site, list_name, list_backup_prefix, data_classification, modified_since)
+
+    return backup_to_full_df(
+        bucket=COVID_BUCKET, prefix=list_backup_prefix,
+        data_classification=data_classification,
+        backed_up_rows=list_backup, snapshot_df=snapshot_df
+    )
+
+
+def df_to_parquet_bytes(df, row_group_size=PARQUET_ROW_GROUP_SIZE):
+    """
+    Parquet file of the dataframe, in row groups small enough for the readers' filters to skip most of them
+    """
+    parquet_buffer = io.BytesIO()
+    df.to_parquet(parquet_buffer, row_group_size=row_group_size)
+
+    return parquet_buffer.getvalue()
+
+
+def parquet_bytes_to_minio(parquet_bytes, filename_prefix, minio_access, minio_secret):
+    minio_dir, filename = filename_prefix.rsplit("/", 1)
+    with tempfile.TemporaryDirectory() as tempdir:
+        local_path = os.path.join(tempdir, f"{filename}.parquet")
+        with open(local_path, "wb") as parquet_file:
+            parquet_file.write(parquet_bytes)
+
+        return minio_utils.file_to_minio(
+            filename=local_path,
+            minio_bucket=COVID_BUCKET,
+            minio_key=minio_access,
+            minio_secret=minio_secret,
+            data_classification=EDGE_CLASSIFICATION,
+            filename_prefix_override=f"{minio_dir}/",
+        )
+
+
 def fix_sp_formatted_cols(df, columns_list, regex_pattern):
     df_copy = df.copy()
     re_pattern = re.compile(regex_pattern)
@@ -195,21 +358,7 @@ def unset_proxy():
         os.environ.pop(proxy)
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
-
-    # secrets env
-    SECRETS_PATH_VAR = "SECRETS_PATH"
-
-    # Loading secrets
-    if SECRETS_PATH_VAR not in os.environ:
-        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
-        sys.exit(-1)
-
-    secrets_path = os.environ[SECRETS_PATH_VAR]
-    secrets = json.load(open(secrets_path))
-
+def get_vaccine_list_dfs(secrets, full_rebuild=False):
     # ----------------------------------
     logging.info("Fetch[ing] in auths")
     # get auths
@@ -229,20 +378,14 @@ if __name__ == "__main__":
     # ----------------------------------
     # get staff list df
     logging.info(f"Fetch[ing] {SP_STAFF_LIST_NAME}")
-    staff_list_backup = get_xml_list_dfs(
+    staff_list_df = list_to_full_df(
         sp_site, SP_STAFF_LIST_NAME, STAFF_LIST_BAK,
-        data_classification=EDGE_CLASSIFICATION
-    )
-    logging.info(f"Fetch[ed] {SP_STAFF_LIST_NAME}")
-    logging.info(f"Back[ing] up the full df for {SP_STAFF_LIST_NAME}")
-    staff_list_df = backup_to_full_df(
-        bucket=COVID_BUCKET, prefix=STAFF_LIST_BAK,
-        data_classification=EDGE_CLASSIFICATION
+        data_classification=EDGE_CLASSIFICATION, full_rebuild=full_rebuild
     )
     if staff_list_df.empty:
         logging.error(f"empty dataframe for sharepoint list {SP_STAFF_LIST_NAME}")
         sys.exit(-1)
-    logging.info(f"Back[ed] up the full df for {SP_STAFF_LIST_NAME}")
+    logging.info(f"Fetch[ed] {SP_STAFF_LIST_NAME}")
 
     # fix sharepoint formatting
     logging.info(f"Formatt[ing] columns")
@@ -252,13 +395,9 @@ if __name__ == "__main__":
     # ----------------------------------
     # get vaccine register df
     logging.info(f"Fetch[ing] {SP_VACCINE_REGISTER}")
-    staff_vaccine_backup = get_xml_list_dfs(
+    staff_vaccine_register_df = list_to_full_df(
         sp_site, SP_VACCINE_REGISTER, VACC_LIST_BAK,
-        data_classification=EDGE_CLASSIFICATION
-    )
-    staff_vaccine_register_df = backup_to_full_df(
-        bucket=COVID_BUCKET, prefix=VACC_LIST_BAK,
-        data_classification=EDGE_CLASSIFICATION
+        data_classification=EDGE_CLASSIFICATION, full_rebuild=full_rebuild
     )
     if staff_vaccine_register_df.empty:
         logging.error(f"empty dataframe for sharepoint list {SP_VACCINE_REGISTER}")
@@ -270,16 +409,17 @@ if __name__ == "__main__":
     staff_vaccine_register_df_fixed = fix_sp_formatted_cols(staff_vaccine_register_df, [VAX_MERGE_STR], SP_REGEX)
     logging.info(f"Formatt[ed] columns")
 
+    # sorted by date, so that each row group of the parquet file covers a short run of dates
+    staff_vaccine_register_df_fixed = staff_vaccine_register_df_fixed.sort_values(
+        VAX_DATE, kind="stable", ignore_index=True
+    )
+
     # ----------------------------------
     # get sequencing survey
     logging.info(f"Fetch[ing] {SP_SEQUENCING_SURVEY}")
-    staff_seq_survey_backckup = get_xml_list_dfs(
+    staff_seq_survey_df = list_to_full_df(
         sp_site, SP_SEQUENCING_SURVEY, SEQ_LIST_BAK,
-        data_classification=EDGE_CLASSIFICATION
-    )
-    staff_seq_survey_df = backup_to_full_df(
-        bucket=COVID_BUCKET, prefix=SEQ_LIST_BAK,
-        data_classification=EDGE_CLASSIFICATION
+        data_classification=EDGE_CLASSIFICATION, full_rebuild=full_rebuild
     )
     if staff_seq_survey_df.empty:
         logging.error(f"empty dataframe for sharepoint list {SP_SEQUENCING_SURVEY}")
@@ -293,6 +433,32 @@ if __name__ == "__main__":
     # unset the proxies set by Sharepoint utils
     unset_proxy()
 
+    return staff_list_df_fixed, staff_vaccine_register_df_fixed, staff_seq_survey_df_fixed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+
+    # secrets env
+    SECRETS_PATH_VAR = "SECRETS_PATH"
+
+    # Loading secrets
+    if SECRETS_PATH_VAR not in os.environ:
+        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+        sys.exit(-1)
+
+    secrets_path = os.environ[SECRETS_PATH_VAR]
+    secrets = json.load(open(secrets_path))
+
+    full_rebuild = os.environ.get(FULL_REBUILD_VAR, "").lower() in ("1", "true", "yes")
+    if full_rebuild:
+        logging.info(f"'{FULL_REBUILD_VAR}' is set, fetching all of the list items and rebuilding the backup snapshots")
+
+    staff_list_df_fixed, staff_vaccine_register_df_fixed, staff_seq_survey_df_fixed = get_vaccine_list_dfs(
+        secrets, full_rebuild
+    )
+
     # write to minio
     logging.info(f"Push[ing] data to mino")
     for filename, df in [
@@ -301,17 +467,15 @@ if __name__ == "__main__":
         (SEQ_SURVEY_PREFIX, staff_seq_survey_df_fixed)
     ]:
 
-        minio_utils.dataframe_to_minio(
-            df,
-            COVID_BUCKET,
+        result = parquet_bytes_to_minio(
+            df_to_parquet_bytes(df),
+            f"{VACCINE_PREFIX_RAW}{filename}",
             secrets["minio"]["edge"]["access"],
             secrets["minio"]["edge"]["secret"],
-            EDGE_CLASSIFICATION,
-            filename_prefix_override=f"{VACCINE_PREFIX_RAW}{filename}",
-            file_format="parquet",
-            data_versioning=False
-
         )
+        if not result:
+            logging.error(f"Failed to push {filename} to minio")
+            sys.exit(-1)
     logging.info(f"Push[ed] data to mino")
 
     logging.info("...Done!")
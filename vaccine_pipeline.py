@@ -0,0 +1,217 @@
+"""
+Script to run the staff vaccine munging chain (or a contiguous part of it) in a single process
+"""
+
+# base imports
+import concurrent.futures
+import functools
+import io
+import json
+import logging
+import os
+import sys
+# external imports
+from db_utils import minio_utils
+import pandas as pd
+# local imports
+import vaccine_annotate_HR_munge
+import vaccine_annotate_non_HR_munge
+import vaccine_data_to_minio
+import vaccine_register_munge
+import vaccine_register_willing_munge
+import vaccine_rollout_time_series
+import vaccine_rollout_willing_time_series
+import vaccine_sequencing_aggregation
+import vaccine_sequencing_munge
+from vaccine_data_to_minio import (COVID_BUCKET, EDGE_CLASSIFICATION, VACCINE_PREFIX_RAW, FULL_REBUILD_VAR,
+                                   df_to_parquet_bytes, parquet_bytes_to_minio)
+from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, OUTPUT_PREFIX_AGG, CSV_READER, PARQUET_READER,
+                                      minio_to_df)
+
+FIRST_STEP_VAR = "VACCINE_PIPELINE_FIRST_STEP"
+LAST_STEP_VAR = "VACCINE_PIPELINE_LAST_STEP"
+PUSH_WORKERS = 4
+
+
+def get_vaccine_steps(secrets, full_rebuild=False):
+    """
+    The vaccine munging steps, in the order that they need to run, as tuples of
+    (step name, step function, source minio filenames, output minio prefixes and formats)
+
+    A source can also be a tuple of (minio filename, columns, filters), to only read part of it
+    """
+    return [
+        ("vaccine-data-to-minio",
+         functools.partial(vaccine_data_to_minio.get_vaccine_list_dfs, secrets, full_rebuild),
+         [],
+         [(f"{VACCINE_PREFIX_RAW}{filename}", PARQUET_READER)
+          for filename in (vaccine_data_to_minio.STAFF_LIST_PREFIX,
+                           vaccine_data_to_minio.RAW_VAX_REGISTER_PREFIX,
+                           vaccine_data_to_minio.SEQ_SURVEY_PREFIX)]),
+        ("vaccine-sequencing-munge",
+         vaccine_sequencing_munge.annotate_sequencing,
+         [(vaccine_sequencing_munge.HR_MASTER_DATA, vaccine_sequencing_munge.HR_MASTER_READ_COLS, None),
+          (vaccine_sequencing_munge.STAFF_LIST, vaccine_sequencing_munge.STAFF_LIST_KEEP_COLS, None),
+          (vaccine_sequencing_munge.CITY_SEQ_SURVEY, vaccine_sequencing_munge.SEQ_KEEP_COLS, None)],
+         [(f"{OUTPUT_PREFIX_ANN}{filename}", PARQUET_READER)
+          for filename in (vaccine_sequencing_munge.UNIQUE_STAFF_LIST,
+                           vaccine_sequencing_munge.UNIQUE_STAFF_LIST_ANN,
+                           vaccine_sequencing_munge.VACCINE_SEQ_ANN)]),
+        ("vaccine-sequencing-aggregation",
+         vaccine_sequencing_aggregation.aggregate_willingness,
+         [vaccine_sequencing_aggregation.UNIQUE_STAFF_LIST_ANN,
+          vaccine_sequencing_aggregation.VACCINE_SEQ_ANN],
+         [(f"{vaccine_sequencing_aggregation.OUTPUT_PREFIX_AGG}{filename}", PARQUET_READER)
+          for filename in (vaccine_sequencing_aggregation.SEQ_WILLINGNESS_TOTAL,
+                           vaccine_sequencing_aggregation.SEQ_WILLINGNESS_BRANCH,
+                           vaccine_sequencing_aggregation.SEQ_WILLINGNESS_TYPE,
+                           vaccine_sequencing_aggregation.SEQ_WILLINGNESS_RISK)]),
+        ("vaccine-annotate-hr-munge",
+         vaccine_annotate_HR_munge.annotate_register_hr,
+         [(f"{VACCINE_PREFIX_RAW}{vaccine_annotate_HR_munge.CITY_VAX_REGISTER}",
+           vaccine_annotate_HR_munge.VAX_KEEP_COLS, vaccine_annotate_HR_munge.VAX_DATE_READ_FILTERS),
+          (vaccine_annotate_HR_munge.HR_MASTER_DATA, vaccine_annotate_HR_munge.HR_MASTER_READ_COLS, None)],
+         [(f"{OUTPUT_PREFIX_ANN}{vaccine_annotate_HR_munge.VACCINE_REGISTER_ANNOTATED_HR}", PARQUET_READER)]),
+        ("vaccine-annotate-non-hr-munge",
+         vaccine_annotate_non_HR_munge.annotate_register_non_hr,
+         [f"{OUTPUT_PREFIX_ANN}{vaccine_annotate_non_HR_munge.CITY_VAX_REGISTER}",
+          f"{OUTPUT_PREFIX_ANN}{vaccine_annotate_non_HR_munge.UNIQUE_STAFF_LIST}"],
+         [(f"{OUTPUT_PREFIX_ANN}{vaccine_annotate_non_HR_munge.VACCINE_REGISTER_ANNOT_NON_STAFF}", PARQUET_READER)]),
+        # the all staff and willing staff register aggregates come out of the same count
+        ("vaccine-register-munge",
+         vaccine_register_willing_munge.aggregate_register_all_and_willing,
+         [vaccine_register_willing_munge.SEQUENCING_ANNOTATED,
+          vaccine_register_willing_munge.CITY_VAX_REGISTER],
+         [(f"{OUTPUT_PREFIX_AGG}{filename}", PARQUET_READER)
+          for filename in (vaccine_register_munge.VACCINE_REGISTER_AGG,
+                           vaccine_register_willing_munge.VACCINE_REGISTER_AGG_WILLING)]),
+        # the all staff and willing staff time series come out of the same pass over the register
+        ("vaccine-rollout-time-series",
+         vaccine_rollout_willing_time_series.get_rollout_all_and_willing_time_series,
+         [f"{OUTPUT_PREFIX_ANN}{vaccine_rollout_willing_time_series.SEQUENCING_ANNOTATED}",
+          f"{OUTPUT_PREFIX_AGG}{vaccine_rollout_willing_time_series.CITY_VAX_REGISTER}",
+          vaccine_rollout_time_series.STAFF_DF_OVERRIDE],
+         [(f"{vaccine_rollout_time_series.TS_PREFIX}{outfile_prefix}", CSV_READER)
+          for outfile_prefix in (vaccine_rollout_time_series.OUTFILE_PREFIX,
+                                 vaccine_rollout_willing_time_series.OUTFILE_PREFIX)]),
+    ]
+
+
+def get_source_df(source, produced_files, fetched_dfs):
+    """
+    Gets a step's source dataframe, from what an earlier step produced in this run if possible, otherwise from minio.
+    Every call gets its own copy, as the steps modify their source dataframes
+    """
+    filename, columns, filters = source if isinstance(source, tuple) else (source, None, None)
+    if filename in produced_files:
+        logging.debug(f"Using '{filename}' from this run")
+        return pd.read_parquet(io.BytesIO(produced_files[filename]), columns=columns, filters=filters)
+
+    fetch_key = (filename, repr(columns), repr(filters))
+    if fetch_key not in fetched_dfs:
+        logging.debug(f"Fetching '{filename}' from minio")
+        fetched_dfs[fetch_key] = minio_to_df(
+            minio_filename_override=filename,
+            minio_bucket=COVID_BUCKET,
+            data_classification=EDGE_CLASSIFICATION,
+            reader=CSV_READER if filename.endswith(".csv") else PARQUET_READER,
+            columns=columns,
+            filters=filters
+        )
+
+    return fetched_dfs[fetch_key].copy()
+
+
+def select_vaccine_steps(vaccine_steps, first_step=None, last_step=None):
+    step_names = [step_name for step_name, *_ in vaccine_steps]
+    for step in (first_step, last_step):
+        if step is not None and step not in step_names:
+            raise ValueError(f"'{step}' is not one of the vaccine steps: {', '.join(step_names)}")
+
+    first_index = step_names.index(first_step) if first_step else 0
+    last_index = step_names.index(last_step) if last_step else len(step_names) - 1
+    if first_index > last_index:
+        raise ValueError(f"'{first_step}' runs after '{last_step}'")
+
+    return vaccine_steps[first_index:last_index + 1]
+
+
+def run_vaccine_steps(vaccine_steps, minio_access, minio_secret, push_workers=PUSH_WORKERS):
+    # Outputs are handed to later steps as parquet, so they see exactly what they would have read out of minio
+    produced_files = {}
+    fetched_dfs = {}
+    pushes = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=push_workers) as push_executor:
+        for step_name, step_func, source_files, outputs in vaccine_steps:
+            logging.info(f"Runn[ing] {step_name}")
+            source_dfs = [get_source_df(source, produced_files, fetched_dfs) for source in source_files]
+            output_dfs = step_func(*source_dfs)
+            if isinstance(output_dfs, pd.DataFrame):
+                output_dfs = (output_dfs,)
+
+            for (filename_prefix, file_format), output_df in zip(outputs, output_dfs):
+                logging.debug(f"Queuing push of '{filename_prefix}.{file_format}'")
+                if file_format == PARQUET_READER:
+                    parquet_bytes = df_to_parquet_bytes(output_df)
+                    produced_files[f"{filename_prefix}.{file_format}"] = parquet_bytes
+                    push = push_executor.submit(
+                        parquet_bytes_to_minio, parquet_bytes, filename_prefix, minio_access, minio_secret
+                    )
+                else:
+                    push = push_executor.submit(
+                        minio_utils.dataframe_to_minio,
+                        output_df,
+                        COVID_BUCKET,
+                        minio_access,
+                        minio_secret,
+                        EDGE_CLASSIFICATION,
+                        filename_prefix_override=filename_prefix,
+                        file_format=file_format,
+                        data_versioning=False
+                    )
+                pushes += [(f"{filename_prefix}.{file_format}", push)]
+            logging.info(f"R[an] {step_name}")
+
+        logging.info(f"Wait[ing] for {len(pushes)} pushes to minio")
+
+    failed_pushes = [filename for filename, push in pushes if not push.result()]
+    logging.info(f"Wait[ed] for {len(pushes)} pushes to minio")
+
+    return failed_pushes
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+
+    # secrets env
+    SECRETS_PATH_VAR = "SECRETS_PATH"
+
+    # Loading secrets
+    if SECRETS_PATH_VAR not in os.environ:
+        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+        sys.exit(-1)
+
+    secrets_path = os.environ[SECRETS_PATH_VAR]
+    secrets = json.load(open(secrets_path))
+
+    full_rebuild = os.environ.get(FULL_REBUILD_VAR, "").lower() in ("1", "true", "yes")
+    first_step = os.environ.get(FIRST_STEP_VAR) or None
+    last_step = os.environ.get(LAST_STEP_VAR) or None
+    logging.info(f"Running vaccine steps from '{first_step or 'the start'}' to '{last_step or 'the end'}'")
+
+    try:
+        vaccine_steps = select_vaccine_steps(get_vaccine_steps(secrets, full_rebuild), first_step, last_step)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(-1)
+
+    failed_pushes = run_vaccine_steps(
+        vaccine_steps, secrets["minio"]["edge"]["access"], secrets["minio"]["edge"]["secret"]
+    )
+
+    if failed_pushes:
+        logging.error(f"Failed to push {', '.join(failed_pushes)} to minio")
+        sys.exit(-1)
+
+    logging.info("...Done!")
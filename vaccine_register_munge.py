@@ -6,6 +6,8 @@ import os
 import sys
 # external imports
 from db_utils import minio_utils
+import numpy as np
+import pandas as pd
 from vaccine_data_to_minio import COVID_BUCKET, EDGE_CLASSIFICATION, CREATED_DATE, VAX_DATE
 from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, OUTPUT_PREFIX_AGG, DIRECTORATE_COL, DEPARTMENT_COL, STAFF_NO,
                                       SUBDISTRICT, STAFF_TYPE, BRANCH, SECTION, ORG_UNIT, FACILITY, POSITION, GENDER,
@@ -22,6 +24,7 @@ VACCINE_REGISTER_AGG = "staff-vaccination-register-aggregated"
 
 # vaccine register list cols
 COUNT = "count"
+ROW_POSITION = "row_position"
 
 PRIMARY_GRP_COLS = [
     VAX_DATE, VAX_TYPE, DOSE_NO,
@@ -29,6 +32,54 @@ PRIMARY_GRP_COLS = [
 ]
 
 
+def get_count_cube(df, cube_cols, count_col):
+    """
+    Count of count_col's values for every combination of cube_cols that occurs in df, with the columns' values
+    encoded as sorted integers (missing values last), so that the cube can be summed out without hashing them again
+    """
+    cube_codes_df = pd.DataFrame(index=range(len(df)))
+    for col in cube_cols:
+        codes, uniques = pd.factorize(df[col], sort=True)
+        cube_codes_df[col] = np.where(codes < 0, len(uniques), codes)
+
+    cube_codes_df[COUNT] = df[count_col].notna().values
+    cube_codes_df[ROW_POSITION] = np.arange(len(df))
+
+    count_cube_df = cube_codes_df.groupby(cube_cols).agg(
+        **{COUNT: (COUNT, "sum")},
+        **{ROW_POSITION: (ROW_POSITION, "min")},
+    ).reset_index()
+
+    return count_cube_df
+
+
+def sum_out_count_cube(count_cube_df, df, keep_cols):
+    """
+    Sums the counts in the cube over everything apart from keep_cols, decoding the kept columns' values from the rows
+    of df that the cube was counted from
+    """
+    cube_cols = count_cube_df.columns.difference([COUNT, ROW_POSITION])
+    summed_cube_df = count_cube_df.groupby(keep_cols).agg(
+        **{COUNT: (COUNT, "sum")},
+        **{ROW_POSITION: (ROW_POSITION, "min")},
+    ) if cube_cols.difference(keep_cols).size else count_cube_df
+
+    agg_df = df[keep_cols].iloc[summed_cube_df[ROW_POSITION].values].reset_index(drop=True)
+    agg_df[COUNT] = summed_cube_df[COUNT].values
+
+    return agg_df
+
+
+def aggregate_register(staff_vaccine_register_df):
+    # ----------------------------------
+    logging.info("Aggregat[ing] master vaccine register data")
+    count_cube_df = get_count_cube(staff_vaccine_register_df, PRIMARY_GRP_COLS, CREATED_DATE)
+    vaccine_register_agg_df = sum_out_count_cube(count_cube_df, staff_vaccine_register_df, PRIMARY_GRP_COLS)
+    logging.info("Aggregat[ed] master vaccine register data")
+
+    return vaccine_register_agg_df
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
@@ -55,13 +106,8 @@ if __name__ == "__main__":
         reader=PARQUET_READER
     )
 
-    # ----------------------------------
-    logging.info("Aggregat[ing] master vaccine register data")
-    vaccine_register_agg_df = staff_vaccine_register_df.groupby(PRIMARY_GRP_COLS, dropna=False).agg(
-            **{COUNT: (CREATED_DATE, "count")},
-        ).reset_index()
-    logging.info("Aggregat[ing] master vaccine register data")
-     
+    vaccine_register_agg_df = aggregate_register(staff_vaccine_register_df)
+
     # ----------------------------------
     logging.info(f"Push[ing] data to mino")
     minio_utils.dataframe_to_minio(
@@ -17,7 +17,8 @@ from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, OUTPUT_PREFIX_AGG, VACC
                                       POSITION, GENDER, Q1, Q2, RISK_SCORE, minio_to_df, PARQUET_READER)
 from vaccine_annotate_non_HR_munge import VACCINE_REGISTER_ANNOT_NON_STAFF
 from vaccine_annotate_HR_munge import SIDE_EFFECT, VAX_TYPE, DOSE_NO
-from vaccine_register_munge import COUNT
+from vaccine_register_munge import (COUNT, PRIMARY_GRP_COLS as REGISTER_GRP_COLS, VACCINE_REGISTER_AGG,
+                                    get_count_cube, sum_out_count_cube)
 
 # input settings
 CITY_VAX_REGISTER = f"{OUTPUT_PREFIX_ANN}{VACCINE_REGISTER_ANNOT_NON_STAFF}.parquet"
@@ -35,6 +36,60 @@ PRIMARY_GRP_COLS = [
 ]
 
 
+def get_register_count_cube(annotated_sequencing_df, staff_vaccine_register_df):
+    # ----------------------------------
+    # annotate vaccine register with seq survey
+    logging.info(f"Merg[ing] Staff annotations onto vaccine register")
+    register_annotated_risk = pd.merge(
+        staff_vaccine_register_df,
+        annotated_sequencing_df[[VAX_MERGE_STR, Q1, Q2, RISK_SCORE]],
+        how="left",
+        on=VAX_MERGE_STR,
+        validate="m:1"
+    )
+    logging.info(f"Merg[ed] Staff annotations onto vaccine register")
+
+    # ----------------------------------
+    logging.info("Count[ing] vaccine register")
+    count_cube_df = get_count_cube(register_annotated_risk, PRIMARY_GRP_COLS, CREATED_DATE)
+    logging.info("Count[ed] vaccine register")
+
+    return count_cube_df, register_annotated_risk
+
+
+def aggregate_register_willing(annotated_sequencing_df, staff_vaccine_register_df):
+    count_cube_df, register_annotated_risk = get_register_count_cube(annotated_sequencing_df, staff_vaccine_register_df)
+
+    # ----------------------------------
+    logging.info("Aggregat[ing] master vaccine register data")
+    vaccine_register_agg_df = sum_out_count_cube(count_cube_df, register_annotated_risk, PRIMARY_GRP_COLS)
+
+    for col in [RISK_SCORE, Q1, Q2]:
+        vaccine_register_agg_df[col] = vaccine_register_agg_df[col].astype(str)
+    logging.info("Aggregat[ed] master vaccine register data")
+
+    return vaccine_register_agg_df
+
+
+def aggregate_register_all_and_willing(annotated_sequencing_df, staff_vaccine_register_df):
+    """
+    Both the all staff and the willing staff vaccine register aggregates, from a single count of the register.
+    The all staff aggregate is the willing one with the sequencing survey columns summed out.
+    """
+    count_cube_df, register_annotated_risk = get_register_count_cube(annotated_sequencing_df, staff_vaccine_register_df)
+
+    # ----------------------------------
+    logging.info("Aggregat[ing] master vaccine register data")
+    vaccine_register_agg_df = sum_out_count_cube(count_cube_df, register_annotated_risk, REGISTER_GRP_COLS)
+
+    vaccine_register_agg_willing_df = sum_out_count_cube(count_cube_df, register_annotated_risk, PRIMARY_GRP_COLS)
+    for col in [RISK_SCORE, Q1, Q2]:
+        vaccine_register_agg_willing_df[col] = vaccine_register_agg_willing_df[col].astype(str)
+    logging.info("Aggregat[ed] master vaccine register data")
+
+    return vaccine_register_agg_df, vaccine_register_agg_willing_df
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
@@ -70,41 +125,23 @@ if __name__ == "__main__":
     # dataframes
     annotated_sequencing_df, staff_vaccine_register_df = vax_register_dfs
 
-    # ----------------------------------
-    # annotate vaccine register with seq survey
-    logging.info(f"Merg[ing] Staff annotations onto vaccine register")
-    register_annotated_risk = pd.merge(
-        staff_vaccine_register_df,
-        annotated_sequencing_df[[VAX_MERGE_STR, Q1, Q2, RISK_SCORE]],
-        how="left",
-        on=VAX_MERGE_STR,
-        validate="m:1"
-    )
-    logging.info(f"Merg[ed] Staff annotations onto vaccine register")
+    # the all staff aggregate comes out of the same count, so both get written here
+    vaccine_register_agg_dfs = aggregate_register_all_and_willing(annotated_sequencing_df, staff_vaccine_register_df)
 
     # ----------------------------------
-    logging.info("Aggregat[ing] master vaccine register data")
-    vaccine_register_agg_df = register_annotated_risk.groupby(PRIMARY_GRP_COLS, dropna=False).agg(
-        **{COUNT: (CREATED_DATE, "count")},
-    ).reset_index()
-
-    for col in [RISK_SCORE, Q1, Q2]:
-        vaccine_register_agg_df[col] = vaccine_register_agg_df[col].astype(str)
-    logging.info("Aggregat[ing] master vaccine register data")
-
-
-    # ----------------------------------
-    logging.info(f"Push[ing] data to mino")
-    minio_utils.dataframe_to_minio(
-        vaccine_register_agg_df,
-        COVID_BUCKET,
-        secrets["minio"]["edge"]["access"],
-        secrets["minio"]["edge"]["secret"],
-        EDGE_CLASSIFICATION,
-        filename_prefix_override=f"{OUTPUT_PREFIX_AGG}{VACCINE_REGISTER_AGG_WILLING}",
-        file_format="parquet",
-        data_versioning=False
-    )
-    logging.info(f"Push[ed] data to mino")
+    for vaccine_register_agg_df, outfile_prefix in zip(vaccine_register_agg_dfs,
+                                                       (VACCINE_REGISTER_AGG, VACCINE_REGISTER_AGG_WILLING)):
+        logging.info(f"Push[ing] data to mino for {outfile_prefix}")
+        minio_utils.dataframe_to_minio(
+            vaccine_register_agg_df,
+            COVID_BUCKET,
+            secrets["minio"]["edge"]["access"],
+            secrets["minio"]["edge"]["secret"],
+            EDGE_CLASSIFICATION,
+            filename_prefix_override=f"{OUTPUT_PREFIX_AGG}{outfile_prefix}",
+            file_format="parquet",
+            data_versioning=False
+        )
+        logging.info(f"Push[ed] data to mino for {outfile_prefix}")
 
     logging.info("...Done!")
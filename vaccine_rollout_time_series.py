@@ -1,4 +1,5 @@
 # base imports
+from dataclasses import dataclass
 import json
 import logging
 import os
@@ -52,52 +53,187 @@ AGG_GROUP_DICT = {
 }
 
 
-def get_agg_timeseries(vacc_df, agg_col, staff_totals_df, staff_col):
-    agg_cols = AGG_GROUP_DICT[agg_col]
-    vaccination_time_series = vacc_df.groupby([VAX_DATE] + agg_cols).agg(
-        **{VACCINATED: (COUNT, "sum")}
-    ).reset_index()
+@dataclass
+class StaffPopulation:
+    staff_df: pd.DataFrame
+    staff_col: str
+    agg_levels: list
+    # which of the register's rows belong to the population, or None for all of them
+    register_mask: np.ndarray = None
+
+
+def _get_level_keys(codes_df, agg_cols, col_uniques):
+    """
+    Single integer key for each row's combination of the level's columns, or -1 if any of them are missing
+    """
+    if not agg_cols:
+        return np.zeros(len(codes_df), dtype=np.int64)
+
+    level_codes = codes_df[agg_cols].values
+    level_keys = np.ravel_multi_index(
+        level_codes.clip(min=0).T, [len(col_uniques[col]) for col in agg_cols]
+    ).astype(np.int64)
+    level_keys[(level_codes < 0).any(axis=1)] = -1
+
+    return level_keys
+
+
+def get_grouping_sets_timeseries(vacc_df, populations):
+    """
+    Daily and cumulative vaccination time series for the whole city, and for each of the aggregation levels, for each
+    of the staff populations. The values of the grouping columns are encoded as integers once, and each level's keys
+    are worked out once for the whole register. Each population then only masks out the register rows that aren't
+    its own, before its daily counts, staff totals and cumulative sums are worked out on a dense group x date grid.
+    """
+    agg_levels = list(dict.fromkeys(agg_level for population in populations for agg_level in population.agg_levels))
+    level_cols = list(dict.fromkeys(col for agg_level in agg_levels for col in AGG_GROUP_DICT[agg_level]))
+
+    # Encoding the values of each column as (sorted) integers once, shared between the register and staff totals, so
+    # that none of the levels have to hash the values again. Missing values are -1.
+    col_uniques = {}
+    vacc_codes_df = pd.DataFrame(index=range(len(vacc_df)))
+    staff_codes_dfs = [pd.DataFrame(index=range(len(population.staff_df))) for population in populations]
+    date_codes, date_uniques = pd.factorize(vacc_df[VAX_DATE], sort=True)
+    for col in level_cols:
+        col_staff = [(staff_codes_df, population.staff_df)
+                     for staff_codes_df, population in zip(staff_codes_dfs, populations)
+                     if col in population.staff_df.columns]
+        codes, col_uniques[col] = pd.factorize(
+            pd.concat([vacc_df[col]] + [staff_df[col] for _, staff_df in col_staff]), sort=True
+        )
+        vacc_codes_df[col] = codes[:len(vacc_df)]
+        codes_start = len(vacc_df)
+        for staff_codes_df, staff_df in col_staff:
+            staff_codes_df[col] = codes[codes_start:codes_start + len(staff_df)]
+            codes_start += len(staff_df)
+
+    vacc_counts = vacc_df[COUNT].values
+    dates_count = len(date_uniques)
+    populations_vacc_valid = [
+        (date_codes >= 0) & (population.register_mask if population.register_mask is not None else True)
+        for population in populations
+    ]
+
+    populations_level_time_series = [[] for _ in populations]
+    for agg_level, agg_cols in [(TOP_LEVEL, [])] + [(agg_level, AGG_GROUP_DICT[agg_level])
+                                                      for agg_level in agg_levels]:
+        vacc_keys = _get_level_keys(vacc_codes_df, agg_cols, col_uniques)
+
+        for population, staff_codes_df, population_vacc_valid, level_time_series in zip(
+                populations, staff_codes_dfs, populations_vacc_valid, populations_level_time_series):
+            if agg_cols and agg_level not in population.agg_levels:
+                continue
+
+            vacc_valid = (vacc_keys >= 0) & population_vacc_valid
+            staff_keys = _get_level_keys(staff_codes_df, agg_cols, col_uniques)
+            staff_valid = staff_keys >= 0
+            staff_counted = population.staff_df[population.staff_col].notna().values
+
+            # numbering the level's groups in the order of their values
+            group_ids, group_keys = pd.factorize(
+                np.concatenate([vacc_keys[vacc_valid], staff_keys[staff_valid]]), sort=True
+            )
+            groups_count = len(group_keys)
+            vacc_group_ids = group_ids[:vacc_valid.sum()]
+            staff_group_ids = group_ids[vacc_valid.sum():]
+
+            # daily counts, and their running totals, for every group and date
+            grid_cells = vacc_group_ids * dates_count + date_codes[vacc_valid]
+            grid_shape = (groups_count, dates_count)
+            vaccinated_grid = np.bincount(grid_cells, weights=vacc_counts[vacc_valid],
+                                          minlength=groups_count * dates_count).reshape(grid_shape)
+            vaccinated_cumsum_grid = vaccinated_grid.cumsum(axis=1)
+            registered_grid = np.bincount(grid_cells, minlength=groups_count * dates_count).reshape(grid_shape) > 0
+
+            # only the dates on which each group had vaccinations, by date and then group
+            date_idx, group_idx = np.nonzero(registered_grid.T)
+
+            level_ts = pd.DataFrame({
+                VAX_DATE: date_uniques.take(date_idx),
+                VACCINATED: vaccinated_grid[group_idx, date_idx].astype(vacc_counts.dtype),
+                VACCINATED_CUMSUM: vaccinated_cumsum_grid[group_idx, date_idx].astype(vacc_counts.dtype),
+            })
+
+            if agg_cols:
+                staff_rows = np.bincount(staff_group_ids, minlength=groups_count)[group_idx]
+                staff_totals = np.bincount(staff_group_ids, weights=staff_counted[staff_valid],
+                                           minlength=groups_count)[group_idx].astype(np.int64)
+                level_ts[TOTAL_STAFF] = (staff_totals if (staff_rows > 0).all()
+                                         else np.where(staff_rows > 0, staff_totals, np.nan))
+
+                level_codes = np.unravel_index(group_keys.take(group_idx),
+                                               [len(col_uniques[col]) for col in agg_cols])
+                for col, codes in zip(agg_cols, level_codes):
+                    level_ts[col] = col_uniques[col].take(codes)
+                level_ts[AGG_TYPE_NAMES] = level_ts[agg_level]
+            else:
+                # top level counts unique staff members
+                level_ts[TOTAL_STAFF] = population.staff_df[STAFF_NO].nunique()
+                level_ts[AGG_TYPE_NAMES] = TOP_LEVEL
+
+            level_ts[AGG_TYPE] = agg_level
+            level_ts[VACCINATED_REL] = level_ts[VACCINATED_CUMSUM] / level_ts[TOTAL_STAFF]
+
+            level_time_series += [level_ts]
+
+    return [pd.concat(level_time_series) for level_time_series in populations_level_time_series]
+
+
+def clean_subdistricts(df):
+    df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("_", " ")
+    df[SUBDISTRICT] = df[SUBDISTRICT].str.replace(" support", "", case=False)
+    df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("Mitchell's", "Mitchells", case=False)
+    df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("Nothern", "Northern", case=False)
+
+    return df
+
+
+def get_fully_vaccinated(vaccine_register_agg_df):
+    # ----------------------------------
+    # get J&J one dose vaccinations
+    logging.info("Filter[ing] to J&J vaccinations")
+    jj_1shot = vaccine_register_agg_df.query(f"`{VAX_TYPE}` == @J_AND_J_VACC").copy()
+    logging.info("Filter[ed] to J&J vaccinations")
 
-    # add staff totals
-    staff_totals_counts = staff_totals_df.groupby(agg_cols).agg(
-        **{TOTAL_STAFF: (staff_col, "count")}
-    ).reset_index()
+    # if other exists, will need additional aggregation
+    logging.info("Check[ing] for other vaccination types")
+    # split out other vaccination types
+    other_vaccines = vaccine_register_agg_df.query(f"`{VAX_TYPE}` != @J_AND_J_VACC").copy()
+    other_vaccines_full = other_vaccines.query(f"`{DOSE_NO}` == @SECOND_DOSE").copy()
+    logging.info("Check[ed] for other vaccination types")
 
-    staff_agg_ts = pd.merge(
-        vaccination_time_series,
-        staff_totals_counts,
-        on=agg_cols,
-        how="left",
-        validate="m:1"
-    )
+    # make sure only 1st dose for J&J, aggregations assume single dose for fully vaccinated
+    logging.info("Check[ing] that J&J has only dose 1 entries")
+    jj_doses = jj_1shot[DOSE_NO].nunique()
+    if jj_doses != 1:
+        logging.error(f"{jj_doses} doses detected for J&J vaccine\nExpected only one dose")
+        sys.exit(-1)
+    logging.info("Check[ed] that J&J has only dose 1 entries")
 
-    staff_agg_ts.sort_values([VAX_DATE], ascending=True, inplace=True)
-    staff_agg_ts[VACCINATED_CUMSUM] = staff_agg_ts.groupby(agg_cols, sort=False).agg(
-        **{VACCINATED_CUMSUM: (VACCINATED, "cumsum")}
-    )
+    fully_vaccinated_df = pd.concat([jj_1shot, other_vaccines_full], ignore_index=True)
 
-    staff_agg_ts[VACCINATED_REL] = staff_agg_ts[VACCINATED_CUMSUM] / staff_agg_ts[TOTAL_STAFF]
-    staff_agg_ts[AGG_TYPE_NAMES] = staff_agg_ts[agg_col]
-    staff_agg_ts[AGG_TYPE] = agg_col
+    # convert date format
+    fully_vaccinated_df[VAX_DATE] = pd.to_datetime(fully_vaccinated_df[VAX_DATE]).dt.date
 
-    return staff_agg_ts
+    return fully_vaccinated_df
 
 
-def get_agg_totals(vacc_df, staff_totals_df):
-    total_staff = staff_totals_df[STAFF_NO].nunique()
+def get_rollout_time_series(vaccine_register_agg_df, staff_list_df):
+    for df in (vaccine_register_agg_df, staff_list_df):
+        clean_subdistricts(df)
 
-    vaccination_totals_time_series = vacc_df.groupby(VAX_DATE).agg(
-        **{VACCINATED: (COUNT, "sum")}
-    ).reset_index()
+    fully_vaccinated_df = get_fully_vaccinated(vaccine_register_agg_df)
 
-    # annotate with staff target totals
-    vaccination_totals_time_series[VACCINATED_CUMSUM] = vaccination_totals_time_series[VACCINATED].cumsum()
-    vaccination_totals_time_series[TOTAL_STAFF] = total_staff
-    vaccination_totals_time_series[VACCINATED_REL] = (
-            vaccination_totals_time_series[VACCINATED_CUMSUM] / vaccination_totals_time_series[TOTAL_STAFF]
+    # ----------------------------------
+    logging.info("Aggregat[ing] vaccine total time series")
+    collected_agg_df, = get_grouping_sets_timeseries(
+        fully_vaccinated_df, [StaffPopulation(staff_list_df, STAFF_NO, AGG_LEVELS)]
     )
+    logging.info("Aggregat[ed] vaccine total time series")
+
+    collected_agg_df = collected_agg_df[OUTOUT_COL_ORDER].copy()
 
-    return vaccination_totals_time_series
+    return collected_agg_df
 
 
 if __name__ == "__main__":
@@ -126,64 +262,12 @@ if __name__ == "__main__":
             data_classification=EDGE_CLASSIFICATION,
             reader=reader
         )
-        df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("_", " ") 
-        df[SUBDISTRICT] = df[SUBDISTRICT].str.replace(" support", "", case=False) 
-        df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("Mitchell's", "Mitchells", case=False)
-        df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("Nothern", "Northern", case=False)
         vax_register_dfs.append(df)
     
     # dataframes
     vaccine_register_agg_df, staff_list_df = vax_register_dfs
     
-    
-    # ----------------------------------
-    # get J&J one dose vaccinations
-    logging.info("Filter[ing] to J&J vaccinations")
-    jj_1shot = vaccine_register_agg_df.query(f"`{VAX_TYPE}` == @J_AND_J_VACC").copy()
-    logging.info("Filter[ed] to J&J vaccinations")
-
-    # if other exists, will need additional aggregation
-    logging.info("Check[ing] for other vaccination types")
-    # split out other vaccination types
-    other_vaccines = vaccine_register_agg_df.query(f"`{VAX_TYPE}` != @J_AND_J_VACC").copy()
-    vaccine_types = other_vaccines[VAX_TYPE].unique()
-    other_vaccines_full = other_vaccines.query(f"`{DOSE_NO}` == @SECOND_DOSE").copy()
-    logging.info("Check[ed] for other vaccination types")
-
-    # make sure only 1st dose for J&J, aggregations assume single dose for fully vaccinated
-    logging.info("Check[ing] that J&J has only dose 1 entries")
-    jj_doses = jj_1shot[DOSE_NO].nunique()
-    if jj_doses != 1:
-        logging.error(f"{jj_doses} doses detected for J&J vaccine\nExpected only one dose")
-        sys.exit(-1)
-    logging.info("Check[ed] that J&J has only dose 1 entries")
-
-    fully_vaccinated_df = pd.concat([jj_1shot, other_vaccines_full])
-
-    # convert date format
-    fully_vaccinated_df[VAX_DATE] = pd.to_datetime(fully_vaccinated_df[VAX_DATE]).dt.date
-
-    # ----------------------------------
-    # get total time series
-    logging.info("Calculat[ing] top level aggregation")
-    vaccination_totals_time_series = get_agg_totals(fully_vaccinated_df, staff_list_df)
-    vaccination_totals_time_series[AGG_TYPE] = TOP_LEVEL
-    vaccination_totals_time_series[AGG_TYPE_NAMES] = TOP_LEVEL
-    logging.info("Calculat[ing] top level aggregation")
-    
-    collected_agg_df = vaccination_totals_time_series.copy()
-    for i, agg_level in enumerate(AGG_LEVELS):
-        logging.info("Aggregat[ing] vaccine total time series")
-        staff_agg_level_ts = get_agg_timeseries(
-            fully_vaccinated_df,
-            agg_level,
-            staff_list_df,
-            STAFF_NO,
-        )
-        collected_agg_df = pd.concat([collected_agg_df, staff_agg_level_ts])
-        logging.info("Aggregat[ed] vaccine total time series")
-
-    collected_agg_df = collected_agg_df[OUTOUT_COL_ORDER].copy()
+    collected_agg_df = get_rollout_time_series(vaccine_register_agg_df, staff_list_df)
 
     # ----------------------------------
     logging.info(f"Push[ing] data to mino for {OUTFILE_PREFIX}")
@@ -5,30 +5,97 @@ import os
 import sys
 # external imports
 from db_utils import minio_utils
-import pandas as pd
 # local imports
 from vaccine_data_to_minio import COVID_BUCKET, EDGE_CLASSIFICATION, VAX_MERGE_STR
-from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, OUTPUT_PREFIX_AGG, VACCINE_SEQ_ANN, Q1, RISK_SCORE,
+from vaccine_sequencing_munge import (OUTPUT_PREFIX_ANN, OUTPUT_PREFIX_AGG, VACCINE_SEQ_ANN, Q1, RISK_SCORE, STAFF_NO,
                                       minio_to_df, PARQUET_READER)
-from vaccine_annotate_HR_munge import VAX_TYPE, VAX_DATE, DOSE_NO
-from vaccine_register_munge import J_AND_J_VACC
 from vaccine_register_willing_munge import VACCINE_REGISTER_AGG_WILLING
-from vaccine_rollout_time_series import (TS_PREFIX, OUTFILE_PREFIX, AGG_TYPE, AGG_TYPE_NAMES, TOTAL_STAFF,
-                                         VACCINATED, VACCINATED_CUMSUM, VACCINATED_REL, TOP_LEVEL, SUBDISTRICT,
-                                         SECOND_DOSE, OUTOUT_COL_ORDER, AGG_LEVELS, get_agg_timeseries, get_agg_totals)
+from vaccine_rollout_time_series import (TS_PREFIX, OUTFILE_PREFIX as ALL_STAFF_OUTFILE_PREFIX, AGG_TYPE_NAMES,
+                                         OUTOUT_COL_ORDER, AGG_LEVELS as ALL_STAFF_AGG_LEVELS, STAFF_DF_OVERRIDE,
+                                         STAFF_READER, StaffPopulation, clean_subdistricts, get_fully_vaccinated,
+                                         get_grouping_sets_timeseries)
 
 # input settings
 CITY_VAX_REGISTER = f"{VACCINE_REGISTER_AGG_WILLING}.parquet"
 SEQUENCING_ANNOTATED = f"{VACCINE_SEQ_ANN}.parquet"
 
 # outfile
-OUTFILE_PREFIX += "-willing"
+OUTFILE_PREFIX = f"{ALL_STAFF_OUTFILE_PREFIX}-willing"
 
-AGG_LEVELS += [RISK_SCORE]
-TOTAL_STAFF = f"{TOTAL_STAFF}{OUTFILE_PREFIX}"
-VACCINATED = f"{VACCINATED}{OUTFILE_PREFIX}"
-VACCINATED_CUMSUM = f"{VACCINATED_CUMSUM}{OUTFILE_PREFIX}"
-VACCINATED_REL = f"{VACCINATED_REL}{OUTFILE_PREFIX}"
+AGG_LEVELS = ALL_STAFF_AGG_LEVELS + [RISK_SCORE]
+WILLING_REGISTER_Q1 = "1.0"
+
+
+def check_willing_staff(annotated_sequencing_df, vaccine_register_agg_df):
+    if annotated_sequencing_df.query(f"`{Q1}` == 1").empty or \
+            vaccine_register_agg_df.query(f"`{Q1}` == @WILLING_REGISTER_Q1").empty:
+        logging.error(f"Empty df, no willing staff in dataframe")
+        sys.exit(-1)
+
+
+def get_willing_population(annotated_sequencing_df, fully_vaccinated_df):
+    """
+    The staff that said that they are willing to be vaccinated, and their rows of the fully vaccinated register
+    """
+    annotated_sequencing_df_willing = annotated_sequencing_df.query(f"`{Q1}` == 1").copy()
+    register_willing = (fully_vaccinated_df[Q1] == WILLING_REGISTER_Q1).values
+
+    # the risk scores come through the register aggregate as strings, and are missing for the staff that aren't
+    # willing, so they are nullable ints, on both sides, for the risk score groups to be labelled as whole numbers
+    fully_vaccinated_df[RISK_SCORE] = fully_vaccinated_df[RISK_SCORE].astype(float).astype("Int64")
+    annotated_sequencing_df_willing[RISK_SCORE] = annotated_sequencing_df_willing[RISK_SCORE].astype("Int64")
+
+    return StaffPopulation(annotated_sequencing_df_willing, VAX_MERGE_STR, AGG_LEVELS, register_willing)
+
+
+def get_rollout_all_and_willing_time_series(annotated_sequencing_df, vaccine_register_agg_df, staff_list_df):
+    """
+    Both the all staff and the willing staff vaccine rollout time series, from a single pass over the register.
+    The willing time series only counts the register rows of the staff that said that they are willing.
+    """
+    for df in (annotated_sequencing_df, vaccine_register_agg_df, staff_list_df):
+        clean_subdistricts(df)
+
+    check_willing_staff(annotated_sequencing_df, vaccine_register_agg_df)
+
+    fully_vaccinated_df = get_fully_vaccinated(vaccine_register_agg_df)
+    willing_population = get_willing_population(annotated_sequencing_df, fully_vaccinated_df)
+
+    # ----------------------------------
+    logging.info("Aggregat[ing] vaccine total time series")
+    collected_agg_df, collected_agg_willing_df = get_grouping_sets_timeseries(
+        fully_vaccinated_df, [StaffPopulation(staff_list_df, STAFF_NO, ALL_STAFF_AGG_LEVELS), willing_population]
+    )
+    logging.info("Aggregat[ed] vaccine total time series")
+
+    collected_agg_df = collected_agg_df[OUTOUT_COL_ORDER].copy()
+    collected_agg_willing_df = collected_agg_willing_df[OUTOUT_COL_ORDER].copy()
+    # convert column for parquet
+    collected_agg_willing_df[AGG_TYPE_NAMES] = collected_agg_willing_df[AGG_TYPE_NAMES].astype(str)
+
+    return collected_agg_df, collected_agg_willing_df
+
+
+def get_rollout_willing_time_series(annotated_sequencing_df, vaccine_register_agg_df):
+    for df in (annotated_sequencing_df, vaccine_register_agg_df):
+        clean_subdistricts(df)
+
+    check_willing_staff(annotated_sequencing_df, vaccine_register_agg_df)
+
+    fully_vaccinated_df = get_fully_vaccinated(vaccine_register_agg_df)
+
+    # ----------------------------------
+    logging.info("Aggregat[ing] vaccine total time series")
+    collected_agg_df, = get_grouping_sets_timeseries(
+        fully_vaccinated_df, [get_willing_population(annotated_sequencing_df, fully_vaccinated_df)]
+    )
+    logging.info("Aggregat[ed] vaccine total time series")
+
+    collected_agg_df = collected_agg_df[OUTOUT_COL_ORDER].copy()
+    # convert column for parquet
+    collected_agg_df[AGG_TYPE_NAMES] = collected_agg_df[AGG_TYPE_NAMES].astype(str)
+
+    return collected_agg_df
 
 
 if __name__ == "__main__":
@@ -48,94 +115,39 @@ if __name__ == "__main__":
 
     # ----------------------------------
     vax_register_dfs = []
-    for filename, prefix in [
-        (SEQUENCING_ANNOTATED, OUTPUT_PREFIX_ANN),
-        (CITY_VAX_REGISTER, OUTPUT_PREFIX_AGG),
+    for filename_override, reader in [
+        (f"{OUTPUT_PREFIX_ANN}{SEQUENCING_ANNOTATED}", PARQUET_READER),
+        (f"{OUTPUT_PREFIX_AGG}{CITY_VAX_REGISTER}", PARQUET_READER),
+        (STAFF_DF_OVERRIDE, STAFF_READER),
     ]:
         df = minio_to_df(
-            minio_filename_override=f"{prefix}{filename}",
+            minio_filename_override=filename_override,
             minio_bucket=COVID_BUCKET,
             data_classification=EDGE_CLASSIFICATION,
-            reader=PARQUET_READER
+            reader=reader
         )
-        df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("_", " ") 
-        df[SUBDISTRICT] = df[SUBDISTRICT].str.replace(" support", "", case=False) 
-        df[SUBDISTRICT] = df[SUBDISTRICT].str.replace("Mitchell's", "Mitchells", case=False)
         vax_register_dfs.append(df)
 
     # dataframes
-    annotated_sequencing_df, vaccine_register_agg_df = vax_register_dfs
-    annotated_sequencing_df_willing = annotated_sequencing_df.query(f"`{Q1}` == 1").copy()
-    vaccine_register_agg_df_willing = vaccine_register_agg_df.query(f"`{Q1}` == '1.0'").copy()
+    annotated_sequencing_df, vaccine_register_agg_df, staff_list_df = vax_register_dfs
 
-    if annotated_sequencing_df.empty or annotated_sequencing_df.empty:
-        logging.error(f"Empty df, no willing staff in dataframe")
-        sys.exit(-1)
+    # the all staff time series comes out of the same pass over the register, so both get written here
+    collected_agg_dfs = get_rollout_all_and_willing_time_series(annotated_sequencing_df, vaccine_register_agg_df,
+                                                                staff_list_df)
 
     # ----------------------------------
-    # get J&J one dose vaccinations
-    logging.info("Filter[ing] to J&J vaccinations")
-    jj_1shot = vaccine_register_agg_df_willing.query(f"`{VAX_TYPE}` == @J_AND_J_VACC").copy()
-    logging.info("Filter[ed] to J&J vaccinations")
-
-    # if other exists, will need additional aggregation
-    logging.info("Check[ing] for other vaccination types")
-    # split out other vaccination types
-    other_vaccines = vaccine_register_agg_df.query(f"`{VAX_TYPE}` != @J_AND_J_VACC").copy()
-    vaccine_types = other_vaccines[VAX_TYPE].unique()
-    other_vaccines_full = other_vaccines.query(f"`{DOSE_NO}` == @SECOND_DOSE").copy()
-    logging.info("Check[ed] for other vaccination types")
-
-    # make sure only 1st dose for J&J, aggregations assume single dose for fully vaccinated
-    logging.info("Check[ing] that J&J has only dose 1 entries")
-    jj_doses = jj_1shot[DOSE_NO].nunique()
-    if jj_doses != 1:
-        logging.error(f"{jj_doses} doses detected for J&J vaccine\nExpected only one dose")
-        sys.exit(-1)
-    logging.info("Check[ed] that J&J has only dose 1 entries")
-
-    fully_vaccinated_df = pd.concat([jj_1shot, other_vaccines_full])
-
-    # convert date format
-    fully_vaccinated_df[VAX_DATE] = pd.to_datetime(fully_vaccinated_df[VAX_DATE]).dt.date
-
-    # ----------------------------------
-    # get total time series
-    vaccination_totals_time_series = get_agg_totals(fully_vaccinated_df, annotated_sequencing_df_willing)
-    vaccination_totals_time_series[AGG_TYPE] = TOP_LEVEL
-    vaccination_totals_time_series[AGG_TYPE_NAMES] = TOP_LEVEL
-
-    collected_agg_df = vaccination_totals_time_series.copy()
-    for i, agg_level in enumerate(AGG_LEVELS):
-        if agg_level == RISK_SCORE:
-            fully_vaccinated_df[agg_level] = fully_vaccinated_df[agg_level].astype(float)
-            fully_vaccinated_df[agg_level] = fully_vaccinated_df[agg_level].astype(int)
-        logging.info("Aggregat[ing] vaccine total time series")
-        staff_agg_level_ts = get_agg_timeseries(
-            fully_vaccinated_df,
-            agg_level,
-            annotated_sequencing_df_willing,
-            VAX_MERGE_STR,
+    for collected_agg_df, outfile_prefix in zip(collected_agg_dfs, (ALL_STAFF_OUTFILE_PREFIX, OUTFILE_PREFIX)):
+        logging.info(f"Push[ing] data to mino for {outfile_prefix}")
+        result = minio_utils.dataframe_to_minio(
+            collected_agg_df,
+            COVID_BUCKET,
+            secrets["minio"]["edge"]["access"],
+            secrets["minio"]["edge"]["secret"],
+            EDGE_CLASSIFICATION,
+            filename_prefix_override=f"{TS_PREFIX}{outfile_prefix}",
+            file_format="csv",
+            data_versioning=False
         )
-        collected_agg_df = pd.concat([collected_agg_df, staff_agg_level_ts])
-        logging.info("Aggregat[ed] vaccine total time series")
-
-    collected_agg_df = collected_agg_df[OUTOUT_COL_ORDER].copy()
-    # convert column for parquet
-    collected_agg_df[AGG_TYPE_NAMES] = collected_agg_df[AGG_TYPE_NAMES].astype(str)
-
-    # ----------------------------------
-    logging.info(f"Push[ing] data to mino for {OUTFILE_PREFIX}")
-    result = minio_utils.dataframe_to_minio(
-        collected_agg_df,
-        COVID_BUCKET,
-        secrets["minio"]["edge"]["access"],
-        secrets["minio"]["edge"]["secret"],
-        EDGE_CLASSIFICATION,
-        filename_prefix_override=f"{TS_PREFIX}{OUTFILE_PREFIX}",
-        file_format="csv",
-        data_versioning=False
-    )
-    logging.info(f"Push[ed] data to mino for {OUTFILE_PREFIX}")
+        logging.info(f"Push[ed] data to mino for {outfile_prefix}")
 
     logging.info("...Done!")
@@ -89,33 +89,7 @@ def willingness_agg_wrapper(df_vacc, df_seq, group_col, willing_only=False):
     return totals_willing_df
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
-
-    # secrets env
-    SECRETS_PATH_VAR = "SECRETS_PATH"
-
-    # Loading secrets
-    if SECRETS_PATH_VAR not in os.environ:
-        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
-        sys.exit(-1)
-
-    secrets_path = os.environ[SECRETS_PATH_VAR]
-    secrets = json.load(open(secrets_path))
-
-    # ----------------------------------
-    logging.info(f"Fetch[ing] the data")
-    staff_list_df_fixed_filt_unique, annotated_sequencing_df = [
-        minio_to_df(
-            minio_filename_override=filename,
-            minio_bucket=COVID_BUCKET,
-            data_classification=EDGE_CLASSIFICATION,
-            reader=PARQUET_READER
-        ) for filename in [UNIQUE_STAFF_LIST_ANN, VACCINE_SEQ_ANN]
-    ]
-    logging.info(f"Fetch[ed] the data")
-
+def aggregate_willingness(staff_list_df_fixed_filt_unique, annotated_sequencing_df):
     # ----------------------------------
     # calculate staff willingness by branch
     logging.info("Aggregat[ing] vaccine sentiment by Branch")
@@ -157,6 +131,40 @@ if __name__ == "__main__":
     })
     logging.info("Calculat[ed] staff totals")
 
+    return percent_willing_totals_df, staff_seq_by_branch, staff_seq_by_type, willingness_risk_score
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+
+    # secrets env
+    SECRETS_PATH_VAR = "SECRETS_PATH"
+
+    # Loading secrets
+    if SECRETS_PATH_VAR not in os.environ:
+        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+        sys.exit(-1)
+
+    secrets_path = os.environ[SECRETS_PATH_VAR]
+    secrets = json.load(open(secrets_path))
+
+    # ----------------------------------
+    logging.info(f"Fetch[ing] the data")
+    staff_list_df_fixed_filt_unique, annotated_sequencing_df = [
+        minio_to_df(
+            minio_filename_override=filename,
+            minio_bucket=COVID_BUCKET,
+            data_classification=EDGE_CLASSIFICATION,
+            reader=PARQUET_READER
+        ) for filename in [UNIQUE_STAFF_LIST_ANN, VACCINE_SEQ_ANN]
+    ]
+    logging.info(f"Fetch[ed] the data")
+
+    percent_willing_totals_df, staff_seq_by_branch, staff_seq_by_type, willingness_risk_score = aggregate_willingness(
+        staff_list_df_fixed_filt_unique, annotated_sequencing_df
+    )
+
     # ----------------------------------
     logging.info(f"Push[ing] data to mino")
     for outfile, out_df, prefix in [
@@ -1,4 +1,5 @@
 # base imports
+import functools
 import json
 import logging
 import os
@@ -9,7 +10,8 @@ from db_utils import minio_utils
 import pandas as pd
 import numpy as np
 
-from hr_master_data_munge import HR_MASTER_FILENAME_PATH, DIRECTORATE_COL, DEPARTMENT_COL
+from hr_master_data_munge import (HR_MASTER_FILENAME_PATH, DIRECTORATE_COL, DEPARTMENT_COL, STAFF_KEY, add_staff_key,
+                                  get_staff_keys)
 from vaccine_data_to_minio import (COVID_BUCKET, EDGE_CLASSIFICATION, VACCINE_PREFIX_RAW, SEQ_SURVEY_PREFIX,
                                    SP_STAFF_LIST_NAME, STAFF_MERGE_STR, VAX_MERGE_STR)
 
@@ -70,8 +72,10 @@ STAFF_LIST_KEEP_COLS = [
     STAFF_TYPE, BRANCH, SECTION, ORG_UNIT, FACILITY, POSITION, STAFF_NO, FIRST_NAME, LAST_NAME, GENDER, SUBDISTRICT,
     STAFF_MERGE_STR
 ]
+MERGE_CODE = "merge_code"
 HR_KEEP_COLS = [STAFF_NO, DIRECTORATE_COL, DEPARTMENT_COL, BRANCH, SECTION, ORG_UNIT, ORG_UNIT_NO, POSITION]
 FIX_HR_ATRIBUTE_COLS = [BRANCH, SECTION, ORG_UNIT, POSITION]
+HR_MASTER_READ_COLS = HR_KEEP_COLS + [STAFF_KEY]
 
 # vaccine sequencing list cols
 MODIFIED_DATE = "Modified"
@@ -100,12 +104,19 @@ STATUS_MAP = {
 }
 
 
-def minio_to_df(minio_filename_override, minio_bucket, data_classification, reader="csv"):
+def minio_to_df(minio_filename_override, minio_bucket, data_classification, reader="csv", columns=None, filters=None):
+    """
+    Reads a file out of minio. Only the columns given are read, if any, and for parquet files the filters are pushed
+    down into the reader, so that row groups that can't match aren't read at all.
+    csv files can't be filtered, and columns that aren't in them are skipped rather than being an error
+    """
     logging.debug("Pulling data from Minio bucket...")
     if reader == "csv":
-        file_reader = pd.read_csv
+        file_reader = functools.partial(
+            pd.read_csv, usecols=(lambda col: col in columns) if columns is not None else None
+        )
     elif reader == "parquet":
-        file_reader = pd.read_parquet
+        file_reader = functools.partial(pd.read_parquet, columns=columns, filters=filters)
     else:
         logging.error("reader is not 'csv' or 'parquet")
         sys.exit(-1)
@@ -126,6 +137,15 @@ def minio_to_df(minio_filename_override, minio_bucket, data_classification, read
             return df
 
 
+def get_merge_codes(left_keys, right_keys):
+    """
+    Encodes two merge key columns against the same set of values, so that they can be merged on as integers
+    """
+    codes, _ = pd.factorize(pd.concat([left_keys, right_keys], ignore_index=True))
+
+    return codes[:len(left_keys)], codes[len(left_keys):]
+
+
 def fix_attribute_cols(df, columns_to_fix, left_tag=STAFF_LIST_TAG, right_tag=HR_DATA_TAG):
     """
     Replace values in right merge column with values from left merge column if right == nan
@@ -152,39 +172,7 @@ def fix_attribute_cols(df, columns_to_fix, left_tag=STAFF_LIST_TAG, right_tag=HR
     return edit_df
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
-    
-    # secrets env
-    SECRETS_PATH_VAR = "SECRETS_PATH"
-    
-    # Loading secrets
-    if SECRETS_PATH_VAR not in os.environ:
-        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
-        sys.exit(-1)
-
-    secrets_path = os.environ[SECRETS_PATH_VAR]
-    secrets = json.load(open(secrets_path))
-    
-    # ----------------------------------
-    vaccine_dfs = []
-    for (filename, reader) in [(HR_MASTER_DATA, CSV_READER),
-                           (STAFF_LIST, PARQUET_READER),
-                           (CITY_SEQ_SURVEY, PARQUET_READER)
-                           ]:
-        
-        df = minio_to_df(
-            minio_filename_override=filename,
-            minio_bucket=COVID_BUCKET,
-            data_classification=EDGE_CLASSIFICATION,
-            reader=reader
-        )
-        vaccine_dfs.append(df)
-
-    # unpack the dfs
-    hr_data, staff_list_df, staff_vaccine_seq_df = vaccine_dfs
-    
+def annotate_sequencing(hr_data, staff_list_df, staff_vaccine_seq_df):
     # ----------------------------------
     # clean up the staff list
     staff_list_df_fixed = staff_list_df.query(
@@ -214,19 +202,20 @@ if __name__ == "__main__":
                     f"rows dropped from staff list\n{len(staff_list_df_fixed_filt_unique)} records remaining")
     
     # ----------------------------------
-    logging.info(f"Convert[ing] staff numbers to string for merge")
+    logging.info(f"Add[ing] staff keys for merge")
+    staff_list_df_fixed_filt_unique = add_staff_key(staff_list_df_fixed_filt_unique, STAFF_NO)
     staff_list_df_fixed_filt_unique[STAFF_NO] = staff_list_df_fixed_filt_unique[STAFF_NO].astype(str)
-    hr_data[STAFF_NO] = hr_data[STAFF_NO].astype(str)
-    logging.info(f"Convert[ed] staff numbers to string for merge")
+    hr_data = add_staff_key(hr_data, STAFF_NO)
+    logging.info(f"Add[ed] staff keys for merge")
     
     # ----------------------------------
     # annotate staff list with HR staff details
     logging.info(f"Merg[ing] HR master data onto Staff annotations")
     annotated_staff_list_df = pd.merge(
         staff_list_df_fixed_filt_unique, 
-        hr_data[HR_KEEP_COLS], 
+        hr_data.loc[hr_data[STAFF_KEY].notna(), [STAFF_KEY] + HR_KEEP_COLS].drop(columns=[STAFF_NO]),
         how="left",
-        on=STAFF_NO,
+        on=STAFF_KEY,
         suffixes=[STAFF_LIST_TAG, HR_DATA_TAG],
         validate="m:1",
     )
@@ -282,14 +271,15 @@ if __name__ == "__main__":
     # ----------------------------------
     # annotate vaccine register with staff details
     logging.info(f"Merg[ing] Staff annotations onto vaccine register")
+    staff_merge_codes, vax_merge_codes = get_merge_codes(annotated_staff_list_df[STAFF_MERGE_STR],
+                                                         staff_vaccine_seq_df_unique[VAX_MERGE_STR])
     annotated_sequencing_df = pd.merge(
-        annotated_staff_list_df, 
-        staff_vaccine_seq_df_unique, 
+        annotated_staff_list_df.assign(**{MERGE_CODE: staff_merge_codes}),
+        staff_vaccine_seq_df_unique.assign(**{MERGE_CODE: vax_merge_codes}),
         how="right",
-        left_on=STAFF_MERGE_STR,
-        right_on=VAX_MERGE_STR,
+        on=MERGE_CODE,
         validate="1:1"
-    )
+    ).drop(columns=[MERGE_CODE])
     logging.info(f"Merg[ed] Staff annotations onto vaccine register")
 
     # ----------------------------------
@@ -298,6 +288,47 @@ if __name__ == "__main__":
     annotated_sequencing_df[RISK_SCORE] = annotated_sequencing_df[SCORE_Q].sum(axis=1)
     logging.info("Calulat[ed] risk score")
 
+    return staff_list_df_fixed_filt_unique, annotated_staff_list_df, annotated_sequencing_df
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s-%(module)s.%(funcName)s [%(levelname)s]: %(message)s')
+    
+    # secrets env
+    SECRETS_PATH_VAR = "SECRETS_PATH"
+    
+    # Loading secrets
+    if SECRETS_PATH_VAR not in os.environ:
+        logging.error(f"'{SECRETS_PATH_VAR}' env var missing!")
+        sys.exit(-1)
+
+    secrets_path = os.environ[SECRETS_PATH_VAR]
+    secrets = json.load(open(secrets_path))
+    
+    # ----------------------------------
+    vaccine_dfs = []
+    for (filename, reader, columns) in [(HR_MASTER_DATA, CSV_READER, HR_MASTER_READ_COLS),
+                                        (STAFF_LIST, PARQUET_READER, STAFF_LIST_KEEP_COLS),
+                                        (CITY_SEQ_SURVEY, PARQUET_READER, SEQ_KEEP_COLS)
+                                        ]:
+        
+        df = minio_to_df(
+            minio_filename_override=filename,
+            minio_bucket=COVID_BUCKET,
+            data_classification=EDGE_CLASSIFICATION,
+            reader=reader,
+            columns=columns
+        )
+        vaccine_dfs.append(df)
+
+    # unpack the dfs
+    hr_data, staff_list_df, staff_vaccine_seq_df = vaccine_dfs
+    
+    staff_list_df_fixed_filt_unique, annotated_staff_list_df, annotated_sequencing_df = annotate_sequencing(
+        hr_data, staff_list_df, staff_vaccine_seq_df
+    )
+
     # ----------------------------------
     logging.info(f"Push[ing] data to mino")
     for outfile, out_df, prefix in [
@@ -1,10 +1,15 @@
+import concurrent.futures
+import contextlib
+import gzip
 import hashlib
+import io
 import json
 import logging
 import os
 import pathlib
 import sys
 
+import numpy
 import pandas
 from db_utils import minio_utils
 
@@ -18,18 +23,48 @@ STAFFNUMBER_ENCRYPTED_COL = "persno_encrypted"
 FTP_WRITE_DIR_NAME = 'COCT_WCGH'
 FTP_WRITE_FILE_NAME = 'cct_staff_id_encrypted.csv.gz'
 
+HASH_WORKERS_VAR = "VACCINE_STAFF_HASH_WORKERS"
+HASH_CHUNK_SIZE = 50000
 
-def _encrypt_data(hr_df, salt):
+
+def _hash_values(id_vals, salt):
+    return [
+        hashlib.sha256(f"{float(id_val):013.0f}{salt}".encode()).hexdigest()
+        for id_val in id_vals
+    ]
+
+
+def _hash_col(id_series, salt, executor=None, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Hashes each unique value in id_series once, in chunks spread over the executor if one is given, and maps the
+    hashes back onto the rows by their codes. Missing values stay missing.
+    """
+    codes, uniques = pandas.factorize(id_series)
+    unique_vals = uniques.tolist()
+    logging.debug(f"Hashing {len(unique_vals)} unique values of '{id_series.name}'")
+
+    if executor is not None and len(unique_vals) > chunk_size:
+        chunks = [unique_vals[i:i + chunk_size] for i in range(0, len(unique_vals), chunk_size)]
+        hashed_chunks = executor.map(_hash_values, chunks, [salt] * len(chunks))
+        hashed_vals = [hashed_val for hashed_chunk in hashed_chunks for hashed_val in hashed_chunk]
+    else:
+        hashed_vals = _hash_values(unique_vals, salt)
+
+    # missing values have a code of -1, which picks up the None on the end
+    hashed_lookup = numpy.array(hashed_vals + [None], dtype=object)
+
+    return pandas.Series(hashed_lookup[codes], index=id_series.index)
+
+
+def _encrypt_data(hr_df, salt, workers=1):
     logging.debug("Encrypting data")
-    encrypted_df = pandas.DataFrame({
-        encrypted_col: hr_df[col].apply(
-            lambda id_val: hashlib.sha256(
-                f"{float(id_val):013.0f}{salt}".encode()
-            ).hexdigest() if pandas.notna(id_val) else None
-        )
-        for col, encrypted_col in ((HR_MASTER_STAFFNUMBER, STAFFNUMBER_ENCRYPTED_COL),
-                                   (ID_COL, ID_ENCRYPED_COL))
-    })
+    hash_executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    with hash_executor or contextlib.nullcontext() as executor:
+        encrypted_df = pandas.DataFrame({
+            encrypted_col: _hash_col(hr_df[col], salt, executor)
+            for col, encrypted_col in ((HR_MASTER_STAFFNUMBER, STAFFNUMBER_ENCRYPTED_COL),
+                                       (ID_COL, ID_ENCRYPED_COL))
+        })
     logging.debug("Encrypted data")
 
     logging.debug("Shuffling data")
@@ -48,9 +83,13 @@ def _write_data_to_prov(encrypted_df, sftp):
     with sftp.file(str(sftp_path), "wb") as output_file:
         logging.debug("Open[ed] remote file")
 
-        logging.debug("Writ[ing] data")
-        encrypted_df.to_csv(output_file, index=False)
-        logging.debug("Wr[ote] data")
+        # compressing on the way out, so that the file is never held in full, locally or in memory
+        output_file.set_pipelined(True)
+        with gzip.GzipFile(fileobj=output_file, mode="wb") as gzip_file, \
+                io.TextIOWrapper(gzip_file, encoding="utf-8", newline="") as csv_file:
+            logging.debug("Writ[ing] data")
+            encrypted_df.to_csv(csv_file, index=False, chunksize=HASH_CHUNK_SIZE)
+            logging.debug("Wr[ote] data")
 
 
 if __name__ == "__main__":
@@ -73,7 +112,8 @@ if __name__ == "__main__":
     logging.info("G[ot] Staff Master Data")
 
     logging.info("Form[ing] Encrypted Data")
-    encrypted_hr_df = _encrypt_data(hr_master_df, secrets["data"]["wcgh"]["hr-staff-salt"])
+    hash_workers = int(os.environ.get(HASH_WORKERS_VAR, 1))
+    encrypted_hr_df = _encrypt_data(hr_master_df, secrets["data"]["wcgh"]["hr-staff-salt"], hash_workers)
     logging.info("Form[ed] Encrypted Data")
 
     # Getting SFTP client